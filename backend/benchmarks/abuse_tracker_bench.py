@@ -0,0 +1,31 @@
+"""
+KO Gym - Benchmark do tracker de tentativas falhadas
+Scan sintético com 1M de IPs distintos: a memória deve estabilizar no limite de IPs
+
+Uso (a partir de backend/): python -m benchmarks.abuse_tracker_bench [n_ips]
+"""
+import sys
+import time
+import tracemalloc
+from utils.abuse_store import LocalAbuseStore
+
+def run(n_ips: int = 1_000_000, max_tracked_ips: int = 50000, report_every: int = 100_000):
+    store = LocalAbuseStore(max_tracked_ips=max_tracked_ips, compact_interval=0)
+    tracemalloc.start()
+    started = time.perf_counter()
+    
+    print(f"{'ips':>10} {'tracked':>8} {'current_mb':>11} {'peak_mb':>8} {'us/op':>7}")
+    for i in range(1, n_ips + 1):
+        ip = f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+        store.record_failure(ip, "/api/auth/login", window_seconds=86400, max_attempts=5, block_seconds=900)
+        if i % report_every == 0:
+            current, peak = tracemalloc.get_traced_memory()
+            elapsed_us = (time.perf_counter() - started) * 1e6 / i
+            print(f"{i:>10} {store.stats()['tracked_ips']:>8} {current / 1e6:>11.1f} {peak / 1e6:>8.1f} {elapsed_us:>7.2f}")
+    
+    tracemalloc.stop()
+    return store.stats()
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(run(n))
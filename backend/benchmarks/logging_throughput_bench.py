@@ -0,0 +1,57 @@
+"""
+KO Gym - Benchmark de throughput com logging
+Requests/s de um handler com 4 linhas de log (como get_dashboard_stats) + LoggingMiddleware:
+logging desligado, sink síncrono (print) e sink assíncrono em fila
+
+Uso (a partir de backend/): python -m benchmarks.logging_throughput_bench [n_requests]
+O output dos logs vai para /dev/null para medir só o custo no event loop.
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from utils.logger import gym_logger, LoggingMiddleware
+
+async def dashboard_like_app(scope, receive, send):
+    gym_logger.info("Getting dashboard analytics", user_role="admin")
+    gym_logger.business_metric("dashboard_accessed", True, user_id="u1")
+    gym_logger.debug("Cache miss: dashboard_stats")
+    gym_logger.info("Dashboard stats computed", members=120, attendance=540)
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+async def receive():
+    return {"type": "http.request", "body": b""}
+
+async def send(message):
+    return None
+
+def make_scope():
+    return {"type": "http", "method": "GET", "path": "/api/dashboard", "client": ("10.0.0.1", 5000), "headers": []}
+
+async def measure(n: int) -> float:
+    app = LoggingMiddleware(dashboard_like_app)
+    started = time.perf_counter()
+    for _ in range(n):
+        await app(make_scope(), receive, send)
+    return n / (time.perf_counter() - started)
+
+def main(n: int):
+    with open(os.devnull, "w") as devnull:
+        modes = {
+            "off": dict(async_sink=False, level=logging.CRITICAL, stream=devnull),
+            "sync (print)": dict(async_sink=False, stream=devnull),
+            "async (queue)": dict(async_sink=True, stream=devnull),
+        }
+        for name, options in modes.items():
+            gym_logger.reconfigure(**options)
+            rps = asyncio.run(measure(n))
+            flush_started = time.perf_counter()
+            gym_logger.flush()
+            flush_ms = (time.perf_counter() - flush_started) * 1000
+            print(f"{name:>14}: {rps:10.0f} req/s  (flush {flush_ms:.0f} ms)")
+    gym_logger.reconfigure()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,69 @@
+"""
+KO Gym - Benchmark dos decoradores de rate limit
+Latência adicionada por api_rate_limit (create_member) e dashboard_rate_limit (/dashboard)
+para cada storage/estratégia do slowapi
+
+Uso (a partir de backend/): python -m benchmarks.rate_limit_decorator_bench [n_calls] [storage_uri ...]
+ex.: python -m benchmarks.rate_limit_decorator_bench 20000 memory redis://localhost:6379/1
+"""
+import asyncio
+import sys
+import time
+from fastapi import Request
+from utils import rate_limiter
+from utils.rate_limiter import GymRateLimiter, resolve_storage_uri
+
+STRATEGIES = ("fixed-window", "moving-window", "sliding-window-counter")
+
+def make_request(i: int) -> Request:
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/api/members",
+        "query_string": b"",
+        "client": (f"203.0.{(i >> 8) & 255}.{i & 255}", 50000),
+        "headers": [(b"host", b"ko-gym.local"), (b"content-type", b"application/json")],
+    }
+    return Request(scope)
+
+async def create_member(request: Request):
+    return None
+
+async def get_dashboard_stats(request: Request):
+    return None
+
+async def measure(func, n: int, distinct_ips: int) -> float:
+    requests = [make_request(i % distinct_ips) for i in range(n)]
+    started = time.perf_counter()
+    for request in requests:
+        await func(request=request)
+    return (time.perf_counter() - started) * 1e6 / n
+
+async def main(n: int, storages):
+    # Limites altos: mede o custo da verificação, não o 429
+    for limits in rate_limiter.ROLE_RATE_LIMITS.values():
+        for category in limits:
+            limits[category] = "100000000/minute"
+    
+    for storage in storages:
+        for strategy in STRATEGIES:
+            limiter = GymRateLimiter()
+            limiter.storage_uri = resolve_storage_uri(storage)
+            limiter._limiters.clear()
+            rate_limiter.gym_rate_limiter = limiter
+            for category in rate_limiter.RATE_LIMIT_STRATEGIES:
+                rate_limiter.RATE_LIMIT_STRATEGIES[category] = strategy
+            
+            baseline = await measure(create_member, n, 256)
+            decorated = {
+                "api_rate_limit(create_member)": rate_limiter.api_rate_limit()(create_member),
+                "dashboard_rate_limit(/dashboard)": rate_limiter.dashboard_rate_limit()(get_dashboard_stats),
+            }
+            for name, func in decorated.items():
+                us = await measure(func, n, 256)
+                print(f"{storage:>24} {strategy:>22} {name:>34}: {us - baseline:7.2f} µs/call")
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    storages = sys.argv[2:] or ["memory"]
+    asyncio.run(main(n, storages))
@@ -0,0 +1,78 @@
+"""
+KO Gym - Benchmark do RateLimitMiddleware
+Overhead por request (µs) do caminho ASGI puro vs construir um Request do Starlette,
+numa listagem (/api/members) e num recurso individual (/api/members/{id}): com 200
+sai no filtro do SecurityAnalyzer, com 404 passa pela janela do IP (pior caso)
+
+Uso (a partir de backend/): python -m benchmarks.rate_limit_middleware_bench [n_requests]
+"""
+import asyncio
+import sys
+import time
+from fastapi import Request
+from utils.rate_limiter import RateLimitMiddleware, gym_rate_limiter, resolve_client_ip
+
+def make_scope(i: int, via_proxy: bool, path: str):
+    headers = [
+        (b"host", b"ko-gym.local"),
+        (b"user-agent", b"Mozilla/5.0"),
+        (b"accept", b"application/json"),
+        (b"authorization", b"Bearer token"),
+    ]
+    client_ip = f"203.0.{(i >> 8) & 255}.{i & 255}"
+    if via_proxy:
+        headers.append((b"x-forwarded-for", f"{client_ip}, 127.0.0.1".encode()))
+        client_ip = "127.0.0.1"
+    return {"type": "http", "method": "GET", "path": path.format(i=i), "client": (client_ip, 50000),
+            "headers": headers, "query_string": b""}
+
+def make_app(status: int):
+    async def noop_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+    return noop_app
+
+async def receive():
+    return {"type": "http.request", "body": b""}
+
+async def send(message):
+    return None
+
+class RequestBasedMiddleware:
+    """Mesma resolução de IP mas através de um Request do Starlette, para comparação"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        ip = resolve_client_ip(
+            request.client.host if request.client else None,
+            request.headers.get("x-forwarded-for"),
+            request.headers.get("x-real-ip")
+        )
+        gym_rate_limiter.is_ip_blocked(ip)
+        await self.app(scope, receive, send)
+
+async def measure(middleware, n: int, via_proxy: bool, path: str) -> float:
+    scopes = [make_scope(i, via_proxy, path) for i in range(n)]
+    started = time.perf_counter()
+    for scope in scopes:
+        await middleware(scope, receive, send)
+    return (time.perf_counter() - started) * 1e6 / n
+
+async def main(n: int):
+    for path, status in (("/api/members", 200), ("/api/members/m-{i}", 200), ("/api/members/m-{i}", 404)):
+        noop_app = make_app(status)
+        for via_proxy in (False, True):
+            print(f"{path} -> {status} " + ("via trusted proxy (X-Forwarded-For)" if via_proxy else "direct client"))
+            baseline = await measure(noop_app, n, via_proxy, path)
+            for name, middleware in (
+                ("request_based", RequestBasedMiddleware(noop_app)),
+                ("pure_asgi", RateLimitMiddleware(noop_app)),
+            ):
+                us = await measure(middleware, n, via_proxy, path)
+                print(f"  {name:>14}: {us - baseline:6.2f} µs/request overhead")
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000))
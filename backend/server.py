@@ -1,13 +1,15 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query, Depends, status, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Header, Depends, status, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 import uuid
 from datetime import datetime, date, timezone, timedelta, time
 from enum import Enum
@@ -15,25 +17,40 @@ import qrcode
 from io import BytesIO
 import base64
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 import json
 import random
+import hmac
+import asyncio
 import firebase_admin
 from firebase_admin import credentials, messaging
 
 # Sistemas Premium KO Gym
 from utils.logger import gym_logger, LoggingMiddleware
 from utils.cache import gym_cache, BusinessCache, cache_result
-from utils.rate_limiter import gym_rate_limiter, auth_rate_limit, api_rate_limit, dashboard_rate_limit, RateLimitMiddleware
+from utils.rate_limiter import gym_rate_limiter, auth_rate_limit, api_rate_limit, dashboard_rate_limit, mobile_rate_limit, member_login_rate_limit, RateLimitMiddleware, create_rate_limit_handler, security_analyzer
+from slowapi.errors import RateLimitExceeded
 from utils.analytics import AnalyticsEngine
+from utils.password_hashing import password_hasher
+from utils.metrics import metrics_registry, timed, timing_summary, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from utils.db_monitoring import mongo_command_listener, slow_query_recorder
+from utils.profiler import sampling_profiler, ProfilerBusy
+from utils.loop_monitor import loop_watchdog
+from utils.business_metrics import business_metrics
+from utils.activity_registry import activity_registry
+from utils.qr import QRCodec, InvalidQRCode, member_number_cache
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# O listener atribui comandos e tempo de DB ao request em curso (Server-Timing)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[mongo_command_listener])
 db = client[os.environ['DB_NAME']]
+slow_query_recorder.attach_client(client.delegate)
+business_metrics.attach(db)
+activity_registry.attach(db)
+member_number_cache.attach(db)
 
 # Analytics Engine Premium
 analytics_engine = None
@@ -69,13 +86,16 @@ app.add_middleware(RateLimitMiddleware)
 
 # Configurar rate limiter no FastAPI
 app.state.limiter = gym_rate_limiter.limiter
+app.add_exception_handler(RateLimitExceeded, create_rate_limit_handler())
 
 # Security
 SECRET_KEY = "your-secret-key-change-in-production-2024-gym-management"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 480  # 8 hours
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Assinatura dos QR codes de check-in (KO1)
+qr_codec = QRCodec(os.environ.get("QR_SIGNING_KEY", SECRET_KEY))
+
 security = HTTPBearer()
 
 # Enums
@@ -306,6 +326,19 @@ class Attendance(BaseModel):
     check_in_time: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     method: str = "manual"  # manual or qr_code
 
+# Sincronização em lote (quiosques offline / app móvel)
+BULK_CHECKIN_MAX_ITEMS = 500
+
+class BulkCheckInItem(BaseModel):
+    member_id: str
+    activity_id: str
+    check_in_time: datetime  # Hora do scan no cliente
+    method: str = "kiosk"
+    idempotency_key: Optional[str] = None
+
+class BulkCheckInRequest(BaseModel):
+    check_ins: List[BulkCheckInItem] = Field(..., min_length=1, max_length=BULK_CHECKIN_MAX_ITEMS)
+
 class AttendanceCreate(BaseModel):
     member_id: str
     activity_id: str  # Required modalidade
@@ -436,25 +469,17 @@ class SmartDiscountCreate(BaseModel):
     usage_limit: Optional[int] = None
 
 # Authentication functions
-def verify_password(plain_password, hashed_password):
-    # Temporary SHA256 for testing
-    import hashlib
-    if len(hashed_password) == 64:  # SHA256 hash length
-        return hashlib.sha256(plain_password.encode()).hexdigest() == hashed_password
-    
-    # Bcrypt fallback
-    try:
-        if len(plain_password.encode('utf-8')) > 72:
-            plain_password = plain_password[:72]
-        return pwd_context.verify(plain_password, hashed_password)
-    except Exception:
-        return False
-
-def get_password_hash(password):
-    # Bcrypt has a 72 byte limit, truncate if necessary
-    if len(password.encode('utf-8')) > 72:
-        password = password[:72]
-    return pwd_context.hash(password)
+async def verify_password(plain_password, hashed_password, user_id: Optional[str] = None):
+    """Verifica a password no pool de hashing; com user_id grava o hash atualizado
+    (SHA256 legado ou bcrypt com outro custo) após um login válido"""
+    valid, new_hash = await password_hasher.verify(plain_password, hashed_password)
+    if valid and new_hash and user_id:
+        await db.users.update_one({"id": user_id}, {"$set": {"password_hash": new_hash}})
+        gym_logger.info("Password hash upgraded", user_id=user_id)
+    return valid
+
+async def get_password_hash(password):
+    return await password_hasher.hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -466,6 +491,29 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+@cache_result(ttl_seconds=60, tags=("principals",))
+async def load_principal(username: str) -> Optional[Dict]:
+    """Utilizador do token (sem password_hash), em cache L1/L2 por username
+    
+    Invalidado pela tag "principals" sempre que um utilizador é alterado.
+    """
+    user = await db.users.find_one({"username": username}, {"_id": 0, "password_hash": 0})
+    return User(**parse_from_mongo(user)).dict() if user else None
+
+async def principal_is_active(principal) -> bool:
+    """Dono do JWT ainda ativo: utilizadores pela cache de principals, membros pelo status"""
+    if principal.kind == "member":
+        return await db.members.find_one({"id": principal.id, "status": "active"}, {"_id": 0, "id": 1}) is not None
+    user = await load_principal(principal.id)
+    return bool(user and user["is_active"])
+
+# Rate limiting por utilizador/membro a partir do JWT (sem ir à base de dados); só um
+# request de um IP bloqueado confirma que o dono do token continua ativo
+gym_rate_limiter.configure_token_decoder(
+    lambda token: jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]),
+    active_check=principal_is_active
+)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -481,11 +529,11 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except JWTError:
         raise credentials_exception
     
-    user = await db.users.find_one({"username": username})
+    user = await load_principal(username)
     if user is None:
         raise credentials_exception
     
-    return User(**parse_from_mongo(user))
+    return User(**user)
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     if not current_user.is_active:
@@ -520,7 +568,7 @@ async def create_admin_user():
                 role=UserRole.ADMIN
             )
             admin_dict = prepare_for_mongo(admin_user.dict())
-            admin_dict["password_hash"] = get_password_hash("admin123")
+            admin_dict["password_hash"] = await get_password_hash("admin123")
             await db.users.insert_one(admin_dict)
             print("Admin user created successfully")
     except Exception as e:
@@ -580,8 +628,115 @@ async def update_existing_members_with_numbers():
                 }
             }
         )
+        member_number_cache.put(next_number, member["id"])
         print(f"Updated member {member['name']} with number {next_number}")
 
+async def backfill_workout_counters(batch_size: int = 500):
+    """Preenche workout_count/last_check_in_at dos membros que ainda não têm o contador
+    
+    Uma agregação por lote de membros e um bulk_write; só toca em membros sem o campo.
+    """
+    updated = 0
+    while True:
+        members = await db.members.find(
+            {"workout_count": {"$exists": False}}, {"_id": 0, "id": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not members:
+            break
+        
+        member_ids = [member["id"] for member in members]
+        totals = {
+            row["_id"]: row
+            async for row in db.attendance.aggregate([
+                {"$match": {"member_id": {"$in": member_ids}}},
+                {"$group": {"_id": "$member_id", "count": {"$sum": 1}, "last": {"$max": "$check_in_time"}}}
+            ])
+        }
+        operations = []
+        for member_id in member_ids:
+            row = totals.get(member_id, {})
+            operations.append(UpdateOne(
+                {"id": member_id, "workout_count": {"$exists": False}},
+                {"$set": {"workout_count": row.get("count", 0), "last_check_in_at": row.get("last")}}
+            ))
+        await db.members.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    
+    if updated:
+        gym_logger.info("Workout counters backfilled", members=updated)
+
+# Scans repetidos do mesmo membro/atividade dentro desta janela contam como um check-in
+CHECKIN_DEDUPE_WINDOW_SECONDS = int(os.environ.get("CHECKIN_DEDUPE_WINDOW_SECONDS", "120"))
+
+async def ensure_attendance_indexes():
+    """Índices únicos parciais que tornam os check-ins idempotentes"""
+    await db.attendance.create_index(
+        "dedupe_key", unique=True, partialFilterExpression={"dedupe_key": {"$exists": True}}
+    )
+    await db.attendance.create_index(
+        "idempotency_key", unique=True, partialFilterExpression={"idempotency_key": {"$exists": True}}
+    )
+
+def local_check_in_date(check_in_time: Optional[datetime] = None) -> date:
+    """Dia da presença na hora local do servidor, como date.today() nos check-ins ao vivo
+    
+    Todos os caminhos (manual, QR, app, lote) têm de derivar o dia da mesma forma:
+    o dia entra na dedupe_key e um lote com o dia em UTC deixava passar duplicados.
+    """
+    if check_in_time is None:
+        return date.today()
+    return check_in_time.astimezone().date()
+
+def attendance_dedupe_key(member_id: str, activity_id: Optional[str], check_in_date: date, check_in_time: datetime) -> str:
+    """member:atividade:dia:janela - dois scans na mesma janela colidem no índice único
+    
+    O dia entra na chave: presenças retroativas de dias diferentes lançadas
+    em seguida (mesmo check_in_time) não são duplicados.
+    """
+    bucket = int(check_in_time.timestamp()) // CHECKIN_DEDUPE_WINDOW_SECONDS
+    return f"{member_id}:{activity_id}:{check_in_date.isoformat()}:{bucket}"
+
+async def insert_attendance(attendance: Attendance, idempotency_key: Optional[str] = None) -> Tuple[dict, bool]:
+    """Insere a presença ou devolve a original se for repetida: (documento, criada)
+    
+    Repetições (Idempotency-Key já usada ou mesmo membro/atividade na janela de
+    dedupe) são detetadas pelo índice único: um insert falhado e um find_one.
+    """
+    attendance_dict = prepare_for_mongo(attendance.dict())
+    if CHECKIN_DEDUPE_WINDOW_SECONDS > 0:
+        attendance_dict["dedupe_key"] = attendance_dedupe_key(
+            attendance.member_id, attendance.activity_id, attendance.check_in_date, attendance.check_in_time
+        )
+    if idempotency_key:
+        attendance_dict["idempotency_key"] = idempotency_key
+    
+    try:
+        await db.attendance.insert_one(attendance_dict)
+    except DuplicateKeyError:
+        conditions = [{"dedupe_key": attendance_dict["dedupe_key"]}] if "dedupe_key" in attendance_dict else []
+        if idempotency_key:
+            conditions.append({"idempotency_key": idempotency_key})
+        original = await db.attendance.find_one({"$or": conditions}, {"_id": 0})
+        if original is None:
+            raise
+        if original["member_id"] != attendance.member_id:
+            raise HTTPException(status_code=409, detail="Idempotency key already used for another check-in")
+        gym_logger.info("Duplicate check-in ignored", member_id=attendance.member_id,
+                        activity_id=attendance.activity_id, attendance_id=original["id"])
+        return original, False
+    
+    attendance_dict.pop("_id", None)
+    return attendance_dict, True
+
+async def increment_workout_count(member_filter: dict) -> Optional[dict]:
+    """$inc atómico do contador de treinos; devolve o membro já atualizado (ou None)"""
+    return await db.members.find_one_and_update(
+        member_filter,
+        {"$inc": {"workout_count": 1}, "$set": {"last_check_in_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0, "id": 1, "workout_count": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
 async def create_default_motivational_notes():
     """Create default sarcastic motivational notes if they don't exist"""
     existing_notes = await db.motivational_notes.count_documents({})
@@ -814,6 +969,7 @@ async def generate_next_invoice_number():
         timestamp = int(datetime.now().timestamp())
         return f"INV-{datetime.now().year}-{timestamp}"
 
+@timed
 async def calculate_smart_discount(member_id: str, amount: float):
     """Calculate applicable smart discounts for a member"""
     try:
@@ -874,6 +1030,7 @@ async def calculate_smart_discount(member_id: str, amount: float):
         print(f"Error calculating smart discount: {e}")
         return 0.0, None
 
+@timed
 async def generate_fiscal_report(report_type: str, period_start: date, period_end: date):
     """Generate fiscal report for a specific period"""
     try:
@@ -956,6 +1113,7 @@ async def root():
 
 # Activities/Modalidades Routes
 @api_router.get("/activities", response_model=List[Activity])
+@cache_result(ttl_seconds=600, tags=("activities",))
 async def get_activities(current_user: User = Depends(require_admin_or_staff)):
     activities = await db.activities.find({"is_active": True}).to_list(1000)
     return [Activity(**parse_from_mongo(activity)) for activity in activities]
@@ -968,6 +1126,8 @@ async def create_activity(
     activity = Activity(**activity_data.dict())
     activity_dict = prepare_for_mongo(activity.dict())
     await db.activities.insert_one(activity_dict)
+    activity_registry.invalidate()
+    gym_cache.invalidate_tags("activities")
     return activity
 
 @api_router.put("/activities/{activity_id}", response_model=Activity)
@@ -985,6 +1145,9 @@ async def update_activity(
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Activity not found")
     
+    gym_cache.delete(f"activity:{activity_id}")
+    gym_cache.invalidate_tags("activities")
+    activity_registry.invalidate()
     updated_activity = await db.activities.find_one({"id": activity_id})
     return Activity(**parse_from_mongo(updated_activity))
 
@@ -1002,18 +1165,22 @@ async def delete_activity(
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Activity not found")
     
+    gym_cache.delete(f"activity:{activity_id}")
+    gym_cache.invalidate_tags("activities")
+    activity_registry.invalidate()
     return {"message": "Activity deactivated successfully"}
 
 # Authentication Routes
 @api_router.post("/auth/login", response_model=Token)
-async def login(user_credentials: UserLogin):
+async def login(user_credentials: UserLogin, request: Request):
     print(f"Login attempt for username: {user_credentials.username}")
     user = await db.users.find_one({"username": user_credentials.username})
     print(f"User found: {user is not None}")
-    if user:
-        print(f"Password check: {verify_password(user_credentials.password, user['password_hash'])}")
     
-    if not user or not verify_password(user_credentials.password, user["password_hash"]):
+    client_ip = gym_rate_limiter.get_client_ip(request)
+    if not user or not await verify_password(user_credentials.password, user["password_hash"], user.get("id")):
+        # Conta para o bloqueio de IP partilhado entre workers
+        gym_rate_limiter.record_failed_attempt(client_ip, "/auth/login")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -1023,7 +1190,8 @@ async def login(user_credentials: UserLogin):
     if not user["is_active"]:
         raise HTTPException(status_code=400, detail="User account is disabled")
     
-    access_token = create_access_token(data={"sub": user["username"]})
+    gym_rate_limiter.record_successful_attempt(client_ip)
+    access_token = create_access_token(data={"sub": user["username"], "role": user["role"]})
     user_obj = User(**parse_from_mongo(user))
     
     return Token(
@@ -1061,7 +1229,7 @@ async def create_user(
     )
     
     user_dict = prepare_for_mongo(user.dict())
-    user_dict["password_hash"] = get_password_hash(user_data.password)
+    user_dict["password_hash"] = await get_password_hash(user_data.password)
     
     await db.users.insert_one(user_dict)
     return user
@@ -1081,7 +1249,7 @@ async def update_user(
     
     # Update password if provided
     if user_data.password:
-        user_dict["password_hash"] = get_password_hash(user_data.password)
+        user_dict["password_hash"] = await get_password_hash(user_data.password)
     
     result = await db.users.update_one(
         {"id": user_id},
@@ -1090,6 +1258,7 @@ async def update_user(
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    gym_cache.invalidate_tags("principals")
     
     updated_user = await db.users.find_one({"id": user_id})
     return User(**parse_from_mongo(updated_user))
@@ -1112,6 +1281,7 @@ async def toggle_user_status(
         {"id": user_id},
         {"$set": {"is_active": new_status}}
     )
+    gym_cache.invalidate_tags("principals")
     
     return {"message": f"User {'activated' if new_status else 'deactivated'} successfully"}
 
@@ -1135,10 +1305,12 @@ async def delete_user(
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    gym_cache.invalidate_tags("principals")
     
     return {"message": "User deleted successfully"}
 
 # Helper functions
+@timed
 def generate_qr_code(member_id: str) -> str:
     """Generate QR code for member"""
     qr_data = f"MEMBER:{member_id}"
@@ -1152,9 +1324,10 @@ def generate_qr_code(member_id: str) -> str:
     img_str = base64.b64encode(buffer.getvalue()).decode()
     return f"data:image/png;base64,{img_str}"
 
+@timed
 def generate_member_qr_code(member_number: str, member_id: str) -> str:
-    """Generate QR code for member check-in"""
-    qr_data = f"{member_number}-{member_id}"
+    """Generate QR code for member check-in (signed KO1 payload)"""
+    qr_data = qr_codec.encode(member_number, member_id)
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
@@ -1352,6 +1525,24 @@ def parse_from_mongo(item):
                     pass
     return item
 
+async def get_member_summaries(member_ids) -> Dict[str, dict]:
+    """Resumo (id, nome) de vários membros: cache em lote + um único $in para os em falta"""
+    async def load(missing_ids):
+        docs = await db.members.find(
+            {"id": {"$in": missing_ids}}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
+        return {doc["id"]: doc for doc in docs}
+    
+    return await gym_cache.get_or_load_many("member_summary", member_ids, load, ttl_seconds=300)
+
+async def get_activities_by_id(activity_ids) -> Dict[str, dict]:
+    """Documentos de várias atividades: cache em lote + um único $in para as em falta"""
+    async def load(missing_ids):
+        docs = await db.activities.find({"id": {"$in": missing_ids}}, {"_id": 0}).to_list(None)
+        return {doc["id"]: doc for doc in docs}
+    
+    return await gym_cache.get_or_load_many("activity", activity_ids, load, ttl_seconds=600)
+
 # Member Routes
 @api_router.post("/members", response_model=Member)
 @api_rate_limit()
@@ -1374,10 +1565,12 @@ async def create_member(
         member = Member(**member_dict)
         
         # Generate QR code with member number
-        member.qr_code = generate_qr_code(f"{member.member_number}-{member.id}")
+        member.qr_code = generate_member_qr_code(member.member_number, member.id)
         
         member_dict = prepare_for_mongo(member.dict())
+        member_dict["workout_count"] = 0
         await db.members.insert_one(member_dict)
+        member_number_cache.put(member.member_number, member.id)
         
         # Invalidate related cache
         BusinessCache.invalidate_member_cache()
@@ -1460,6 +1653,7 @@ async def update_member(
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Member not found")
     
+    gym_cache.delete(f"member_summary:{member_id}")
     updated_member = await db.members.find_one({"id": member_id})
     return Member(**parse_from_mongo(updated_member))
 
@@ -1468,36 +1662,178 @@ async def delete_member(
     member_id: str,
     current_user: User = Depends(require_admin_or_staff)
 ):
-    result = await db.members.delete_one({"id": member_id})
-    if result.deleted_count == 0:
+    member = await db.members.find_one_and_delete({"id": member_id}, {"_id": 0, "member_number": 1})
+    if member is None:
         raise HTTPException(status_code=404, detail="Member not found")
+    gym_cache.delete(f"member_summary:{member_id}")
+    # O número pode voltar a ser atribuído (próximo = maior existente + 1)
+    if member.get("member_number"):
+        member_number_cache.invalidate(member["member_number"])
     return {"message": "Member deleted successfully"}
 
 # Attendance Routes
-@api_router.post("/attendance", response_model=Attendance)
-async def create_attendance(
+async def record_attendance(
     attendance_data: AttendanceCreate,
-    current_user: User = Depends(require_admin_or_staff)
-):
+    idempotency_key: Optional[str] = None,
+    member: Optional[Dict] = None
+) -> Tuple[Attendance, bool]:
+    """Check-in de staff (manual ou QR): (presença, criada)
+    
+    member: documento já lido pelo chamador (check-in QR), evita um segundo find
+    """
     # Check if member exists
-    member = await db.members.find_one({"id": attendance_data.member_id})
+    if member is None:
+        member = await db.members.find_one({"id": attendance_data.member_id})
     if not member:
         raise HTTPException(status_code=404, detail="Member not found")
     
     # Check if activity exists
-    activity = await db.activities.find_one({"id": attendance_data.activity_id, "is_active": True})
+    activity = await activity_registry.get_active(attendance_data.activity_id)
     if not activity:
         raise HTTPException(status_code=404, detail="Activity not found")
     
     # Set check_in_date to today if not provided
     if not attendance_data.check_in_date:
-        attendance_data.check_in_date = date.today()
+        attendance_data.check_in_date = local_check_in_date()
     
     attendance = Attendance(**attendance_data.dict())
-    attendance_dict = prepare_for_mongo(attendance.dict())
-    await db.attendance.insert_one(attendance_dict)
+    attendance_doc, created = await insert_attendance(attendance, idempotency_key)
+    if not created:
+        return Attendance(**parse_from_mongo(attendance_doc)), False
+    
+    await increment_workout_count({"id": attendance_data.member_id})
+    business_metrics.record("attendance_checked_in", 1, at=attendance.check_in_time, method=attendance.method)
+    return attendance, True
+
+@api_router.post("/attendance", response_model=Attendance)
+async def create_attendance(
+    attendance_data: AttendanceCreate,
+    current_user: User = Depends(require_admin_or_staff),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    attendance, _ = await record_attendance(attendance_data, idempotency_key)
     return attendance
 
+@api_router.post("/attendance/bulk")
+@api_rate_limit()
+async def bulk_create_attendance(
+    payload: BulkCheckInRequest,
+    current_user: User = Depends(require_admin_or_staff),
+    request: Request = None
+):
+    """Sync queued check-ins (kiosks/mobile offline) with per-item status
+    
+    Um $in para os membros, as atividades do lote de uma vez no registo em
+    memória, um insert_many não ordenado (duplicados caem nos índices únicos) e
+    um bulk_write para os contadores; o rollup por minuto vai para business_metrics.
+    """
+    items = payload.check_ins
+    now = datetime.now(timezone.utc)
+    oldest_allowed = now - timedelta(days=int(os.environ.get("CHECKIN_SYNC_MAX_AGE_DAYS", "7")))
+    results = [{"index": index, "status": "pending", "attendance_id": None} for index in range(len(items))]
+    
+    member_ids = list({item.member_id for item in items})
+    active_members = {
+        doc["id"] for doc in await db.members.find(
+            {"id": {"$in": member_ids}, "status": "active"}, {"_id": 0, "id": 1}
+        ).to_list(None)
+    }
+    active_activities = await activity_registry.get_active_many(item.activity_id for item in items)
+    
+    documents, positions = [], []
+    for index, item in enumerate(items):
+        check_in_time = item.check_in_time if item.check_in_time.tzinfo else item.check_in_time.replace(tzinfo=timezone.utc)
+        if item.member_id not in active_members:
+            results[index]["status"] = "invalid_member"
+            continue
+        if item.activity_id not in active_activities:
+            results[index]["status"] = "invalid_activity"
+            continue
+        if not oldest_allowed <= check_in_time <= now + timedelta(minutes=5):
+            results[index]["status"] = "invalid_timestamp"
+            continue
+        
+        attendance = Attendance(
+            member_id=item.member_id,
+            activity_id=item.activity_id,
+            check_in_date=local_check_in_date(check_in_time),
+            check_in_time=check_in_time,
+            method=item.method
+        )
+        document = prepare_for_mongo(attendance.dict())
+        if CHECKIN_DEDUPE_WINDOW_SECONDS > 0:
+            document["dedupe_key"] = attendance_dedupe_key(
+                item.member_id, item.activity_id, attendance.check_in_date, check_in_time
+            )
+        if item.idempotency_key:
+            document["idempotency_key"] = item.idempotency_key
+        documents.append(document)
+        positions.append(index)
+    
+    failed = {}
+    if documents:
+        try:
+            await db.attendance.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"]: error for error in e.details.get("writeErrors", [])}
+    
+    created, duplicates = [], []
+    for batch_index, (document, index) in enumerate(zip(documents, positions)):
+        error = failed.get(batch_index)
+        if error is None:
+            results[index].update(status="created", attendance_id=document["id"])
+            created.append(document)
+        elif error.get("code") == 11000:
+            results[index]["status"] = "duplicate"
+            duplicates.append((document, index))
+        else:
+            results[index].update(status="error", error=error.get("errmsg"))
+    
+    # Duplicados devolvem o id da presença original (um único find); uma
+    # Idempotency-Key já usada por outro membro é um conflito, como o 409 de POST /attendance
+    if duplicates:
+        conditions = [{"dedupe_key": doc["dedupe_key"]} for doc, _ in duplicates if "dedupe_key" in doc]
+        conditions += [{"idempotency_key": doc["idempotency_key"]} for doc, _ in duplicates if "idempotency_key" in doc]
+        originals = await db.attendance.find(
+            {"$or": conditions}, {"_id": 0, "id": 1, "member_id": 1, "dedupe_key": 1, "idempotency_key": 1}
+        ).to_list(None)
+        by_key = {}
+        for original in originals:
+            for field in ("dedupe_key", "idempotency_key"):
+                if original.get(field):
+                    by_key[(field, original[field])] = original
+        for document, index in duplicates:
+            original = (
+                by_key.get(("idempotency_key", document.get("idempotency_key")))
+                or by_key.get(("dedupe_key", document.get("dedupe_key")))
+            )
+            if original is not None and original["member_id"] != document["member_id"]:
+                results[index]["status"] = "conflict"
+            elif original is not None:
+                results[index]["attendance_id"] = original["id"]
+    
+    # Contadores: um UpdateOne por membro com o total de check-ins criados
+    if created:
+        per_member: Dict[str, Tuple[int, str]] = {}
+        for document in created:
+            count, last = per_member.get(document["member_id"], (0, ""))
+            per_member[document["member_id"]] = (count + 1, max(last, document["check_in_time"]))
+        await db.members.bulk_write([
+            UpdateOne({"id": member_id}, {"$inc": {"workout_count": count}, "$max": {"last_check_in_at": last}})
+            for member_id, (count, last) in per_member.items()
+        ], ordered=False)
+        
+        for document in created:
+            business_metrics.record("attendance_checked_in", 1,
+                                    at=datetime.fromisoformat(document["check_in_time"]), method=document["method"])
+    
+    summary = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    gym_logger.info("Bulk check-in sync", user_id=current_user.id, items=len(items), **summary)
+    
+    return {"summary": summary, "results": results}
+
 @api_router.get("/attendance", response_model=List[Attendance])
 async def get_attendance(
     member_id: Optional[str] = None,
@@ -1846,9 +2182,10 @@ async def get_activity_report(
     activity_stats = await db.attendance.aggregate(pipeline).to_list(1000)
     
     # Enrich with activity names
+    activities = await get_activities_by_id(stat["activity_id"] for stat in activity_stats)
     enriched_stats = []
     for stat in activity_stats:
-        activity = await db.activities.find_one({"id": stat["activity_id"]})
+        activity = activities.get(stat["activity_id"])
         stat["activity_name"] = activity["name"] if activity else "Unknown"
         stat["activity_color"] = activity["color"] if activity else "#gray"
         enriched_stats.append(stat)
@@ -1901,9 +2238,10 @@ async def get_top_members_report(
     top_members = await db.attendance.aggregate(pipeline).to_list(limit)
     
     # Enrich with member names
+    members = await get_member_summaries(member_stat["_id"] for member_stat in top_members)
     enriched_members = []
     for member_stat in top_members:
-        member = await db.members.find_one({"id": member_stat["_id"]})
+        member = members.get(member_stat["_id"])
         member_stat["member_name"] = member["name"] if member else "Unknown"
         member_stat["member_id"] = member_stat["_id"]
         enriched_members.append(member_stat)
@@ -1915,26 +2253,26 @@ async def get_top_members_report(
 async def qr_checkin(
     qr_data: str,
     activity_id: str,
-    current_user: User = Depends(require_admin_or_staff)
+    current_user: User = Depends(require_admin_or_staff),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    # Extract member number and ID from QR code
-    if not qr_data or "-" not in qr_data:
-        raise HTTPException(status_code=400, detail="Invalid QR code")
-    
+    """QR check-in: signed KO1 payloads are verified locally (HMAC), legacy
+    "<number>-<id>" / "MEMBER:<id>" codes are still accepted during migration"""
     try:
-        parts = qr_data.split("-")
-        member_number = parts[0]
-        member_id = parts[1]
-    except (ValueError, IndexError):
-        raise HTTPException(status_code=400, detail="Invalid QR code format")
-    
-    # Check if member exists (try both member number and ID)
-    member = await db.members.find_one({
-        "$or": [
-            {"member_number": member_number, "id": member_id},
-            {"id": member_id}
-        ]
-    })
+        payload = qr_codec.parse(qr_data)
+    except InvalidQRCode as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Um só find pelo id; códigos antigos só com o número resolvem-no pela cache
+    member_id = payload.member_id
+    if member_id is None:
+        member_id = await member_number_cache.resolve(payload.member_number)
+    member = await db.members.find_one({"id": member_id}) if member_id else None
+    if not member and payload.member_id is None and member_id:
+        # Número reatribuído noutro worker: a entrada da cache está obsoleta
+        member_number_cache.invalidate(payload.member_number)
+        member_id = await member_number_cache.resolve(payload.member_number)
+        member = await db.members.find_one({"id": member_id}) if member_id else None
     if not member:
         raise HTTPException(status_code=404, detail="Member not found")
     
@@ -1944,17 +2282,19 @@ async def qr_checkin(
         activity_id=activity_id,
         method="qr_code"
     )
-    attendance = await create_attendance(attendance_data)
+    attendance, created = await record_attendance(attendance_data, idempotency_key, member=member)
     
     return {
-        "message": "Check-in successful",
+        "message": "Check-in successful" if created else "Already checked in",
+        "duplicate": not created,
         "member": Member(**parse_from_mongo(member)),
         "attendance": attendance
     }
 
 # Mobile API Endpoints
 @api_router.post("/mobile/auth/login")
-async def mobile_login(credentials: MobileMemberLogin):
+@member_login_rate_limit()
+async def mobile_login(credentials: MobileMemberLogin, request: Request):
     """Mobile app login using member number and phone"""
     member = await db.members.find_one({
         "member_number": credentials.member_number,
@@ -1965,8 +2305,8 @@ async def mobile_login(credentials: MobileMemberLogin):
     if not member:
         raise HTTPException(status_code=401, detail="Invalid credentials or inactive member")
     
-    # Get workout count for motivational note
-    workout_count = await db.attendance.count_documents({"member_id": member["id"]})
+    # Contador mantido nos check-ins (sem contar o histórico)
+    workout_count = member.get("workout_count", 0)
     
     # Generate token for member (using member role)
     token_data = {"sub": member["id"], "role": "member"}
@@ -1989,14 +2329,15 @@ async def mobile_login(credentials: MobileMemberLogin):
     }
 
 @api_router.get("/mobile/profile", response_model=MobileMember)
-async def get_mobile_profile(member_id: str):
+@mobile_rate_limit()
+async def get_mobile_profile(member_id: str, request: Request):
     """Get mobile member profile with workout count and motivational note"""
     member = await db.members.find_one({"id": member_id})
     if not member:
         raise HTTPException(status_code=404, detail="Member not found")
     
-    # Get workout count
-    workout_count = await db.attendance.count_documents({"member_id": member_id})
+    # Contador mantido nos check-ins (sem contar o histórico)
+    workout_count = member.get("workout_count", 0)
     
     # Get motivational note
     motivational_note = get_motivational_note_for_member(workout_count, "pt")
@@ -2011,7 +2352,8 @@ async def get_mobile_profile(member_id: str):
     return mobile_member
 
 @api_router.put("/mobile/profile/{member_id}")
-async def update_mobile_profile(member_id: str, profile_data: dict):
+@mobile_rate_limit()
+async def update_mobile_profile(member_id: str, profile_data: dict, request: Request):
     """Update mobile member profile (limited fields)"""
     # Only allow updating certain fields from mobile
     allowed_fields = ["email", "phone", "address", "photo_url"]
@@ -2050,43 +2392,60 @@ async def get_mobile_activities():
     return [Activity(**parse_from_mongo(activity)) for activity in activities]
 
 @api_router.post("/mobile/checkin")
-async def mobile_qr_checkin(member_id: str, activity_id: str):
-    """Mobile QR check-in"""
-    # Verify member exists and is active
-    member = await db.members.find_one({"id": member_id, "status": "active"})
-    if not member:
-        raise HTTPException(status_code=404, detail="Member not found or inactive")
+@mobile_rate_limit()
+async def mobile_qr_checkin(
+    member_id: str,
+    activity_id: str,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Mobile QR check-in
     
+    Duas escritas e nenhum scan: atividade validada em memória, presença inserida
+    (idempotente) e contador do membro incrementado no mesmo find_one_and_update
+    que confirma que está ativo. Um scan repetido custa um insert falhado e dois finds.
+    """
     # Verify activity exists and is active
-    activity = await db.activities.find_one({"id": activity_id, "is_active": True})
+    activity = await activity_registry.get_active(activity_id)
     if not activity:
         raise HTTPException(status_code=404, detail="Activity not found or inactive")
     
-    # Create attendance record
+    # Create attendance record (ou devolver a original se for um scan repetido)
     attendance_data = AttendanceCreate(
         member_id=member_id,
         activity_id=activity_id,
-        check_in_date=date.today(),
+        check_in_date=local_check_in_date(),
         method="mobile_qr"
     )
-    attendance = Attendance(**attendance_data.dict())
-    attendance_dict = prepare_for_mongo(attendance.dict())
-    await db.attendance.insert_one(attendance_dict)
+    attendance_doc, created = await insert_attendance(Attendance(**attendance_data.dict()), idempotency_key)
+    attendance = Attendance(**parse_from_mongo(attendance_doc))
     
-    # Get updated workout count and motivational note
-    workout_count = await db.attendance.count_documents({"member_id": member_id})
+    if created:
+        # Verify member exists and is active, and count the workout
+        member = await increment_workout_count({"id": member_id, "status": "active"})
+        if not member:
+            await db.attendance.delete_one({"id": attendance.id})
+            raise HTTPException(status_code=404, detail="Member not found or inactive")
+        business_metrics.record("attendance_checked_in", 1, at=attendance.check_in_time, method=attendance.method)
+    else:
+        member = await db.members.find_one({"id": member_id}, {"_id": 0, "workout_count": 1}) or {}
+    
+    workout_count = member.get("workout_count", 0)
     motivational_note = get_motivational_note_for_member(workout_count, "pt")
     
     return {
-        "message": "Check-in successful",
+        "message": "Check-in successful" if created else "Already checked in",
+        "duplicate": not created,
         "workout_count": workout_count,
         "motivational_note": motivational_note,
         "attendance": attendance
     }
 
 @api_router.get("/mobile/attendance/{member_id}")
+@mobile_rate_limit()
 async def get_mobile_attendance_history(
     member_id: str,
+    request: Request,
     limit: int = 20,
     offset: int = 0
 ):
@@ -2097,22 +2456,22 @@ async def get_mobile_attendance_history(
     ).sort("check_in_date", -1).skip(offset).limit(limit).to_list(limit)
     
     # Enrich with activity data
+    activities = await get_activities_by_id(record.get("activity_id") for record in attendance_records)
     detailed_records = []
     for record in attendance_records:
-        activity = None
-        if record.get("activity_id"):
-            activity = await db.activities.find_one({"id": record["activity_id"]})
+        activity = activities.get(record.get("activity_id"))
         
         detailed_record = {
             **parse_from_mongo(record),
-            "activity": parse_from_mongo(activity) if activity else None
+            "activity": parse_from_mongo(dict(activity)) if activity else None
         }
         detailed_records.append(detailed_record)
     
     return detailed_records
 
 @api_router.get("/mobile/messages/{member_id}")
-async def get_mobile_messages(member_id: str, unread_only: bool = False):
+@mobile_rate_limit()
+async def get_mobile_messages(member_id: str, request: Request, unread_only: bool = False):
     """Get messages for member"""
     filter_dict = {
         "$or": [
@@ -2313,6 +2672,44 @@ async def get_churn_analysis(current_user: User = Depends(require_admin), reques
         gym_logger.error("Churn analysis generation failed", error=e, user_id=current_user.id)
         raise HTTPException(status_code=500, detail="Failed to generate churn analysis")
 
+@api_router.get("/analytics/business-metrics")
+@api_rate_limit()
+async def get_business_metrics_series(
+    name: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    interval: str = Query("hour", pattern="^(minute|hour|day)$"),
+    group_by: Optional[str] = Query(None, pattern="^[a-z_]+$"),
+    sum_field: Optional[str] = Query(None, pattern="^[a-z_]+$"),
+    current_user: User = Depends(require_admin),
+    request: Request = None
+):
+    """Time series for an aggregated business metric (Admin only)
+    
+    Defaults to the last 24 hours; group_by splits by a label (ex.: user_role),
+    sum_field adds the sum of a numeric field (ex.: amount for invoice_created).
+    """
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=1)
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if interval == "minute" and end - start > timedelta(days=2):
+        raise HTTPException(status_code=400, detail="Minute resolution is limited to 2 days")
+    
+    points = await business_metrics.series(name, start, end, interval, group_by=group_by, sum_field=sum_field)
+    return {
+        "name": name,
+        "interval": interval,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "group_by": group_by,
+        "points": points
+    }
+
 @api_router.get("/system/status")
 @api_rate_limit()
 async def get_system_status(current_user: User = Depends(require_admin), request: Request = None):
@@ -2346,6 +2743,17 @@ async def get_system_status(current_user: User = Depends(require_admin), request
             "database": db_stats,
             "analytics": analytics_status,
             "firebase": firebase_status,
+            "abuse_tracking": gym_rate_limiter.abuse_store.stats(),
+            "security_analysis": security_analyzer.get_stats(),
+            "password_hashing": password_hasher.get_stats(),
+            "logging": gym_logger.sink_stats(),
+            "slow_queries": slow_query_recorder.stats(),
+            "function_timings": timing_summary(),
+            "profiler": sampling_profiler.stats(),
+            "event_loop": loop_watchdog.get_stats(),
+            "business_metrics": business_metrics.get_stats(),
+            "activity_registry": activity_registry.get_stats(),
+            "qr_codes": {**qr_codec.get_stats(), "member_number_cache": member_number_cache.get_stats()},
             "uptime_info": "Available in production monitoring"
         }
         
@@ -2361,6 +2769,57 @@ async def get_system_status(current_user: User = Depends(require_admin), request
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
 
+@api_router.get("/system/slow-queries")
+@api_rate_limit()
+async def get_slow_queries(
+    limit: int = Query(20, ge=1, le=200),
+    sort_by: str = Query("total_ms", pattern="^(total_ms|count|max_ms)$"),
+    current_user: User = Depends(require_admin),
+    request: Request = None
+):
+    """Top-N query shapes above SLOW_QUERY_MS (Admin only)"""
+    return {
+        **slow_query_recorder.stats(),
+        "sort_by": sort_by,
+        "queries": slow_query_recorder.top(limit, sort_by)
+    }
+
+@api_router.delete("/system/slow-queries")
+@api_rate_limit()
+async def reset_slow_queries(current_user: User = Depends(require_admin), request: Request = None):
+    """Reset the slow query aggregates (Admin only)"""
+    slow_query_recorder.reset()
+    gym_logger.info("Slow query aggregates reset", user_id=current_user.id)
+    return {"message": "Slow query aggregates reset"}
+
+@api_router.get("/system/profile")
+@api_rate_limit()
+async def profile_system(
+    seconds: float = Query(10, gt=0, le=60),
+    format: str = Query("collapsed", pattern="^(collapsed|json)$"),
+    current_user: User = Depends(require_admin),
+    request: Request = None
+):
+    """Sample all thread and asyncio task stacks for N seconds (Admin only)
+    
+    Returns collapsed stacks (flamegraph.pl / speedscope); only one session at a time.
+    """
+    if sampling_profiler.running:
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+    
+    gym_logger.info("Profiling session started", seconds=seconds, user_id=current_user.id)
+    try:
+        # O profiler bloqueia a sua thread; o event loop continua a servir (e a ser amostrado)
+        result = await asyncio.to_thread(sampling_profiler.profile, seconds, asyncio.get_running_loop())
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+    
+    stacks = result.pop("stacks")
+    gym_logger.info("Profiling session finished", user_id=current_user.id, **result)
+    if format == "json":
+        return {**result, "stacks": dict(stacks.most_common())}
+    return Response(content=sampling_profiler.collapsed(stacks), media_type="text/plain")
+
 @api_router.post("/cache/clear")
 @api_rate_limit()
 async def clear_cache(
@@ -2396,7 +2855,7 @@ async def authenticate_user(username: str, password: str) -> Optional[User]:
     if not user:
         return None
     
-    if not verify_password(password, user["password_hash"]):
+    if not await verify_password(password, user["password_hash"], user.get("id")):
         return None
     
     return User(**parse_from_mongo(user))
@@ -2771,6 +3230,23 @@ original_create_member = api_router.routes[0]  # Will be properly applied after
 # Include router
 app.include_router(api_router)
 
+# Métricas no formato Prometheus (fora de /api)
+# METRICS_TOKEN: bearer exigido em /metrics. Sem ele o endpoint fica aberto a
+# qualquer cliente fora de produção e fechado (403) com ENVIRONMENT=production
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_OPEN_WITHOUT_TOKEN = os.environ.get("ENVIRONMENT") != "production"
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    if METRICS_TOKEN:
+        provided = request.headers.get("authorization", "").removeprefix("Bearer ")
+        # Bytes: compare_digest recusa str com caracteres não ASCII (TypeError -> 500)
+        if not hmac.compare_digest(provided.encode(errors="replace"), METRICS_TOKEN.encode()):
+            raise HTTPException(status_code=401, detail="Invalid metrics token")
+    elif not METRICS_OPEN_WITHOUT_TOKEN:
+        raise HTTPException(status_code=403, detail="Metrics token not configured")
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -2797,6 +3273,11 @@ async def startup_db():
     await create_admin_user()
     await create_default_activities()
     await update_existing_members_with_numbers()
+    await backfill_workout_counters()
+    try:
+        await ensure_attendance_indexes()
+    except Exception as e:
+        gym_logger.error("Failed to create attendance indexes", error=e)
     await create_default_motivational_notes()
     await create_default_automated_messages()
     
@@ -2809,8 +3290,26 @@ async def startup_db():
     cache_stats = gym_cache.get_stats()
     gym_logger.info("💾 Cache system status", **cache_stats)
     
+    metrics_registry.start_flusher()
+    if not METRICS_TOKEN:
+        gym_logger.warning("METRICS_TOKEN not set: /metrics is "
+                           + ("open to any client" if METRICS_OPEN_WITHOUT_TOKEN else "disabled (production)"))
+    try:
+        await business_metrics.ensure_indexes()
+    except Exception as e:
+        gym_logger.error("Failed to create business_metrics indexes", error=e)
+    business_metrics.start()
+    if os.environ.get("LOOP_WATCHDOG_ENABLED", "true").lower() not in ("0", "false", "no"):
+        loop_watchdog.start()
+    
     gym_logger.info("🎯 KO Gym API Premium started successfully")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    gym_cache.close()
+    password_hasher.shutdown()
+    await loop_watchdog.stop()
+    await business_metrics.stop()
+    metrics_registry.stop_flusher()
     client.close()
+    gym_logger.flush()
@@ -0,0 +1,321 @@
+"""
+KO Gym - Armazenamento partilhado de abuso
+Janelas deslizantes de tentativas falhadas e bloqueios de IP, comuns a todos os workers
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import redis
+from .logger import gym_logger
+from .cache import LocalCacheTier, REDIS_ERRORS, REDIS_SCRIPT_ERRORS, _MISSING
+from .circuit_breaker import CircuitBreaker
+
+# Prefixo próprio: clear_pattern do cache (ko_gym:*) nunca apaga bloqueios
+KEY_PREFIX = "ko_gym_sec"
+
+# ZADD + poda da janela + contagem + bloqueio num único round trip atómico
+_RECORD_FAILURE_LUA = """
+local now = tonumber(ARGV[1])
+local window_ms = tonumber(ARGV[2])
+local max_attempts = tonumber(ARGV[3])
+local block_ms = tonumber(ARGV[4])
+redis.call('ZADD', KEYS[1], now, ARGV[5])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window_ms)
+local count = redis.call('ZCARD', KEYS[1])
+if count >= max_attempts then
+    local attempts = redis.call('ZRANGE', KEYS[1], 0, -1)
+    redis.call('SET', KEYS[2], now, 'PX', block_ms)
+    redis.call('DEL', KEYS[1])
+    return {count, 1, attempts}
+end
+redis.call('PEXPIRE', KEYS[1], window_ms)
+return {count, 0, {}}
+"""
+
+class FailureResult:
+    """Resultado de registar uma tentativa falhada"""
+    __slots__ = ("attempts", "blocked", "endpoints")
+    
+    def __init__(self, attempts: int, blocked: bool, endpoints: Optional[List[str]] = None):
+        self.attempts = attempts
+        self.blocked = blocked
+        self.endpoints = endpoints or []
+
+class _AttemptRing:
+    """Últimas N tentativas de um IP num buffer circular de tamanho fixo
+    
+    Para decidir o bloqueio basta saber se as últimas max_attempts tentativas
+    cabem na janela, por isso a memória por IP não cresce com o número de falhas.
+    """
+    __slots__ = ("timestamps", "endpoints", "head", "size", "last_seen")
+    
+    def __init__(self, capacity: int):
+        self.timestamps = [0.0] * capacity
+        self.endpoints: List[Optional[str]] = [None] * capacity
+        self.head = 0
+        self.size = 0
+        self.last_seen = 0.0
+    
+    def add(self, timestamp: float, endpoint: str):
+        capacity = len(self.timestamps)
+        self.timestamps[self.head] = timestamp
+        self.endpoints[self.head] = endpoint
+        self.head = (self.head + 1) % capacity
+        if self.size < capacity:
+            self.size += 1
+        self.last_seen = timestamp
+    
+    def count_since(self, cutoff: float) -> int:
+        """Tentativas com timestamp > cutoff (das mais recentes para trás)"""
+        capacity = len(self.timestamps)
+        count = 0
+        for i in range(1, self.size + 1):
+            if self.timestamps[(self.head - i) % capacity] <= cutoff:
+                break
+            count += 1
+        return count
+    
+    def recent_endpoints(self, n: int) -> List[str]:
+        capacity = len(self.timestamps)
+        return [self.endpoints[(self.head - i) % capacity] for i in range(n, 0, -1)]
+
+class LocalAbuseStore:
+    """Stand-in em processo (sem Redis ou com o circuito aberto)
+    
+    Memória limitada: no máximo `max_tracked_ips` IPs (LRU) com um ring buffer
+    cada, e uma thread de compactação remove IPs fora da janela e bloqueios expirados.
+    """
+    
+    def __init__(self, max_tracked_ips: int = 50000, compact_interval: float = 60.0):
+        self.max_tracked_ips = max_tracked_ips
+        self.compact_interval = compact_interval
+        self._attempts: "OrderedDict[str, _AttemptRing]" = OrderedDict()
+        self._blocked_until: "OrderedDict[str, float]" = OrderedDict()
+        self._window_seconds = 86400.0
+        self._lock = threading.Lock()
+        self.stats_counters = {"evicted": 0, "compacted": 0, "compactions": 0}
+        self._compactor: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+    
+    def record_failure(self, ip: str, endpoint: str, window_seconds: float,
+                       max_attempts: int, block_seconds: float) -> FailureResult:
+        now = time.time()
+        self._ensure_compactor()
+        with self._lock:
+            self._window_seconds = window_seconds
+            ring = self._attempts.get(ip)
+            if ring is None or len(ring.timestamps) != max_attempts:
+                ring = _AttemptRing(max_attempts)
+                self._attempts[ip] = ring
+                while len(self._attempts) > self.max_tracked_ips:
+                    self._attempts.popitem(last=False)
+                    self.stats_counters["evicted"] += 1
+            else:
+                self._attempts.move_to_end(ip)
+            ring.add(now, endpoint)
+            
+            count = ring.count_since(now - window_seconds)
+            if count >= max_attempts:
+                self._blocked_until[ip] = now + block_seconds
+                self._blocked_until.move_to_end(ip)
+                while len(self._blocked_until) > self.max_tracked_ips:
+                    self._blocked_until.popitem(last=False)
+                endpoints = ring.recent_endpoints(count)
+                del self._attempts[ip]
+                return FailureResult(count, True, endpoints)
+            return FailureResult(count, False)
+    
+    def blocked_for(self, ip: str) -> float:
+        """Segundos de bloqueio restantes (0 se não bloqueado)"""
+        until = self._blocked_until.get(ip)
+        if until is None:
+            return 0.0
+        remaining = until - time.time()
+        if remaining <= 0:
+            with self._lock:
+                self._blocked_until.pop(ip, None)
+            return 0.0
+        return remaining
+    
+    def clear_failures(self, ip: str):
+        with self._lock:
+            self._attempts.pop(ip, None)
+    
+    def compact(self) -> int:
+        """Remove IPs sem tentativas na janela e bloqueios expirados"""
+        now = time.time()
+        cutoff = now - self._window_seconds
+        with self._lock:
+            stale = [ip for ip, ring in self._attempts.items() if ring.last_seen <= cutoff]
+            for ip in stale:
+                del self._attempts[ip]
+            expired = [ip for ip, until in self._blocked_until.items() if until <= now]
+            for ip in expired:
+                del self._blocked_until[ip]
+            self.stats_counters["compacted"] += len(stale) + len(expired)
+            self.stats_counters["compactions"] += 1
+        return len(stale) + len(expired)
+    
+    def _ensure_compactor(self):
+        if self._compactor is not None or self.compact_interval <= 0:
+            return
+        with self._lock:
+            if self._compactor is not None:
+                return
+            self._compactor = threading.Thread(
+                target=self._compact_loop, name="abuse-store-compactor", daemon=True
+            )
+            self._compactor.start()
+    
+    def _compact_loop(self):
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                gym_logger.error("Abuse store compaction failed", error=e)
+    
+    def close(self):
+        self._stop.set()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "tracked_ips": len(self._attempts),
+            "blocked_ips": len(self._blocked_until),
+            "max_tracked_ips": self.max_tracked_ips,
+            **self.stats_counters
+        }
+
+class RedisAbuseStore:
+    """Janelas deslizantes em sorted sets do Redis, partilhadas entre workers
+    
+    is_blocked custa um PTTL ou um hit no L1; bloqueios conhecidos ficam no L1 até
+    expirarem e "não bloqueado" fica em cache só `negative_ttl` segundos.
+    """
+    
+    def __init__(self, client: "redis.Redis", fallback: Optional[LocalAbuseStore] = None,
+                 negative_ttl: float = 1.0, max_l1_items: int = 10000):
+        self.client = client
+        self.fallback = fallback or LocalAbuseStore()
+        self.negative_ttl = negative_ttl
+        # TTL explícito por entrada: bloqueio restante ou negative_ttl
+        self.l1 = LocalCacheTier(max_items=max_l1_items, ttl_seconds=86400)
+        self.breaker = CircuitBreaker(
+            "redis_abuse_store",
+            failure_threshold=int(os.getenv("CACHE_BREAKER_FAILURE_THRESHOLD", "3")),
+            reset_timeout=float(os.getenv("CACHE_BREAKER_RESET_SECONDS", "10"))
+        )
+        self._record_script = client.register_script(_RECORD_FAILURE_LUA)
+    
+    @staticmethod
+    def _attempts_key(ip: str) -> str:
+        return f"{KEY_PREFIX}:attempts:{ip}"
+    
+    @staticmethod
+    def _block_key(ip: str) -> str:
+        return f"{KEY_PREFIX}:block:{ip}"
+    
+    def _failed(self, error: Exception):
+        self.breaker.record_failure(error)
+        gym_logger.warning("Redis abuse store unavailable, using local store", error=error)
+    
+    def record_failure(self, ip: str, endpoint: str, window_seconds: float,
+                       max_attempts: int, block_seconds: float) -> FailureResult:
+        if self.breaker.allow_request():
+            try:
+                now_ms = int(time.time() * 1000)
+                count, blocked, attempts = self._record_script(
+                    keys=[self._attempts_key(ip), self._block_key(ip)],
+                    args=[
+                        now_ms, int(window_seconds * 1000), max_attempts,
+                        int(block_seconds * 1000), f"{now_ms}:{uuid.uuid4().hex[:8]}:{endpoint}"
+                    ]
+                )
+                self.breaker.record_success()
+                if blocked:
+                    self.l1.set(ip, time.time() + block_seconds, block_seconds)
+                    endpoints = [
+                        (a.decode() if isinstance(a, bytes) else a).split(":", 2)[2] for a in attempts
+                    ]
+                    return FailureResult(int(count), True, endpoints)
+                return FailureResult(int(count), False)
+            except REDIS_SCRIPT_ERRORS as e:
+                self._failed(e)
+        
+        result = self.fallback.record_failure(ip, endpoint, window_seconds, max_attempts, block_seconds)
+        if result.blocked:
+            self.l1.set(ip, time.time() + block_seconds, block_seconds)
+        return result
+    
+    def blocked_for(self, ip: str) -> float:
+        """Segundos de bloqueio restantes (0 se não bloqueado)"""
+        cached = self.l1.get(ip)
+        if cached is False:
+            return 0.0
+        if cached is not _MISSING:
+            return max(cached - time.time(), 0.0)
+        
+        if self.breaker.allow_request():
+            try:
+                pttl = self.client.pttl(self._block_key(ip))
+                self.breaker.record_success()
+                if pttl and pttl > 0:
+                    remaining = pttl / 1000.0
+                    self.l1.set(ip, time.time() + remaining, remaining)
+                    return remaining
+                self.l1.set(ip, False, self.negative_ttl)
+                return 0.0
+            except REDIS_ERRORS as e:
+                self._failed(e)
+        
+        return self.fallback.blocked_for(ip)
+    
+    def clear_failures(self, ip: str):
+        self.fallback.clear_failures(ip)
+        if self.breaker.allow_request():
+            try:
+                self.client.delete(self._attempts_key(ip))
+                self.breaker.record_success()
+            except REDIS_ERRORS as e:
+                self._failed(e)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "redis",
+            "l1_entries": len(self.l1),
+            "circuit_breaker": self.breaker.snapshot(),
+            "local_fallback": self.fallback.stats()
+        }
+
+def create_abuse_store():
+    """Redis partilhado quando configurado, senão stand-in local"""
+    redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    local_store = LocalAbuseStore(
+        max_tracked_ips=int(os.getenv("ABUSE_MAX_TRACKED_IPS", "50000")),
+        compact_interval=float(os.getenv("ABUSE_COMPACT_INTERVAL_SECONDS", "60"))
+    )
+    try:
+        client = redis.from_url(
+            redis_url,
+            socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5")),
+            socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+        )
+        store = RedisAbuseStore(
+            client,
+            fallback=local_store,
+            negative_ttl=float(os.getenv("ABUSE_L1_NEGATIVE_TTL_SECONDS", "1"))
+        )
+    except Exception as e:
+        gym_logger.warning("Redis abuse store not configured, using local store", error=e)
+        return local_store
+    
+    try:
+        client.ping()
+    except REDIS_ERRORS as e:
+        # Workers continuam a funcionar; o breaker volta a tentar o Redis mais tarde
+        store.breaker.force_open(e)
+        gym_logger.warning("Redis not available for abuse tracking, using local store", error=e)
+    return store
@@ -0,0 +1,76 @@
+"""
+KO Gym - Registo em memória das atividades ativas
+Validação de check-ins sem ir à base de dados (a coleção activities é pequena)
+"""
+import asyncio
+import os
+import time
+from typing import Any, Dict, Iterable, Optional
+
+class ActivityRegistry:
+    """Mapa id -> atividade ativa, recarregado por inteiro
+    
+    - recarrega ao fim de ttl_seconds (alterações feitas noutros workers)
+    - invalidate() após criar/editar/desativar neste worker força o reload
+    - um id desconhecido provoca no máximo um reload a cada miss_reload_seconds
+      (atividade acabada de criar noutro worker) sem abrir a porta a scans por pedido
+    """
+    
+    def __init__(self, ttl_seconds: float = 60.0, miss_reload_seconds: float = 5.0):
+        self.ttl_seconds = ttl_seconds
+        self.miss_reload_seconds = miss_reload_seconds
+        self.collection = None
+        self._activities: Dict[str, Dict[str, Any]] = {}
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self.stats = {"reloads": 0, "hits": 0, "misses": 0}
+    
+    def attach(self, db):
+        self.collection = db.activities
+    
+    def invalidate(self):
+        self._loaded_at = 0.0
+    
+    async def reload(self, max_age: float = 0.0):
+        """Recarrega, salvo se outro pedido o fez há menos de max_age (reloads concorrentes)"""
+        async with self._lock:
+            if self._loaded_at and time.monotonic() - self._loaded_at < max_age:
+                return
+            docs = await self.collection.find({"is_active": True}, {"_id": 0}).to_list(None)
+            self._activities = {doc["id"]: doc for doc in docs}
+            self._loaded_at = time.monotonic()
+            self.stats["reloads"] += 1
+    
+    async def get_active(self, activity_id: str) -> Optional[Dict[str, Any]]:
+        return (await self.get_active_many((activity_id,))).get(activity_id)
+    
+    async def get_active_many(self, activity_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Atividades ativas de um lote (ids distintos): no máximo um reload por TTL
+        e um pelos ids desconhecidos, como get_active"""
+        ids = set(activity_ids)
+        age = time.monotonic() - self._loaded_at
+        if age >= self.ttl_seconds:
+            await self.reload(max_age=self.ttl_seconds)
+            age = 0.0
+        
+        found = {activity_id: self._activities[activity_id] for activity_id in ids if activity_id in self._activities}
+        if len(found) < len(ids) and age >= self.miss_reload_seconds:
+            await self.reload(max_age=self.miss_reload_seconds)
+            found = {activity_id: self._activities[activity_id] for activity_id in ids if activity_id in self._activities}
+        
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(ids) - len(found)
+        return found
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "active_activities": len(self._activities),
+            "age_seconds": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None,
+            "ttl_seconds": self.ttl_seconds,
+            **self.stats
+        }
+
+activity_registry = ActivityRegistry(
+    ttl_seconds=float(os.getenv("ACTIVITY_REGISTRY_TTL_SECONDS", "60")),
+    miss_reload_seconds=float(os.getenv("ACTIVITY_REGISTRY_MISS_RELOAD_SECONDS", "5"))
+)
@@ -8,6 +8,7 @@ from dataclasses import dataclass
 import asyncio
 from .logger import gym_logger
 from .cache import gym_cache, BusinessCache
+from .metrics import timed
 
 def serialize_mongo_data(data):
     """Convert MongoDB ObjectIds and dates to strings for JSON serialization"""
@@ -65,6 +66,7 @@ class AnalyticsEngine:
     def __init__(self, db):
         self.db = db
         
+    @timed
     async def get_dashboard_analytics(self, user_role: str = "admin") -> Dict[str, Any]:
         """Analytics completas para o dashboard"""
         
@@ -105,6 +107,7 @@ class AnalyticsEngine:
         
         return analytics
     
+    @timed
     async def _get_member_metrics(self) -> Dict[str, Any]:
         """Métricas de membros"""
         now = datetime.now(timezone.utc)
@@ -144,6 +147,7 @@ class AnalyticsEngine:
             "membership_breakdown": {item["_id"]: item["count"] for item in membership_breakdown}
         })
     
+    @timed
     async def _get_attendance_metrics(self) -> Dict[str, Any]:
         """Métricas de frequência"""
         now = datetime.now(timezone.utc)
@@ -207,6 +211,7 @@ class AnalyticsEngine:
             "capacity_utilization": min(round((avg_daily / 100) * 100, 1), 100)  # Assumindo capacidade de 100
         })
     
+    @timed
     async def _get_financial_metrics(self) -> Dict[str, Any]:
         """Métricas financeiras completas (admin only)"""
         now = datetime.now(timezone.utc)
@@ -275,6 +280,7 @@ class AnalyticsEngine:
                              for item in payment_methods}
         })
     
+    @timed
     async def _get_basic_financial_metrics(self) -> Dict[str, Any]:
         """Métricas financeiras básicas (staff)"""
         now = datetime.now(timezone.utc)
@@ -298,6 +304,7 @@ class AnalyticsEngine:
             "access_level": "limited"
         })
     
+    @timed
     async def _get_activity_metrics(self) -> Dict[str, Any]:
         """Métricas de atividades/modalidades"""
         now = datetime.now(timezone.utc)
@@ -346,6 +353,7 @@ class AnalyticsEngine:
             }
         })
     
+    @timed
     async def _get_growth_metrics(self) -> Dict[str, Any]:
         """Métricas de crescimento e tendências"""
         now = datetime.now(timezone.utc)
@@ -376,6 +384,7 @@ class AnalyticsEngine:
             "trend": "growing" if monthly_growth[-1]["new_members"] > monthly_growth[-2]["new_members"] else "stable"
         })
     
+    @timed
     async def get_member_analytics(self, member_id: str) -> MemberAnalytics:
         """Analytics detalhadas de um membro específico"""
         
@@ -487,6 +496,7 @@ class AnalyticsEngine:
         
         return analytics
     
+    @timed
     def _calculate_streaks(self, workouts: List[Dict]) -> Tuple[int, int]:
         """Calcula streak atual e maior streak"""
         if not workouts:
@@ -528,6 +538,7 @@ class AnalyticsEngine:
         
         return current_streak, longest_streak
     
+    @timed
     async def get_churn_prediction(self) -> Dict[str, Any]:
         """Análise de previsão de churn"""
         # Membros em risco (sem check-in há mais de 14 dias)
@@ -0,0 +1,190 @@
+"""
+KO Gym - Métricas de negócio agregadas
+Soma por (nome, labels, minuto) em memória e grava em bulk ($inc upserts) na coleção business_metrics
+"""
+import asyncio
+import os
+import threading
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo import UpdateOne, ASCENDING
+from .logger import gym_logger
+
+COLLECTION = "business_metrics"
+
+# Só estes kwargs viram labels (baixa cardinalidade); ids, datas e textos livres ficam no log
+DEFAULT_LABELS = "user_role,membership_type,report_type,trigger,discount_applied,method"
+
+_INTERVAL_FORMATS = {
+    "minute": "%Y-%m-%dT%H:%M:00Z",
+    "hour": "%Y-%m-%dT%H:00:00Z",
+    "day": "%Y-%m-%d",
+}
+
+BufferKey = Tuple[str, Tuple[Tuple[str, str], ...], datetime]
+
+class BusinessMetricsAggregator:
+    """Buffer de incrementos com flush periódico
+    
+    - record() é O(1) e thread-safe: soma count, value e os kwargs numéricos (ex.: amount)
+    - flush() troca o buffer e grava um UpdateOne(upsert, $inc) por (nome, labels, minuto)
+      num único bulk_write não ordenado
+    - se o flush falhar, os incrementos voltam ao buffer (até max_pending chaves)
+    """
+    
+    def __init__(self, label_keys: Tuple[str, ...], flush_interval: float = 5.0, max_pending: int = 100000):
+        self.label_keys = frozenset(label_keys)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.collection = None
+        self._buffer: Dict[BufferKey, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"recorded": 0, "flushes": 0, "upserts": 0, "flush_errors": 0, "dropped": 0}
+    
+    def attach(self, db):
+        self.collection = db[COLLECTION]
+    
+    async def ensure_indexes(self):
+        await self.collection.create_index([("key", ASCENDING), ("minute", ASCENDING)], unique=True)
+        await self.collection.create_index([("name", ASCENDING), ("minute", ASCENDING)])
+    
+    @staticmethod
+    def _key_string(name: str, labels: Tuple[Tuple[str, str], ...]) -> str:
+        return name + "|" + ",".join(f"{k}={v}" for k, v in labels)
+    
+    def record(self, name: str, value: Any = 1, at: Optional[datetime] = None, **kwargs):
+        """at: hora do evento (ex.: check-ins sincronizados mais tarde); por omissão, agora"""
+        if value is True or value is None:
+            value = 1
+        elif not isinstance(value, (int, float)) or isinstance(value, bool):
+            value = 0
+        
+        labels = tuple(sorted(
+            (k, str(v.value if isinstance(v, Enum) else v))
+            for k, v in kwargs.items() if k in self.label_keys and v is not None
+        ))
+        sums = {k: v for k, v in kwargs.items()
+                if k not in self.label_keys and isinstance(v, (int, float)) and not isinstance(v, bool)}
+        minute = (at or datetime.now(timezone.utc)).astimezone(timezone.utc).replace(second=0, microsecond=0)
+        key = (name, labels, minute)
+        
+        with self._lock:
+            entry = self._buffer.get(key)
+            if entry is None:
+                if len(self._buffer) >= self.max_pending:
+                    self.stats["dropped"] += 1
+                    return
+                entry = self._buffer[key] = {"count": 0, "value": 0, "sums": {}}
+            entry["count"] += 1
+            entry["value"] += value
+            for field, amount in sums.items():
+                entry["sums"][field] = entry["sums"].get(field, 0) + amount
+            self.stats["recorded"] += 1
+    
+    def _restore(self, pending: Dict[BufferKey, Dict[str, Any]]):
+        with self._lock:
+            for key, entry in pending.items():
+                current = self._buffer.get(key)
+                if current is None:
+                    if len(self._buffer) >= self.max_pending:
+                        self.stats["dropped"] += 1
+                        continue
+                    self._buffer[key] = entry
+                    continue
+                current["count"] += entry["count"]
+                current["value"] += entry["value"]
+                for field, amount in entry["sums"].items():
+                    current["sums"][field] = current["sums"].get(field, 0) + amount
+    
+    async def flush(self) -> int:
+        if self.collection is None:
+            return 0
+        with self._lock:
+            pending, self._buffer = self._buffer, {}
+        if not pending:
+            return 0
+        
+        operations = []
+        for (name, labels, minute), entry in pending.items():
+            increments = {"count": entry["count"], "value": entry["value"]}
+            increments.update({f"sums.{field}": amount for field, amount in entry["sums"].items()})
+            operations.append(UpdateOne(
+                {"key": self._key_string(name, labels), "minute": minute},
+                {"$inc": increments, "$setOnInsert": {"name": name, "labels": dict(labels)}},
+                upsert=True
+            ))
+        
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            self.stats["flush_errors"] += 1
+            self._restore(pending)
+            gym_logger.error("Business metrics flush failed", error=e, pending=len(pending))
+            return 0
+        
+        self.stats["flushes"] += 1
+        self.stats["upserts"] += len(operations)
+        return len(operations)
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def series(self, name: str, start: datetime, end: datetime, interval: str = "hour",
+                     group_by: Optional[str] = None, sum_field: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Série temporal de uma métrica por minuto/hora/dia, opcionalmente por label
+        e com a soma de um kwarg numérico (ex.: amount)"""
+        await self.flush()
+        group_id: Dict[str, Any] = {
+            "bucket": {"$dateToString": {"format": _INTERVAL_FORMATS[interval], "date": "$minute"}}
+        }
+        if group_by:
+            group_id["label"] = f"$labels.{group_by}"
+        
+        group = {"_id": group_id, "count": {"$sum": "$count"}, "value": {"$sum": "$value"}}
+        if sum_field:
+            group["sum"] = {"$sum": f"$sums.{sum_field}"}
+        
+        pipeline = [
+            {"$match": {"name": name, "minute": {"$gte": start, "$lt": end}}},
+            {"$group": group},
+            {"$sort": {"_id.bucket": 1}}
+        ]
+        points = []
+        async for row in self.collection.aggregate(pipeline):
+            point = {"bucket": row["_id"]["bucket"], "count": row["count"], "value": row["value"]}
+            if sum_field:
+                point[sum_field] = row.get("sum", 0)
+            if group_by:
+                point[group_by] = row["_id"].get("label")
+            points.append(point)
+        return points
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {"pending": len(self._buffer), "flush_interval_seconds": self.flush_interval, **self.stats}
+
+business_metrics = BusinessMetricsAggregator(
+    label_keys=tuple(k.strip() for k in os.getenv("BUSINESS_METRIC_LABELS", DEFAULT_LABELS).split(",") if k.strip()),
+    flush_interval=float(os.getenv("BUSINESS_METRICS_FLUSH_SECONDS", "5")),
+    max_pending=int(os.getenv("BUSINESS_METRICS_MAX_PENDING", "100000"))
+)
+
+# Cada gym_logger.business_metric passa também pelo agregador
+gym_logger.add_business_metric_listener(business_metrics.record)
@@ -3,14 +3,186 @@ KO Gym - Sistema de Cache Premium
 Cache inteligente para performance otimizada
 """
 import redis
+import asyncio
+import bisect
+import copy
+import inspect
 import json
 import pickle
-from datetime import datetime, timedelta, timezone
-from typing import Any, Optional, Dict, Union
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, date, timedelta, timezone
+from enum import Enum
+from typing import Any, Awaitable, Callable, Optional, Dict, Iterable, List, Union, Tuple
 from functools import wraps
 import hashlib
 import os
+from starlette.requests import HTTPConnection
 from .logger import gym_logger
+from .circuit_breaker import CircuitBreaker
+
+# Erros de ligação/timeout do Redis que contam para o circuit breaker
+REDIS_ERRORS = (redis.ConnectionError, redis.TimeoutError, OSError)
+
+# Scripts Lua: um erro de resposta (ResponseError, NoScriptError) também é falha
+# do backend; deixá-lo escapar deixaria a sonda half-open por resolver
+REDIS_SCRIPT_ERRORS = REDIS_ERRORS + (redis.RedisError,)
+
+# Sentinela para distinguir "não existe" de um valor None guardado
+_MISSING = object()
+
+# Marcador guardado no cache para resultados None (negative caching)
+_NEGATIVE_MARKER = "__ko_gym:none__"
+
+# SADD + EXPIRE só se o novo TTL for maior (compatível com Redis < 7)
+_TAG_LUA = """
+redis.call('SADD', KEYS[1], ARGV[1])
+local ttl = tonumber(ARGV[2])
+if redis.call('TTL', KEYS[1]) < ttl then
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+return 1
+"""
+
+class LocalCacheTier:
+    """Cache L1 em memória do processo (LRU limitado com TTL curto)
+    
+    O GymCache guarda aqui os bytes serializados, não o objeto: cada hit
+    devolve uma cópia nova e quem a alterar não corrompe a entrada.
+    """
+    
+    def __init__(self, max_items: int = 2048, ttl_seconds: float = 5.0):
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Any:
+        """Devolve o valor ou _MISSING se ausente/expirado"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None):
+        """Guarda valor com TTL limitado ao TTL do L1"""
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+    
+    def invalidate(self, key: str) -> bool:
+        with self._lock:
+            return self._data.pop(key, None) is not None
+    
+    def invalidate_pattern(self, pattern: str) -> int:
+        """Remove chaves que contêm o padrão (mesma semântica do fallback em memória)"""
+        with self._lock:
+            keys = [k for k in self._data if pattern in k]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+class CacheMetrics:
+    """Contadores e histogramas de latência por namespace (prefixo da chave)"""
+    
+    # Limites dos buckets de latência em ms (último bucket = +inf)
+    LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+    
+    def __init__(self, history_minutes: int = 60):
+        self.namespaces: Dict[str, Dict[str, Any]] = {}
+        # Hit ratio por minuto para afinar TTLs com dados
+        self.history: "deque[Dict[str, Any]]" = deque(maxlen=history_minutes)
+        self._current_minute = int(time.time() // 60)
+        self._window: Dict[str, list] = {}
+    
+    @staticmethod
+    def namespace_of(key: str) -> str:
+        return key.split(":", 1)[0] if ":" in key else key
+    
+    def _bucket(self, namespace: str) -> Dict[str, Any]:
+        stats = self.namespaces.get(namespace)
+        if stats is None:
+            stats = self.namespaces[namespace] = {
+                "hits": 0, "misses": 0, "sets": 0, "deletes": 0,
+                "latency_ms": {op: [0] * (len(self.LATENCY_BUCKETS_MS) + 1) for op in ("get", "set", "delete")},
+                "latency_sum_ms": {"get": 0.0, "set": 0.0, "delete": 0.0}
+            }
+        return stats
+    
+    def _rotate(self):
+        minute = int(time.time() // 60)
+        if minute != self._current_minute:
+            if self._window:
+                self.history.append({
+                    "minute": datetime.fromtimestamp(self._current_minute * 60, timezone.utc).isoformat(),
+                    "namespaces": {
+                        ns: {"hits": h, "misses": m, "hit_ratio": round(h / (h + m), 4) if h + m else 0.0}
+                        for ns, (h, m) in self._window.items()
+                    }
+                })
+            self._window = {}
+            self._current_minute = minute
+    
+    def record(self, op: str, key: str, started_ns: int, hits: int = 0, misses: int = 0, count: int = 1):
+        """Regista uma operação; custo = perf_counter_ns + alguns incrementos"""
+        elapsed_ms = (time.perf_counter_ns() - started_ns) / 1_000_000
+        namespace = self.namespace_of(key)
+        stats = self._bucket(namespace)
+        
+        stats["latency_ms"][op][bisect.bisect_left(self.LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        stats["latency_sum_ms"][op] += elapsed_ms
+        if op == "get":
+            stats["hits"] += hits
+            stats["misses"] += misses
+            self._rotate()
+            window = self._window.setdefault(namespace, [0, 0])
+            window[0] += hits
+            window[1] += misses
+        elif op == "set":
+            stats["sets"] += count
+        else:
+            stats["deletes"] += count
+    
+    def snapshot(self) -> Dict[str, Any]:
+        self._rotate()
+        bounds = [str(b) for b in self.LATENCY_BUCKETS_MS] + ["+Inf"]
+        namespaces = {}
+        for namespace, stats in self.namespaces.items():
+            lookups = stats["hits"] + stats["misses"]
+            gets = sum(stats["latency_ms"]["get"])
+            namespaces[namespace] = {
+                "hits": stats["hits"],
+                "misses": stats["misses"],
+                "hit_ratio": round(stats["hits"] / lookups, 4) if lookups else 0.0,
+                "sets": stats["sets"],
+                "deletes": stats["deletes"],
+                "avg_get_ms": round(stats["latency_sum_ms"]["get"] / gets, 3) if gets else 0.0,
+                "latency_histogram_ms": {
+                    op: dict(zip(bounds, counts))
+                    for op, counts in stats["latency_ms"].items() if any(counts)
+                }
+            }
+        return {"namespaces": namespaces, "hit_ratio_history": list(self.history)}
 
 class GymCache:
     """Sistema de cache premium para o KO Gym"""
@@ -19,19 +191,190 @@ class GymCache:
         # Configuração Redis (local para desenvolvimento)
         redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
         
+        # L1 por processo à frente do Redis (L2)
+        self.l1 = LocalCacheTier(
+            max_items=int(os.getenv("CACHE_L1_MAX_ITEMS", "2048")),
+            ttl_seconds=float(os.getenv("CACHE_L1_TTL_SECONDS", "5"))
+        )
+        self.invalidation_channel = os.getenv("CACHE_INVALIDATION_CHANNEL", "ko_gym:cache:invalidate")
+        self.instance_id = uuid.uuid4().hex
+        self._pubsub = None
+        self._pubsub_thread = None
+        self._listener_retry_at = 0.0
+        self.tier_stats = {
+            "l1_hits": 0, "l1_misses": 0,
+            "l2_hits": 0, "l2_misses": 0,
+            "invalidations_published": 0, "invalidations_received": 0
+        }
+        self.metrics = CacheMetrics()
+        self.memory_cache = {}
+        self.cache_timestamps = {}
+        self.memory_tags = {}
+        
+        # Circuit breaker: com Redis em baixo usamos o tier em memória sem esperar timeouts
+        self.breaker = CircuitBreaker(
+            "redis_cache",
+            failure_threshold=int(os.getenv("CACHE_BREAKER_FAILURE_THRESHOLD", "3")),
+            reset_timeout=float(os.getenv("CACHE_BREAKER_RESET_SECONDS", "10")),
+            on_close=self._on_redis_recovered
+        )
+        # Invalidações feitas com o circuito aberto, reaplicadas no Redis ao recuperar
+        self._pending_invalidations: "deque[Tuple[str, str]]" = deque(maxlen=1000)
+        self._pending_overflow = False
+        self._redis_configured = False
+        
+        try:
+            self.redis_client = redis.from_url(
+                redis_url,
+                decode_responses=False,
+                socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5")),
+                socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+            )
+            self._tag_script = self.redis_client.register_script(_TAG_LUA)
+            self._redis_configured = True
+        except Exception as e:
+            # URL inválido: só o tier em memória
+            gym_logger.warning("Redis not configured, using memory cache fallback", error=e)
+            return
+        
         try:
-            self.redis_client = redis.from_url(redis_url, decode_responses=False)
             # Testar conexão
             self.redis_client.ping()
-            self.available = True
             gym_logger.info("Redis cache initialized successfully")
-        except Exception as e:
-            # Fallback para cache em memória se Redis não disponível
-            self.memory_cache = {}
-            self.cache_timestamps = {}
-            self.available = False
+            self._start_invalidation_listener()
+        except REDIS_ERRORS as e:
+            # Fallback para cache em memória; o breaker volta a tentar em half-open
+            self.breaker.force_open(e)
             gym_logger.warning("Redis not available, using memory cache fallback", error=e)
     
+    @property
+    def available(self) -> bool:
+        """Redis em uso neste momento (configurado e com o circuito não aberto)"""
+        return self._redis_configured and self.breaker.state != CircuitBreaker.OPEN
+    
+    def _use_redis(self) -> bool:
+        """Decide se a operação vai ao Redis; em half-open faz uma sonda PING"""
+        if not self._redis_configured:
+            return False
+        if self.breaker.state == CircuitBreaker.CLOSED:
+            if self._pubsub_thread is None and time.monotonic() >= self._listener_retry_at:
+                self._start_invalidation_listener()
+            return True
+        if not self.breaker.allow_request():
+            return False
+        try:
+            self.redis_client.ping()
+        except REDIS_ERRORS as e:
+            self.breaker.record_failure(e)
+            return False
+        self.breaker.record_success()
+        return True
+    
+    def _redis_failed(self, error: Exception):
+        """Regista falha do Redis; a operação continua no tier em memória"""
+        self.breaker.record_failure(error)
+        gym_logger.warning("Redis cache operation failed, using memory tier", error=error)
+    
+    def _remember_invalidation(self, kind: str, value: str):
+        """Guarda invalidações feitas sem Redis para não servir dados antigos ao recuperar"""
+        if not self._redis_configured:
+            return
+        if len(self._pending_invalidations) == self._pending_invalidations.maxlen:
+            self._pending_overflow = True
+        self._pending_invalidations.append((kind, value))
+    
+    def _on_redis_recovered(self):
+        """Circuito fechado: descartar dados locais e reaplicar invalidações pendentes"""
+        self.l1.clear()
+        self.memory_cache.clear()
+        self.cache_timestamps.clear()
+        self.memory_tags.clear()
+        
+        pending = list(self._pending_invalidations)
+        overflow = self._pending_overflow
+        self._pending_invalidations.clear()
+        self._pending_overflow = False
+        
+        if overflow:
+            self.clear_pattern("")
+        else:
+            keys = [value for kind, value in pending if kind == "key"]
+            if keys:
+                self.delete_many(keys)
+            for kind, value in pending:
+                if kind == "pattern":
+                    self.clear_pattern(value)
+                elif kind == "tag":
+                    self.invalidate_tags(value)
+        
+        # Os outros workers também podem ter L1 desatualizado
+        try:
+            self.redis_client.publish(self.invalidation_channel, self._invalidation_message("flush"))
+        except REDIS_ERRORS:
+            pass
+        gym_logger.info("Redis cache recovered", replayed_invalidations=len(pending), overflow=overflow)
+    
+    def _start_invalidation_listener(self):
+        """Subscreve o canal de invalidação para limpar o L1 de todos os workers"""
+        self._listener_retry_at = time.monotonic() + self.breaker.reset_timeout
+        try:
+            self._pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{self.invalidation_channel: self._handle_invalidation})
+            self._pubsub_thread = self._pubsub.run_in_thread(
+                sleep_time=1.0, daemon=True, exception_handler=self._handle_listener_error
+            )
+        except Exception as e:
+            # Sem pub/sub o L1 continua limitado pelo seu TTL curto
+            self._pubsub = None
+            self._pubsub_thread = None
+            gym_logger.warning("Cache invalidation listener unavailable", error=e)
+    
+    def _handle_listener_error(self, error: Exception, pubsub, thread):
+        """Listener perdeu a ligação: parar, limpar L1 e deixar o breaker decidir"""
+        thread.stop()
+        try:
+            pubsub.close()
+        except Exception:
+            pass
+        if self._pubsub_thread is thread:
+            self._pubsub_thread = None
+        self.l1.clear()
+        self.breaker.record_failure(error)
+        gym_logger.warning("Cache invalidation listener lost connection", error=error)
+    
+    def _handle_invalidation(self, message: Dict[str, Any]):
+        """Aplica uma invalidação recebida de outro worker"""
+        try:
+            payload = json.loads(message["data"])
+        except Exception:
+            return
+        if payload.get("origin") == self.instance_id:
+            return
+        
+        self.tier_stats["invalidations_received"] += 1
+        op = payload.get("op")
+        if op == "key":
+            for key in payload.get("keys", []):
+                self.l1.invalidate(key)
+        elif op == "pattern":
+            self.l1.invalidate_pattern(payload.get("pattern", ""))
+        else:
+            self.l1.clear()
+    
+    def _invalidation_message(self, op: str, **fields) -> bytes:
+        self.tier_stats["invalidations_published"] += 1
+        return json.dumps({"origin": self.instance_id, "op": op, **fields}).encode()
+    
+    def close(self):
+        """Encerra o listener de invalidação (shutdown)"""
+        if self._pubsub_thread is not None:
+            try:
+                self._pubsub_thread.stop()
+                self._pubsub.close()
+            except Exception:
+                pass
+            self._pubsub_thread = None
+    
     def _generate_key(self, key: str, prefix: str = "ko_gym") -> str:
         """Gera chave única para o cache"""
         return f"{prefix}:{key}"
@@ -63,179 +406,669 @@ class GymCache:
         
         return None
     
+    def get(self, key: str) -> Any:
+        """Recupera valor do cache"""
+        started = time.perf_counter_ns()
+        value = self._get(key)
+        hit = value is not None
+        self.metrics.record("get", key, started, hits=int(hit), misses=int(not hit))
+        return value
+    
     def set(self, key: str, value: Any, ttl_seconds: int = 3600) -> bool:
+        """Armazena valor no cache"""
+        started = time.perf_counter_ns()
+        result = self._set(key, value, ttl_seconds)
+        self.metrics.record("set", key, started)
+        return result
+    
+    def delete(self, key: str) -> bool:
+        """Remove valor do cache"""
+        started = time.perf_counter_ns()
+        result = self._delete(key)
+        self.metrics.record("delete", key, started)
+        return result
+    
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Recupera várias chaves num só round trip (MGET); devolve só os hits"""
+        keys = list(dict.fromkeys(keys))
+        started = time.perf_counter_ns()
+        found = self._get_many(keys)
+        for namespace, ns_keys in self._group_by_namespace(keys).items():
+            hits = sum(1 for k in ns_keys if k in found)
+            self.metrics.record("get", namespace, started, hits=hits, misses=len(ns_keys) - hits)
+        return found
+    
+    def set_many(self, mapping: Dict[str, Any], ttl_seconds: int = 3600) -> bool:
+        """Armazena várias chaves num só pipeline"""
+        started = time.perf_counter_ns()
+        result = self._set_many(mapping, ttl_seconds)
+        for namespace, ns_keys in self._group_by_namespace(mapping).items():
+            self.metrics.record("set", namespace, started, count=len(ns_keys))
+        return result
+    
+    def delete_many(self, keys: Iterable[str]) -> int:
+        """Remove várias chaves num só round trip"""
+        keys = list(dict.fromkeys(keys))
+        started = time.perf_counter_ns()
+        deleted = self._delete_many(keys)
+        for namespace, ns_keys in self._group_by_namespace(keys).items():
+            self.metrics.record("delete", namespace, started, count=len(ns_keys))
+        return deleted
+    
+    @staticmethod
+    def _group_by_namespace(keys: Iterable[str]) -> Dict[str, List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for key in keys:
+            groups.setdefault(CacheMetrics.namespace_of(key), []).append(key)
+        return groups
+    
+    def _set(self, key: str, value: Any, ttl_seconds: int = 3600) -> bool:
         """Armazena valor no cache"""
         try:
             cache_key = self._generate_key(key)
             
-            if self.available:
-                # Redis
-                serialized = self._serialize_value(value)
-                self.redis_client.setex(cache_key, ttl_seconds, serialized)
-                gym_logger.debug(f"Cache set: {key}", ttl_seconds=ttl_seconds)
-                return True
-            else:
-                # Memory fallback
-                self.memory_cache[cache_key] = value
-                self.cache_timestamps[cache_key] = datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
-                return True
+            if self._use_redis():
+                try:
+                    # Redis + aviso aos outros workers no mesmo round trip
+                    serialized = self._serialize_value(value)
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    pipe.setex(cache_key, ttl_seconds, serialized)
+                    pipe.publish(self.invalidation_channel, self._invalidation_message("key", keys=[cache_key]))
+                    pipe.execute()
+                    self.breaker.record_success()
+                    self.l1.set(cache_key, serialized, ttl_seconds)
+                    gym_logger.debug(f"Cache set: {key}", ttl_seconds=ttl_seconds)
+                    return True
+                except REDIS_ERRORS as e:
+                    self._redis_failed(e)
+            
+            # Memory fallback (serializado, como no Redis: cada leitura é uma cópia)
+            self.memory_cache[cache_key] = self._serialize_value(value)
+            self.cache_timestamps[cache_key] = datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+            return True
                 
         except Exception as e:
             gym_logger.error(f"Cache set failed: {key}", error=e)
             return False
     
-    def get(self, key: str) -> Any:
+    def _get(self, key: str) -> Any:
         """Recupera valor do cache"""
         try:
             cache_key = self._generate_key(key)
             
-            if self.available:
-                # Redis
-                data = self.redis_client.get(cache_key)
-                if data:
-                    value = self._deserialize_value(data)
-                    gym_logger.debug(f"Cache hit: {key}")
-                    return value
-                else:
-                    gym_logger.debug(f"Cache miss: {key}")
-                    return None
-            else:
-                # Memory fallback
-                if cache_key in self.memory_cache:
-                    # Verificar TTL
-                    if datetime.now(timezone.utc) < self.cache_timestamps.get(cache_key, datetime.min.replace(tzinfo=timezone.utc)):
-                        gym_logger.debug(f"Memory cache hit: {key}")
-                        return self.memory_cache[cache_key]
-                    else:
-                        # Expirado, remover
-                        del self.memory_cache[cache_key]
-                        del self.cache_timestamps[cache_key]
+            if self._use_redis():
+                # L1 (processo)
+                data = self.l1.get(cache_key)
+                if data is not _MISSING:
+                    self.tier_stats["l1_hits"] += 1
+                    return self._deserialize_value(data)
+                self.tier_stats["l1_misses"] += 1
                 
-                gym_logger.debug(f"Memory cache miss: {key}")
-                return None
+                # L2 (Redis)
+                try:
+                    data = self.redis_client.get(cache_key)
+                    self.breaker.record_success()
+                    if data:
+                        value = self._deserialize_value(data)
+                        self.tier_stats["l2_hits"] += 1
+                        self.l1.set(cache_key, data)
+                        gym_logger.debug(f"Cache hit: {key}")
+                        return value
+                    else:
+                        self.tier_stats["l2_misses"] += 1
+                        gym_logger.debug(f"Cache miss: {key}")
+                        return None
+                except REDIS_ERRORS as e:
+                    self._redis_failed(e)
+            
+            # Memory fallback
+            if cache_key in self.memory_cache:
+                # Verificar TTL
+                if datetime.now(timezone.utc) < self.cache_timestamps.get(cache_key, datetime.min.replace(tzinfo=timezone.utc)):
+                    self.tier_stats["l2_hits"] += 1
+                    gym_logger.debug(f"Memory cache hit: {key}")
+                    return self._deserialize_value(self.memory_cache[cache_key])
+                else:
+                    # Expirado, remover
+                    del self.memory_cache[cache_key]
+                    del self.cache_timestamps[cache_key]
+            
+            self.tier_stats["l2_misses"] += 1
+            gym_logger.debug(f"Memory cache miss: {key}")
+            return None
                 
         except Exception as e:
             gym_logger.error(f"Cache get failed: {key}", error=e)
             return None
     
-    def delete(self, key: str) -> bool:
+    def _delete(self, key: str) -> bool:
         """Remove valor do cache"""
         try:
             cache_key = self._generate_key(key)
+            self.l1.invalidate(cache_key)
             
-            if self.available:
-                result = self.redis_client.delete(cache_key)
-                gym_logger.debug(f"Cache delete: {key}", deleted=bool(result))
-                return bool(result)
-            else:
-                if cache_key in self.memory_cache:
-                    del self.memory_cache[cache_key]
-                    del self.cache_timestamps[cache_key]
-                    gym_logger.debug(f"Memory cache delete: {key}")
-                    return True
-                return False
+            if self._use_redis():
+                try:
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    pipe.delete(cache_key)
+                    pipe.publish(self.invalidation_channel, self._invalidation_message("key", keys=[cache_key]))
+                    result = pipe.execute()[0]
+                    self.breaker.record_success()
+                    gym_logger.debug(f"Cache delete: {key}", deleted=bool(result))
+                    return bool(result)
+                except REDIS_ERRORS as e:
+                    self._redis_failed(e)
+            
+            self._remember_invalidation("key", key)
+            if cache_key in self.memory_cache:
+                del self.memory_cache[cache_key]
+                del self.cache_timestamps[cache_key]
+                gym_logger.debug(f"Memory cache delete: {key}")
+                return True
+            return False
                 
         except Exception as e:
             gym_logger.error(f"Cache delete failed: {key}", error=e)
             return False
     
+    def _get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Recupera várias chaves num só round trip (MGET); devolve só os hits"""
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, Any] = {}
+        if not keys:
+            return found
+        try:
+            if self._use_redis():
+                # L1 primeiro, MGET apenas para o que falta
+                pending = []
+                for key in keys:
+                    data = self.l1.get(self._generate_key(key))
+                    if data is not _MISSING:
+                        found[key] = self._deserialize_value(data)
+                    else:
+                        pending.append(key)
+                self.tier_stats["l1_hits"] += len(found)
+                self.tier_stats["l1_misses"] += len(pending)
+                
+                try:
+                    if pending:
+                        raw_values = self.redis_client.mget([self._generate_key(k) for k in pending])
+                        self.breaker.record_success()
+                        for key, data in zip(pending, raw_values):
+                            if data:
+                                found[key] = self._deserialize_value(data)
+                                self.l1.set(self._generate_key(key), data)
+                        hits = sum(1 for key in pending if key in found)
+                        self.tier_stats["l2_hits"] += hits
+                        self.tier_stats["l2_misses"] += len(pending) - hits
+                    
+                    gym_logger.debug("Cache get_many", requested=len(keys), hits=len(found))
+                    return found
+                except REDIS_ERRORS as e:
+                    self._redis_failed(e)
+            
+            # Memory fallback
+            now = datetime.now(timezone.utc)
+            for key in keys:
+                cache_key = self._generate_key(key)
+                if key in found or cache_key not in self.memory_cache:
+                    continue
+                if now < self.cache_timestamps.get(cache_key, datetime.min.replace(tzinfo=timezone.utc)):
+                    found[key] = self._deserialize_value(self.memory_cache[cache_key])
+                else:
+                    del self.memory_cache[cache_key]
+                    self.cache_timestamps.pop(cache_key, None)
+            self.tier_stats["l2_hits"] += len(found)
+            self.tier_stats["l2_misses"] += len(keys) - len(found)
+            
+            gym_logger.debug("Cache get_many", requested=len(keys), hits=len(found))
+            return found
+        
+        except Exception as e:
+            gym_logger.error("Cache get_many failed", error=e, keys_count=len(keys))
+            return found
+    
+    def _set_many(self, mapping: Dict[str, Any], ttl_seconds: int = 3600) -> bool:
+        """Armazena várias chaves num só pipeline"""
+        if not mapping:
+            return True
+        try:
+            serialized = {self._generate_key(k): self._serialize_value(v) for k, v in mapping.items()}
+            if self._use_redis():
+                try:
+                    cache_keys = list(serialized)
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    for cache_key, data in serialized.items():
+                        pipe.setex(cache_key, ttl_seconds, data)
+                    pipe.publish(self.invalidation_channel, self._invalidation_message("key", keys=cache_keys))
+                    pipe.execute()
+                    self.breaker.record_success()
+                    for cache_key, data in serialized.items():
+                        self.l1.set(cache_key, data, ttl_seconds)
+                    gym_logger.debug("Cache set_many", keys_count=len(mapping), ttl_seconds=ttl_seconds)
+                    return True
+                except REDIS_ERRORS as e:
+                    self._redis_failed(e)
+            
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+            for cache_key, data in serialized.items():
+                self.memory_cache[cache_key] = data
+                self.cache_timestamps[cache_key] = expires_at
+            
+            gym_logger.debug("Cache set_many", keys_count=len(mapping), ttl_seconds=ttl_seconds)
+            return True
+        
+        except Exception as e:
+            gym_logger.error("Cache set_many failed", error=e, keys_count=len(mapping))
+            return False
+    
+    def _delete_many(self, keys: Iterable[str]) -> int:
+        """Remove várias chaves num só round trip"""
+        keys = list(dict.fromkeys(keys))
+        cache_keys = [self._generate_key(k) for k in keys]
+        if not cache_keys:
+            return 0
+        try:
+            for cache_key in cache_keys:
+                self.l1.invalidate(cache_key)
+            
+            if self._use_redis():
+                try:
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    pipe.delete(*cache_keys)
+                    pipe.publish(self.invalidation_channel, self._invalidation_message("key", keys=cache_keys))
+                    deleted = pipe.execute()[0]
+                    self.breaker.record_success()
+                    gym_logger.debug("Cache delete_many", keys_count=len(cache_keys), deleted=deleted)
+                    return deleted
+                except REDIS_ERRORS as e:
+                    self._redis_failed(e)
+            
+            deleted = 0
+            for key, cache_key in zip(keys, cache_keys):
+                self._remember_invalidation("key", key)
+                if self.memory_cache.pop(cache_key, _MISSING) is not _MISSING:
+                    deleted += 1
+                self.cache_timestamps.pop(cache_key, None)
+            
+            gym_logger.debug("Cache delete_many", keys_count=len(cache_keys), deleted=deleted)
+            return deleted
+        
+        except Exception as e:
+            gym_logger.error("Cache delete_many failed", error=e, keys_count=len(cache_keys))
+            return 0
+    
+    async def get_or_load_many(
+        self,
+        namespace: str,
+        ids: Iterable[str],
+        loader: Callable[[List[str]], Awaitable[Dict[str, Any]]],
+        ttl_seconds: int = 300
+    ) -> Dict[str, Any]:
+        """Read-through em lote: lê `namespace:id` e carrega os que faltam de uma vez
+        
+        O loader recebe a lista de ids em falta e devolve {id: valor}; ids que o
+        loader não devolver ficam fora do resultado e não são cacheados.
+        """
+        ids = [i for i in dict.fromkeys(ids) if i is not None]
+        if not ids:
+            return {}
+        
+        cached = self.get_many(f"{namespace}:{i}" for i in ids)
+        prefix_len = len(namespace) + 1
+        result = {key[prefix_len:]: value for key, value in cached.items()}
+        
+        missing = [i for i in ids if i not in result]
+        if missing:
+            loaded = await loader(missing)
+            if loaded:
+                self.set_many({f"{namespace}:{i}": value for i, value in loaded.items()}, ttl_seconds)
+                result.update(loaded)
+        
+        return result
+    
     def clear_pattern(self, pattern: str) -> int:
         """Remove todas as chaves que correspondem ao padrão"""
         try:
-            if self.available:
-                keys = self.redis_client.keys(self._generate_key(f"*{pattern}*"))
-                if keys:
-                    deleted = self.redis_client.delete(*keys)
-                    gym_logger.info(f"Cache pattern cleared: {pattern}", keys_deleted=deleted)
+            if self._use_redis():
+                try:
+                    # Apagar no L2 antes de avisar: um worker que limpe o L1 e releia
+                    # o Redis já não volta a encontrar o valor antigo
+                    keys = self.redis_client.keys(self._generate_key(f"*{pattern}*"))
+                    deleted = self.redis_client.delete(*keys) if keys else 0
+                    self.l1.invalidate_pattern(pattern)
+                    self.redis_client.publish(
+                        self.invalidation_channel,
+                        self._invalidation_message("pattern", pattern=pattern)
+                    )
+                    self.breaker.record_success()
+                    if deleted:
+                        gym_logger.info(f"Cache pattern cleared: {pattern}", keys_deleted=deleted)
                     return deleted
-                return 0
-            else:
-                # Memory fallback
-                keys_to_delete = [k for k in self.memory_cache.keys() if pattern in k]
-                for key in keys_to_delete:
-                    del self.memory_cache[key]
-                    if key in self.cache_timestamps:
-                        del self.cache_timestamps[key]
-                
-                gym_logger.info(f"Memory cache pattern cleared: {pattern}", keys_deleted=len(keys_to_delete))
-                return len(keys_to_delete)
+                except REDIS_ERRORS as e:
+                    self._redis_failed(e)
+            
+            # Memory fallback
+            self.l1.invalidate_pattern(pattern)
+            self._remember_invalidation("pattern", pattern)
+            keys_to_delete = [k for k in self.memory_cache.keys() if pattern in k]
+            for key in keys_to_delete:
+                del self.memory_cache[key]
+                if key in self.cache_timestamps:
+                    del self.cache_timestamps[key]
+            
+            gym_logger.info(f"Memory cache pattern cleared: {pattern}", keys_deleted=len(keys_to_delete))
+            return len(keys_to_delete)
                 
         except Exception as e:
             gym_logger.error(f"Cache pattern clear failed: {pattern}", error=e)
             return 0
     
+    def tag_keys(self, key: str, tags, ttl_seconds: int = 3600) -> bool:
+        """Associa uma chave a tags para invalidação em grupo"""
+        tags = list(tags)
+        if not tags:
+            return True
+        try:
+            cache_key = self._generate_key(key)
+            if self._use_redis():
+                try:
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    for tag in tags:
+                        self._tag_script(
+                            keys=[self._generate_key(f"tag:{tag}")],
+                            args=[cache_key, ttl_seconds],
+                            client=pipe
+                        )
+                    pipe.execute()
+                    self.breaker.record_success()
+                    return True
+                except REDIS_SCRIPT_ERRORS as e:
+                    self._redis_failed(e)
+            
+            for tag in tags:
+                self.memory_tags.setdefault(tag, set()).add(cache_key)
+            return True
+        except Exception as e:
+            gym_logger.error(f"Cache tag failed: {key}", error=e, tags=tags)
+            return False
+    
+    def invalidate_tags(self, *tags: str) -> int:
+        """Remove todas as chaves registadas nas tags indicadas"""
+        deleted = 0
+        try:
+            remaining = list(tags)
+            if self._use_redis():
+                try:
+                    while remaining:
+                        tag_key = self._generate_key(f"tag:{remaining[0]}")
+                        keys = self.redis_client.smembers(tag_key)
+                        pipe = self.redis_client.pipeline(transaction=False)
+                        if keys:
+                            pipe.delete(*keys)
+                            decoded = [k.decode() if isinstance(k, bytes) else k for k in keys]
+                            for cache_key in decoded:
+                                self.l1.invalidate(cache_key)
+                            pipe.publish(self.invalidation_channel, self._invalidation_message("key", keys=decoded))
+                        pipe.delete(tag_key)
+                        results = pipe.execute()
+                        deleted += results[0] if keys else 0
+                        remaining.pop(0)
+                    self.breaker.record_success()
+                except REDIS_ERRORS as e:
+                    self._redis_failed(e)
+            
+            for tag in remaining:
+                self._remember_invalidation("tag", tag)
+                for cache_key in self.memory_tags.pop(tag, set()):
+                    self.l1.invalidate(cache_key)
+                    if self.memory_cache.pop(cache_key, None) is not None:
+                        deleted += 1
+                    self.cache_timestamps.pop(cache_key, None)
+            
+            gym_logger.info("Cache tags invalidated", tags=list(tags), keys_deleted=deleted)
+            return deleted
+        except Exception as e:
+            gym_logger.error("Cache tag invalidation failed", error=e, tags=list(tags))
+            return deleted
+    
+    def get_tier_stats(self) -> Dict[str, Any]:
+        """Hit ratio por camada (L1 processo / L2 backend)"""
+        stats = self.tier_stats
+        
+        def ratio(hits: int, misses: int) -> float:
+            total = hits + misses
+            return round(hits / total, 4) if total else 0.0
+        
+        return {
+            "l1": {
+                "enabled": self.available,
+                "hits": stats["l1_hits"],
+                "misses": stats["l1_misses"],
+                "hit_ratio": ratio(stats["l1_hits"], stats["l1_misses"]),
+                "size": len(self.l1),
+                "max_items": self.l1.max_items,
+                "ttl_seconds": self.l1.ttl_seconds
+            },
+            "l2": {
+                "backend": "redis" if self.available else "memory",
+                "hits": stats["l2_hits"],
+                "misses": stats["l2_misses"],
+                "hit_ratio": ratio(stats["l2_hits"], stats["l2_misses"])
+            },
+            "invalidation": {
+                "channel": self.invalidation_channel,
+                "subscribed": self._pubsub_thread is not None and self._pubsub_thread.is_alive(),
+                "published": stats["invalidations_published"],
+                "received": stats["invalidations_received"]
+            }
+        }
+    
     def get_stats(self) -> Dict[str, Any]:
         """Estatísticas do cache"""
-        if self.available:
+        if self._use_redis():
             try:
                 info = self.redis_client.info()
+                self.breaker.record_success()
                 return {
                     "type": "redis",
                     "connected_clients": info.get("connected_clients", 0),
                     "used_memory": info.get("used_memory_human", "0B"),
                     "keyspace_hits": info.get("keyspace_hits", 0),
-                    "keyspace_misses": info.get("keyspace_misses", 0)
+                    "keyspace_misses": info.get("keyspace_misses", 0),
+                    "tiers": self.get_tier_stats(),
+                    "circuit_breaker": self.breaker.snapshot(),
+                    **self.metrics.snapshot()
                 }
-            except:
+            except REDIS_ERRORS as e:
+                self._redis_failed(e)
+            except Exception:
                 pass
         
         return {
             "type": "memory",
             "keys_count": len(self.memory_cache),
-            "memory_usage": "N/A"
+            "memory_usage": "N/A",
+            "tiers": self.get_tier_stats(),
+            "circuit_breaker": self.breaker.snapshot(),
+            **self.metrics.snapshot()
         }
 
 # Instância global do cache
 gym_cache = GymCache()
 
-def cache_result(ttl_seconds: int = 3600, key_prefix: str = ""):
-    """Decorador para cache automático de resultados de função"""
+# Execuções em curso por chave (single-flight)
+_LEADER_CANCELLED = object()
+_async_inflight: Dict[str, "asyncio.Future"] = {}
+_sync_inflight: Dict[str, threading.Lock] = {}
+_sync_inflight_guard = threading.Lock()
+
+# Argumentos injetados (dependências FastAPI, self) que não identificam o resultado
+INJECTED_ARG_NAMES = {"self", "cls", "request", "current_user", "db", "background_tasks"}
+
+def _canonical_value(value: Any) -> Any:
+    """Converte argumentos numa forma estável e serializável para a chave"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {str(k): _canonical_value(v) for k, v in sorted(value.items(), key=lambda item: str(item[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_canonical_value(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_canonical_value(v) for v in value), key=repr)
+    if hasattr(value, "dict") and callable(value.dict):
+        # Modelos Pydantic
+        return _canonical_value(value.dict())
+    raise TypeError(f"Argument of type {type(value).__name__} has no canonical cache form")
+
+def _default_cache_key(signature: inspect.Signature, args, kwargs, ignore) -> str:
+    """Hash canónico dos argumentos, ignorando dependências injetadas"""
+    bound = signature.bind_partial(*args, **kwargs)
+    relevant = {
+        name: _canonical_value(value)
+        for name, value in bound.arguments.items()
+        if name not in ignore and not isinstance(value, HTTPConnection)
+    }
+    payload = json.dumps(relevant, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+def cache_result(
+    ttl_seconds: int = 3600,
+    key_prefix: str = "",
+    key_func: Optional[Callable[..., str]] = None,
+    ignore_args: Optional[Iterable[str]] = None,
+    cache_none: bool = False,
+    negative_ttl_seconds: int = 60,
+    tags: Union[Iterable[str], Callable[..., Iterable[str]], None] = None,
+    single_flight: bool = True
+):
+    """Decorador para cache automático de resultados de função
+    
+    - key_func: recebe os mesmos argumentos da função e devolve a chave
+    - ignore_args: nomes extra de argumentos a excluir do hash
+    - cache_none/negative_ttl_seconds: guarda resultados None (negative caching)
+    - tags: tags fixas ou callable(*args, **kwargs) para invalidate_tags
+    - single_flight: misses concorrentes da mesma chave partilham uma execução;
+      cada seguidor recebe uma cópia do resultado e, se o líder for cancelado,
+      volta a tentar em vez de falhar com ele
+    
+    O TTL pode ser sobreposto por chamada com o argumento `_cache_ttl`.
+    """
+    ignore = INJECTED_ARG_NAMES | set(ignore_args or ())
+    
     def decorator(func):
+        func_name = f"{key_prefix}{func.__qualname__}" if key_prefix else f"{func.__module__}.{func.__qualname__}"
+        signature = inspect.signature(func)
+        
+        def build_key(args, kwargs) -> Optional[str]:
+            try:
+                suffix = key_func(*args, **kwargs) if key_func else _default_cache_key(signature, args, kwargs, ignore)
+            except TypeError as e:
+                gym_logger.debug(f"Function cache bypassed: {func.__name__}", reason=str(e))
+                return None
+            return f"func:{func_name}:{suffix}"
+        
+        def lookup(cache_key: str) -> Any:
+            cached = gym_cache.get(cache_key)
+            if cached is None:
+                return _MISSING
+            gym_logger.debug(f"Function cache hit: {func.__name__}")
+            return None if isinstance(cached, str) and cached == _NEGATIVE_MARKER else cached
+        
+        def store(cache_key: str, result: Any, ttl: int, args, kwargs):
+            if result is None:
+                if not cache_none:
+                    return
+                gym_cache.set(cache_key, _NEGATIVE_MARKER, min(ttl, negative_ttl_seconds))
+            else:
+                gym_cache.set(cache_key, result, ttl)
+            if tags:
+                key_tags = tags(*args, **kwargs) if callable(tags) else tags
+                gym_cache.tag_keys(cache_key, key_tags, ttl)
+            gym_logger.debug(f"Function result cached: {func.__name__}", ttl_seconds=ttl)
+        
         @wraps(func)
-        async def async_wrapper(*args, **kwargs):
-            # Gerar chave baseada na função e argumentos
-            func_name = f"{key_prefix}{func.__name__}" if key_prefix else func.__name__
-            
-            # Hash dos argumentos para chave única
-            args_str = str(args) + str(sorted(kwargs.items()))
-            args_hash = hashlib.md5(args_str.encode()).hexdigest()[:8]
-            cache_key = f"func:{func_name}:{args_hash}"
+        async def async_wrapper(*args, _cache_ttl: Optional[int] = None, **kwargs):
+            cache_key = build_key(args, kwargs)
+            if cache_key is None:
+                return await func(*args, **kwargs)
             
-            # Tentar obter do cache
-            cached_result = gym_cache.get(cache_key)
-            if cached_result is not None:
-                gym_logger.debug(f"Function cache hit: {func.__name__}")
-                return cached_result
-            
-            # Executar função e cachear resultado
-            result = await func(*args, **kwargs)
-            gym_cache.set(cache_key, result, ttl_seconds)
-            gym_logger.debug(f"Function result cached: {func.__name__}", ttl_seconds=ttl_seconds)
+            while True:
+                cached_result = lookup(cache_key)
+                if cached_result is not _MISSING:
+                    return cached_result
+                if not single_flight:
+                    break
+                
+                # Coalescer misses concorrentes na mesma execução
+                pending = _async_inflight.get(cache_key)
+                if pending is None:
+                    pending = asyncio.get_running_loop().create_future()
+                    _async_inflight[cache_key] = pending
+                    break
+                result = await asyncio.shield(pending)
+                if result is not _LEADER_CANCELLED:
+                    # Cópia própria: o líder e os outros seguidores têm o mesmo objeto
+                    return copy.deepcopy(result)
+                # O líder foi cancelado: voltar a tentar (o primeiro a chegar passa a líder)
             
-            return result
+            try:
+                result = await func(*args, **kwargs)
+                store(cache_key, result, _cache_ttl or ttl_seconds, args, kwargs)
+                if single_flight:
+                    pending.set_result(result)
+                return result
+            except asyncio.CancelledError:
+                # Não propagar o cancelamento (é deste pedido, não dos seguidores)
+                if single_flight:
+                    pending.set_result(_LEADER_CANCELLED)
+                raise
+            except BaseException as e:
+                if single_flight:
+                    pending.set_exception(e)
+                    pending.exception()  # marcar como consumida se ninguém esperar
+                raise
+            finally:
+                if single_flight and _async_inflight.get(cache_key) is pending:
+                    del _async_inflight[cache_key]
         
         @wraps(func)
-        def sync_wrapper(*args, **kwargs):
+        def sync_wrapper(*args, _cache_ttl: Optional[int] = None, **kwargs):
             # Para funções síncronas
-            func_name = f"{key_prefix}{func.__name__}" if key_prefix else func.__name__
-            
-            args_str = str(args) + str(sorted(kwargs.items()))
-            args_hash = hashlib.md5(args_str.encode()).hexdigest()[:8]
-            cache_key = f"func:{func_name}:{args_hash}"
+            cache_key = build_key(args, kwargs)
+            if cache_key is None:
+                return func(*args, **kwargs)
             
-            cached_result = gym_cache.get(cache_key)
-            if cached_result is not None:
-                gym_logger.debug(f"Function cache hit: {func.__name__}")
+            cached_result = lookup(cache_key)
+            if cached_result is not _MISSING:
                 return cached_result
             
-            result = func(*args, **kwargs)
-            gym_cache.set(cache_key, result, ttl_seconds)
-            gym_logger.debug(f"Function result cached: {func.__name__}", ttl_seconds=ttl_seconds)
+            if not single_flight:
+                result = func(*args, **kwargs)
+                store(cache_key, result, _cache_ttl or ttl_seconds, args, kwargs)
+                return result
             
-            return result
+            with _sync_inflight_guard:
+                key_lock = _sync_inflight.setdefault(cache_key, threading.Lock())
+            with key_lock:
+                # Outra thread pode ter preenchido o cache enquanto esperávamos
+                cached_result = lookup(cache_key)
+                if cached_result is not _MISSING:
+                    return cached_result
+                try:
+                    result = func(*args, **kwargs)
+                    store(cache_key, result, _cache_ttl or ttl_seconds, args, kwargs)
+                    return result
+                finally:
+                    with _sync_inflight_guard:
+                        _sync_inflight.pop(cache_key, None)
         
         # Detectar se é função async
-        if hasattr(func, '__code__') and func.__code__.co_flags & 0x80:
+        if inspect.iscoroutinefunction(func):
             return async_wrapper
         else:
             return sync_wrapper
@@ -0,0 +1,121 @@
+"""
+KO Gym - Circuit Breaker
+Proteção contra dependências externas instáveis (Redis)
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from .logger import gym_logger
+
+class CircuitBreaker:
+    """Circuit breaker clássico: closed -> open -> half_open -> closed
+    
+    - closed: pedidos passam; falhas consecutivas acima do limite abrem o circuito
+    - open: pedidos falham rápido (o chamador usa o fallback) até ao reset_timeout
+    - half_open: deixa passar uma única sonda; sucesso fecha, falha reabre
+    
+    Uma sonda que não chega a registar resultado (exceção fora das esperadas pelo
+    chamador) expira ao fim de reset_timeout e é substituída por outra.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 10.0,
+                 on_close: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_close = on_close
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.last_error: Optional[str] = None
+        self.stats = {"opened": 0, "closed": 0, "short_circuited": 0, "failures": 0, "probes": 0}
+        self._probe_in_flight = False
+        self._probe_started_at = 0.0
+        self._lock = threading.Lock()
+    
+    def allow_request(self) -> bool:
+        """True se o chamador pode usar a dependência agora"""
+        if self.state == self.CLOSED:
+            return True
+        
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN and (
+                not self._probe_in_flight or now - self._probe_started_at >= self.reset_timeout
+            ):
+                self._probe_in_flight = True
+                self._probe_started_at = now
+                self.stats["probes"] += 1
+                return True
+            
+            self.stats["short_circuited"] += 1
+            return False
+    
+    def record_success(self):
+        if self.state == self.CLOSED and self.consecutive_failures == 0:
+            return
+        
+        recovered = False
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state != self.CLOSED:
+                self.state = self.CLOSED
+                self._probe_in_flight = False
+                self.stats["closed"] += 1
+                recovered = True
+        
+        if recovered:
+            gym_logger.info(f"Circuit breaker closed: {self.name}")
+            if self.on_close:
+                self.on_close()
+    
+    def record_failure(self, error: Optional[Exception] = None):
+        opened = False
+        with self._lock:
+            self.consecutive_failures += 1
+            self.stats["failures"] += 1
+            self.last_error = f"{type(error).__name__}: {error}" if error else None
+            
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+                self.stats["opened"] += 1
+                opened = True
+        
+        if opened:
+            gym_logger.warning(f"Circuit breaker opened: {self.name}",
+                               failures=self.consecutive_failures, error=self.last_error)
+    
+    def force_open(self, error: Optional[Exception] = None):
+        """Abre o circuito de imediato (ex.: dependência indisponível no arranque)"""
+        with self._lock:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.last_error = f"{type(error).__name__}: {error}" if error else None
+            self.stats["opened"] += 1
+    
+    def snapshot(self) -> Dict[str, Any]:
+        retry_in = 0.0
+        if self.state == self.OPEN:
+            retry_in = max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_timeout_seconds": self.reset_timeout,
+            "retry_in_seconds": round(retry_in, 2),
+            "last_error": self.last_error,
+            **self.stats
+        }
@@ -0,0 +1,249 @@
+"""
+KO Gym - Instrumentação dos comandos MongoDB
+CommandListener do pymongo: contagem e tempo de DB por request e por comando,
+e registo de queries lentas agregadas por forma (valores removidos)
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo import monitoring
+from .logger import gym_logger
+from .metrics import metrics_registry
+from .request_context import current_request
+from .request_sampling import route_template
+
+mongodb_command_duration_seconds = metrics_registry.histogram(
+    "mongodb_command_duration_seconds", "Duração dos comandos MongoDB",
+    ("command",), buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+mongodb_command_failures_total = metrics_registry.counter(
+    "mongodb_command_failures_total", "Comandos MongoDB que falharam", ("command",)
+)
+mongodb_slow_queries_total = metrics_registry.counter(
+    "mongodb_slow_queries_total", "Comandos MongoDB acima do limite de query lenta", ("command", "collection")
+)
+
+# Onde está o filtro de cada comando (updates/deletes: lista de statements com "q")
+_FILTER_FIELDS = {
+    "find": "filter", "count": "query", "distinct": "query",
+    "findAndModify": "query", "aggregate": "pipeline",
+}
+_STATEMENT_FIELDS = {"update": "updates", "delete": "deletes"}
+
+# Comandos que o explain suporta
+_EXPLAINABLE = {"find", "aggregate", "count", "distinct", "findAndModify", "update", "delete"}
+
+def normalize_shape(value: Any) -> Any:
+    """Forma da query: nomes de campos e operadores mantêm-se, valores passam a "?"
+    
+    {"check_in_date": {"$gte": "2024-01-01"}, "member_id": {"$in": [...]}}
+    -> {"check_in_date": {"$gte": "?"}, "member_id": {"$in": "?"}}
+    """
+    if isinstance(value, dict):
+        return {key: normalize_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        # Pipelines e $and/$or mantêm a estrutura; listas de valores colapsam
+        if value and all(isinstance(item, dict) for item in value):
+            return [normalize_shape(item) for item in value]
+        return "?"
+    # "$amount" em pipelines é um caminho de campo, faz parte da forma
+    if isinstance(value, str) and value.startswith("$"):
+        return value
+    return "?"
+
+def command_shape(command_name: str, command: Dict[str, Any]) -> Tuple[str, Any]:
+    """(coleção, forma normalizada) de um comando"""
+    collection = command.get(command_name)
+    if not isinstance(collection, str):
+        collection = command.get("collection", "")
+    
+    field = _FILTER_FIELDS.get(command_name)
+    if field:
+        shape = normalize_shape(command.get(field, {}))
+        if command_name == "find" and command.get("sort"):
+            shape = {"filter": shape, "sort": list(command["sort"])}
+        return collection, shape
+    
+    field = _STATEMENT_FIELDS.get(command_name)
+    if field:
+        statements = command.get(field) or [{}]
+        return collection, normalize_shape(statements[0].get("q", {}))
+    return collection, {}
+
+def _plan_summary(plan: Dict[str, Any]) -> str:
+    """"IXSCAN { check_in_date: 1 }" / "COLLSCAN" a partir do winningPlan"""
+    stages = []
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        stage = node.get("stage")
+        if stage in ("COLLSCAN", "IXSCAN", "COUNT_SCAN", "DISTINCT_SCAN", "IDHACK", "EOF"):
+            key = node.get("keyPattern")
+            stages.append(f"{stage} {json.dumps(key)}" if key else stage)
+        stack.extend(node.get("inputStages", []))
+        for child in ("inputStage", "queryPlan", "winningPlan"):
+            if child in node:
+                stack.append(node[child])
+    return ", ".join(stages) or "unknown"
+
+class SlowQueryRecorder:
+    """Queries acima de threshold_ms, agregadas por (db, coleção, comando, forma)
+    
+    - cada ocorrência é logada com a forma, a coleção e a rota do request
+    - o plano (explain queryPlanner) é pedido uma vez por forma numa thread
+      própria, no cliente pymongo síncrono do Motor
+    - max_shapes limita a memória: quando cheio, descarta a forma menos frequente
+    """
+    
+    def __init__(self, threshold_ms: float = 100.0, max_shapes: int = 500, explain: bool = True):
+        self.threshold_ms = threshold_ms
+        self.max_shapes = max_shapes
+        self.explain = explain
+        self._shapes: Dict[Tuple[str, str, str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._explain_executor: Optional[ThreadPoolExecutor] = None
+        self._sync_client = None
+    
+    def attach_client(self, sync_client):
+        """Cliente pymongo (AsyncIOMotorClient.delegate) para os explains"""
+        self._sync_client = sync_client
+    
+    def record(self, database: str, command_name: str, command: Dict[str, Any], duration_ms: float):
+        collection, shape = command_shape(command_name, command)
+        shape_key = json.dumps(shape, sort_keys=True, default=str)
+        context = current_request.get()
+        route = route_template(context.scope) if context is not None and context.scope else None
+        
+        key = (database, collection, command_name, shape_key)
+        with self._lock:
+            entry = self._shapes.get(key)
+            new_shape = entry is None
+            if new_shape:
+                if len(self._shapes) >= self.max_shapes:
+                    least = min(self._shapes, key=lambda k: self._shapes[k]["count"])
+                    del self._shapes[least]
+                entry = self._shapes[key] = {
+                    "database": database,
+                    "collection": collection,
+                    "command": command_name,
+                    "shape": shape_key,
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "plan_summary": None,
+                    "routes": {},
+                    "first_seen": time.time(),
+                }
+            entry["count"] += 1
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+            entry["last_seen"] = time.time()
+            if route:
+                entry["routes"][route] = entry["routes"].get(route, 0) + 1
+        
+        mongodb_slow_queries_total.labels(command_name, collection).inc()
+        gym_logger.warning(
+            "Slow MongoDB query",
+            collection=collection,
+            command=command_name,
+            shape=shape_key,
+            duration_ms=round(duration_ms, 2),
+            plan_summary=entry["plan_summary"],
+            route=route
+        )
+        
+        if new_shape and self.explain and self._sync_client is not None and command_name in _EXPLAINABLE:
+            self._schedule_explain(key, database, command)
+    
+    def _schedule_explain(self, key, database: str, command: Dict[str, Any]):
+        if self._explain_executor is None:
+            self._explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slow-query-explain")
+        # Só o comando em si; campos de sessão/cluster ($db, lsid, ...) não podem ir no explain
+        explained = {k: v for k, v in command.items() if not k.startswith("$") and k not in ("lsid", "txnNumber")}
+        self._explain_executor.submit(self._explain, key, database, explained)
+    
+    def _explain(self, key, database: str, command: Dict[str, Any]):
+        try:
+            result = self._sync_client[database].command(
+                {"explain": command, "verbosity": "queryPlanner"}
+            )
+            planner = result.get("queryPlanner") or (result.get("stages") or [{}])[0].get("$cursor", {}).get("queryPlanner", {})
+            summary = _plan_summary(planner.get("winningPlan", {}))
+        except Exception as e:
+            summary = f"explain failed: {type(e).__name__}"
+        with self._lock:
+            entry = self._shapes.get(key)
+            if entry is not None:
+                entry["plan_summary"] = summary
+    
+    def top(self, limit: int = 20, sort_by: str = "total_ms") -> List[Dict[str, Any]]:
+        """Top-N formas por total_ms, count ou max_ms"""
+        if sort_by not in ("total_ms", "count", "max_ms"):
+            sort_by = "total_ms"
+        with self._lock:
+            entries = [dict(entry, routes=dict(entry["routes"])) for entry in self._shapes.values()]
+        entries.sort(key=lambda entry: entry[sort_by], reverse=True)
+        for entry in entries:
+            entry["avg_ms"] = round(entry["total_ms"] / entry["count"], 2)
+            entry["total_ms"] = round(entry["total_ms"], 2)
+            entry["max_ms"] = round(entry["max_ms"], 2)
+        return entries[:limit]
+    
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"threshold_ms": self.threshold_ms, "shapes": len(self._shapes), "max_shapes": self.max_shapes}
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Atribui cada comando ao request em curso (contextvar copiado pelo Motor para a thread)
+    
+    started() guarda só a referência ao comando (para a forma, se acabar lento);
+    a duração vem no evento de sucesso/falha (duration_micros).
+    """
+    
+    def __init__(self, slow_queries: Optional[SlowQueryRecorder] = None):
+        self.slow_queries = slow_queries
+        self._in_flight: Dict[Tuple[Any, int], Tuple[str, Dict[str, Any]]] = {}
+    
+    def started(self, event: monitoring.CommandStartedEvent):
+        if self.slow_queries is not None and event.command_name != "explain":
+            self._in_flight[(event.connection_id, event.request_id)] = (event.database_name, event.command)
+    
+    def _record(self, event, failed: bool = False):
+        duration_ns = event.duration_micros * 1000
+        context = current_request.get()
+        if context is not None:
+            context.add_db_command(duration_ns)
+        mongodb_command_duration_seconds.labels(event.command_name).observe_ns(duration_ns)
+        if failed:
+            mongodb_command_failures_total.labels(event.command_name).inc()
+        
+        if self.slow_queries is not None:
+            started = self._in_flight.pop((event.connection_id, event.request_id), None)
+            duration_ms = duration_ns / 1e6
+            if started is not None and duration_ms >= self.slow_queries.threshold_ms:
+                try:
+                    self.slow_queries.record(started[0], event.command_name, started[1], duration_ms)
+                except Exception as e:
+                    gym_logger.error("Slow query recording failed", error=e)
+    
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._record(event)
+    
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._record(event, failed=True)
+
+slow_query_recorder = SlowQueryRecorder(
+    threshold_ms=float(os.getenv("SLOW_QUERY_MS", "100")),
+    max_shapes=int(os.getenv("SLOW_QUERY_MAX_SHAPES", "500")),
+    explain=os.getenv("SLOW_QUERY_EXPLAIN", "true").lower() not in ("0", "false", "no")
+)
+
+mongo_command_listener = MongoCommandListener(slow_queries=slow_query_recorder)
@@ -3,38 +3,200 @@ KO Gym - Sistema de Logging Premium
 Logs estruturados com níveis, métricas e rastreamento
 """
 import structlog
+import asyncio
+import atexit
+import functools
 import logging
+import queue
 import sys
+import threading
+import time
 from datetime import datetime, timezone
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, List, TextIO
 import os
+from .request_sampling import RequestSampler, request_sampler, route_template
+from .metrics import http_requests_total, http_request_duration_seconds, http_requests_in_progress
+from .request_context import RequestContext, current_request
+
+class AsyncLogSink:
+    """Sink não bloqueante: o request só enfileira o event dict (O(1))
+    
+    Uma thread de fundo junta lotes, faz o render (JSON/consola) e escreve de uma vez.
+    Fila limitada: com policy "drop" os registos excedentes são descartados e
+    contados; com "block" o chamador espera por espaço.
+    """
+    
+    def __init__(self, renderer, stream: Optional[TextIO] = None, maxsize: int = 10000,
+                 policy: str = "drop", batch_size: int = 256):
+        self.renderer = renderer
+        self.stream = stream
+        self.policy = policy
+        self.batch_size = batch_size
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.written = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+        self._thread.start()
+    
+    def put(self, event_dict: Dict[str, Any]):
+        if self._closed:
+            self._write([self._render(event_dict)])
+            return
+        if self.policy == "block":
+            self._queue.put(event_dict)
+            return
+        try:
+            self._queue.put_nowait(event_dict)
+        except queue.Full:
+            self.dropped += 1
+    
+    def _render(self, event_dict: Dict[str, Any]) -> str:
+        stamp = event_dict.pop("_ts", None)
+        if stamp is not None and "timestamp" not in event_dict:
+            event_dict["timestamp"] = datetime.fromtimestamp(stamp, timezone.utc).isoformat()
+        try:
+            return self.renderer(None, event_dict.get("level", "info"), event_dict)
+        except Exception as e:
+            return f"log render failed: {type(e).__name__}: {e} ({event_dict.get('event')!r})"
+    
+    def _write(self, lines: List[str]):
+        stream = self.stream or sys.stdout
+        try:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except Exception:
+            pass
+        self.written += len(lines)
+    
+    def _run(self):
+        reported_drops = 0
+        while True:
+            item = self._queue.get()
+            batch = []
+            stop = item is None
+            if not stop:
+                batch.append(self._render(item))
+            while not stop and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(self._render(item))
+            
+            if self.dropped != reported_drops:
+                batch.append(self._render({
+                    "event": "Log records dropped (queue full)",
+                    "level": "warning",
+                    "dropped": self.dropped - reported_drops,
+                    "_ts": time.time()
+                }))
+                reported_drops = self.dropped
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+    
+    def flush(self, timeout: float = 5.0):
+        """Escreve o que está na fila e pára a thread (shutdown)"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "maxsize": self._queue.maxsize,
+            "policy": self.policy,
+            "written": self.written,
+            "dropped": self.dropped
+        }
+
+class QueueLogger:
+    """Logger do structlog que entrega o event dict ao sink em vez de escrever"""
+    
+    def __init__(self, sink: AsyncLogSink):
+        self._sink = sink
+    
+    def msg(self, **event_dict):
+        self._sink.put(event_dict)
+    
+    log = debug = info = warn = warning = err = error = critical = exception = fatal = msg
+
+def _add_raw_timestamp(logger, method_name, event_dict):
+    # Só o float: a formatação ISO fica para a thread do sink
+    event_dict["_ts"] = time.time()
+    return event_dict
+
+def _return_event_dict(logger, method_name, event_dict):
+    # Último processador: o structlog chama QueueLogger.msg(**event_dict)
+    return event_dict
+
+# Sink ativo (None em modo síncrono)
+log_sink: Optional[AsyncLogSink] = None
 
 # Configuração do structlog para logs estruturados
-def configure_logging():
+def configure_logging(async_sink: Optional[bool] = None, level: int = logging.INFO,
+                      stream: Optional[TextIO] = None):
     """Configura o sistema de logging premium"""
+    global log_sink
+    if async_sink is None:
+        async_sink = os.getenv("LOG_ASYNC", "true").lower() not in ("0", "false", "no")
+    
+    # Em produção, usar JSON; em desenvolvimento, formato colorido
+    if os.getenv("ENVIRONMENT") == "production":
+        renderer = structlog.processors.JSONRenderer()
+        format_traceback = structlog.processors.dict_tracebacks
+    else:
+        renderer = structlog.dev.ConsoleRenderer(colors=True)
+        # O ConsoleRenderer não aceita o traceback em dict
+        format_traceback = structlog.processors.format_exc_info
     
-    # Processadores de log
+    # Processadores de log (no thread do chamador; tracebacks têm de ser extraídos aqui)
     processors = [
         structlog.contextvars.merge_contextvars,
         structlog.processors.add_log_level,
-        structlog.processors.TimeStamper(fmt="iso", utc=True),
         structlog.dev.set_exc_info,
-        structlog.processors.dict_tracebacks,
+        format_traceback,
     ]
     
-    # Em produção, usar JSON; em desenvolvimento, formato colorido
-    if os.getenv("ENVIRONMENT") == "production":
-        processors.append(structlog.processors.JSONRenderer())
+    if log_sink is not None:
+        log_sink.flush()
+        log_sink = None
+    
+    if async_sink:
+        log_sink = AsyncLogSink(
+            renderer,
+            stream=stream,
+            maxsize=int(os.getenv("LOG_QUEUE_MAXSIZE", "10000")),
+            policy=os.getenv("LOG_QUEUE_POLICY", "drop"),
+            batch_size=int(os.getenv("LOG_BATCH_SIZE", "256"))
+        )
+        processors += [_add_raw_timestamp, _return_event_dict]
+        logger_factory = lambda *args: QueueLogger(log_sink)
     else:
-        processors.append(structlog.dev.ConsoleRenderer(colors=True))
+        processors += [structlog.processors.TimeStamper(fmt="iso", utc=True), renderer]
+        logger_factory = structlog.PrintLoggerFactory(file=stream) if stream else structlog.PrintLoggerFactory()
     
     structlog.configure(
         processors=processors,
-        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
-        logger_factory=structlog.PrintLoggerFactory(),
+        wrapper_class=structlog.make_filtering_bound_logger(level),
+        logger_factory=logger_factory,
         cache_logger_on_first_use=True,
     )
 
+def flush_logs():
+    """Escreve os registos pendentes (chamar no shutdown)"""
+    if log_sink is not None:
+        log_sink.flush()
+
+atexit.register(flush_logs)
+
 # Logger global da aplicação
 logger = structlog.get_logger("ko_gym")
 
@@ -44,6 +206,22 @@ class GymLogger:
     def __init__(self):
         configure_logging()
         self.logger = structlog.get_logger("ko_gym")
+        self._metric_listeners: List[Callable[..., None]] = []
+    
+    def reconfigure(self, **kwargs):
+        """Reaplica configure_logging (ex.: modo síncrono, outro nível ou stream)"""
+        configure_logging(**kwargs)
+        self.logger = structlog.get_logger("ko_gym")
+    
+    def flush(self):
+        """Escreve os registos pendentes no sink assíncrono"""
+        flush_logs()
+    
+    def sink_stats(self) -> Dict[str, Any]:
+        """Estado da fila de logs (modo síncrono quando não há sink)"""
+        stats = log_sink.stats() if log_sink is not None else {"mode": "sync"}
+        stats["request_sampling"] = request_sampler.get_stats()
+        return stats
     
     def info(self, message: str, **kwargs):
         """Log de informação"""
@@ -75,8 +253,18 @@ class GymLogger:
             **kwargs
         )
     
+    def add_business_metric_listener(self, listener: Callable[..., None]):
+        """Recebe cada business_metric (ex.: o agregador de utils.business_metrics)"""
+        self._metric_listeners.append(listener)
+    
     def business_metric(self, metric_name: str, value: Any, user_id: Optional[str] = None, **kwargs):
-        """Log de métricas de negócio"""
+        """Log de métricas de negócio (e agregação pelos listeners registados)"""
+        for listener in self._metric_listeners:
+            try:
+                listener(metric_name, value, **kwargs)
+            except Exception as e:
+                self.logger.error("Business metric listener failed", metric_name=metric_name,
+                                  error_type=type(e).__name__, error_message=str(e))
         self.logger.info(
             "Business Metric",
             metric_name=metric_name,
@@ -115,70 +303,133 @@ gym_logger = GymLogger()
 
 # Decorador para logar automaticamente funções
 def log_function_call(func_name: str = None):
-    """Decorador para logar chamadas de função"""
+    """Decorador para logar chamadas de função (sync ou async)
+    
+    Escreve duas linhas de debug por chamada; para medir tempos use @timed (utils.metrics).
+    """
     def decorator(func):
+        function_name = func_name or func.__name__
+        
+        def log_failure(e: Exception, start_ns: int):
+            gym_logger.error(
+                f"Function failed: {function_name}",
+                error=e,
+                duration_ms=(time.perf_counter_ns() - start_ns) / 1e6,
+                success=False
+            )
+        
+        def log_success(start_ns: int):
+            gym_logger.debug(
+                f"Function completed: {function_name}",
+                duration_ms=(time.perf_counter_ns() - start_ns) / 1e6,
+                success=True
+            )
+        
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start_ns = time.perf_counter_ns()
+                gym_logger.debug(f"Function started: {function_name}")
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    log_failure(e, start_ns)
+                    raise
+                log_success(start_ns)
+                return result
+            return async_wrapper
+        
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            function_name = func_name or func.__name__
-            start_time = datetime.now(timezone.utc)
-            
+            start_ns = time.perf_counter_ns()
+            gym_logger.debug(f"Function started: {function_name}")
             try:
-                gym_logger.debug(f"Function started: {function_name}")
                 result = func(*args, **kwargs)
-                
-                duration = (datetime.now(timezone.utc) - start_time).total_seconds() * 1000
-                gym_logger.debug(
-                    f"Function completed: {function_name}",
-                    duration_ms=duration,
-                    success=True
-                )
-                return result
-                
             except Exception as e:
-                duration = (datetime.now(timezone.utc) - start_time).total_seconds() * 1000
-                gym_logger.error(
-                    f"Function failed: {function_name}",
-                    error=e,
-                    duration_ms=duration,
-                    success=False
-                )
+                log_failure(e, start_ns)
                 raise
+            log_success(start_ns)
+            return result
         
         return wrapper
     return decorator
 
 # Middleware para logging automático de requests
 class LoggingMiddleware:
-    """Middleware para logging automático de todas as requests"""
+    """Middleware para logging automático de todas as requests
+    
+    Os eventos api_request passam pelo request_sampler: a decisão é tomada no fim
+    do request, com o status e a duração já conhecidos. Todos os requests
+    (não excluídos) alimentam as métricas HTTP, com a rota como label.
     
-    def __init__(self, app):
+    O RequestContext do request acumula os comandos Mongo (MongoCommandListener);
+    seguem no header Server-Timing e no log do request.
+    """
+    
+    def __init__(self, app, sampler: Optional[RequestSampler] = None):
         self.app = app
+        self.sampler = sampler or request_sampler
     
     async def __call__(self, scope, receive, send):
         if scope["type"] == "http":
-            start_time = datetime.now(timezone.utc)
+            path = scope.get("path", "")
+            if self.sampler.is_excluded(path):
+                self.sampler.stats["excluded"] += 1
+                await self.app(scope, receive, send)
+                return
+            
+            start_ns = time.perf_counter_ns()
             
             # Capturar informações da request
             method = scope.get("method", "UNKNOWN")
-            path = scope.get("path", "")
             client = scope.get("client", ("unknown", 0))
-            ip_address = client[0] if client else "unknown"
+            # IP já resolvido (proxies confiáveis) pelo RateLimitMiddleware, se presente
+            ip_address = (scope.get("state") or {}).get("client_ip") or (client[0] if client else "unknown")
+            response_status = [500]
+            context = RequestContext(scope)
             
             async def send_wrapper(message):
                 if message["type"] == "http.response.start":
                     status_code = message["status"]
-                    duration = (datetime.now(timezone.utc) - start_time).total_seconds() * 1000
+                    response_status[0] = status_code
+                    duration = (time.perf_counter_ns() - start_ns) / 1e6
+                    route = route_template(scope)
+                    db_ms = round(context.db_time_ms, 2)
+                    sample_rate = self.sampler.decide(method, route, status_code, duration,
+                                                      db_commands=context.db_commands)
+                    
+                    server_timing = f'db;dur={db_ms};desc="{context.db_commands} mongo cmds", app;dur={duration:.2f}'
+                    message = {
+                        **message,
+                        "headers": list(message.get("headers", [])) + [(b"server-timing", server_timing.encode())]
+                    }
                     
-                    # Log da request
-                    gym_logger.api_request(
-                        method=method,
-                        endpoint=path,
-                        ip_address=ip_address,
-                        duration_ms=round(duration, 2),
-                        status_code=status_code
-                    )
+                    # Log da request (só se amostrado)
+                    if sample_rate is not None:
+                        gym_logger.api_request(
+                            method=method,
+                            endpoint=path,
+                            route=route,
+                            ip_address=ip_address,
+                            duration_ms=round(duration, 2),
+                            status_code=status_code,
+                            db_commands=context.db_commands,
+                            db_ms=db_ms,
+                            sample_rate=sample_rate
+                        )
                 
                 await send(message)
             
-            await self.app(scope, receive, send_wrapper)
+            in_progress = http_requests_in_progress.labels(method)
+            in_progress.inc()
+            context_token = current_request.set(context)
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                current_request.reset(context_token)
+                in_progress.dec()
+                route = route_template(scope)
+                http_request_duration_seconds.labels(method, route).observe_ns(time.perf_counter_ns() - start_ns)
+                http_requests_total.labels(method, route, response_status[0]).inc()
         else:
             await self.app(scope, receive, send)
\ No newline at end of file
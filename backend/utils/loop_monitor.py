@@ -0,0 +1,164 @@
+"""
+KO Gym - Watchdog do event loop
+Mede o lag do loop continuamente e captura a stack da thread do loop quando bloqueia
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional, Tuple
+from .logger import gym_logger
+from .metrics import metrics_registry
+
+event_loop_lag_seconds = metrics_registry.histogram(
+    "event_loop_lag_seconds", "Atraso do heartbeat do event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+event_loop_blocks_total = metrics_registry.counter(
+    "event_loop_blocks_total", "Bloqueios do event loop acima do limite"
+)
+
+# Código da aplicação (o "via" do culpado); o resto são bibliotecas/stdlib
+_APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _is_app_frame(filename: str) -> bool:
+    return filename.startswith(_APP_ROOT) and "site-packages" not in filename
+
+def _describe(frame) -> Tuple[Tuple[str, ...], str]:
+    """(stack raiz -> folha, resumo "make_image (qrcode/image/pil.py) via create_member (server.py:1290)")"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    
+    stack = tuple(f"{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{f.f_lineno})" for f in frames)
+    if not frames:
+        return stack, "unknown"
+    
+    leaf = frames[-1]
+    leaf_file = leaf.f_code.co_filename
+    parts = leaf_file.split(os.sep)
+    short = os.sep.join(parts[-3:]) if "site-packages" in parts else os.path.basename(leaf_file)
+    summary = f"{leaf.f_code.co_name} ({short}:{leaf.f_lineno})"
+    
+    app_frame = next((f for f in reversed(frames) if _is_app_frame(f.f_code.co_filename)), None)
+    if app_frame is not None and app_frame is not leaf:
+        summary += f" via {app_frame.f_code.co_name} ({os.path.basename(app_frame.f_code.co_filename)}:{app_frame.f_lineno})"
+    return stack, summary
+
+class EventLoopWatchdog:
+    """Heartbeat no loop + thread vigilante
+    
+    - o heartbeat dorme interval e mede o atraso com que acorda (lag) -> histograma
+    - a thread vigilante vê se o heartbeat está atrasado mais do que threshold;
+      enquanto o bloqueio dura, amostra a stack da thread do loop (sys._current_frames)
+    - quando o loop volta, o bloqueio é logado com a stack mais frequente e o resumo
+      do culpado ("blocked 240ms in make_image ... via create_member ...")
+    """
+    
+    def __init__(self, interval: float = 0.1, threshold: float = 0.1, max_samples: int = 20,
+                 history: int = 20):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_samples = max_samples
+        self.recent_blocks: deque = deque(maxlen=history)
+        self.stats = {"blocks": 0, "max_lag_ms": 0.0}
+        self._expected_wakeup = 0.0
+        self._loop_thread_id: Optional[int] = None
+        self._samples: List[Tuple[Tuple[str, ...], str]] = []
+        self._samples_for = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+    
+    def start(self):
+        """Chamar dentro do event loop (startup da app)"""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._expected_wakeup = time.monotonic() + self.interval
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+    
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            self._expected_wakeup = expected
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - expected, 0.0)
+            event_loop_lag_seconds.observe(lag)
+            if lag >= self.threshold:
+                self._report(lag, expected)
+    
+    def _watch(self):
+        check_every = max(self.threshold / 2, 0.005)
+        while not self._stop.wait(check_every):
+            expected = self._expected_wakeup
+            if time.monotonic() - expected < self.threshold:
+                continue
+            # Novo bloqueio: descarta amostras de um heartbeat anterior
+            if self._samples_for != expected:
+                self._samples = []
+                self._samples_for = expected
+            if len(self._samples) >= self.max_samples:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self._samples.append(_describe(frame))
+            del frame
+    
+    def _report(self, lag: float, expected: float):
+        samples = self._samples if self._samples_for == expected else []
+        self._samples = []
+        lag_ms = round(lag * 1000, 1)
+        self.stats["blocks"] += 1
+        self.stats["max_lag_ms"] = max(self.stats["max_lag_ms"], lag_ms)
+        event_loop_blocks_total.inc()
+        
+        if samples:
+            (stack, culprit), _ = Counter(samples).most_common(1)[0]
+        else:
+            # Bloqueio curto demais para a thread vigilante o apanhar
+            stack, culprit = (), "unknown (not sampled)"
+        
+        block = {
+            "lag_ms": lag_ms,
+            "culprit": culprit,
+            "samples": len(samples),
+            "at": time.time()
+        }
+        self.recent_blocks.append({**block, "stack": list(stack[-15:])})
+        gym_logger.warning(
+            f"Event loop blocked {lag_ms:.0f}ms in {culprit}",
+            stack=";".join(stack[-15:]),
+            **block
+        )
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            **self.stats,
+            "recent_blocks": list(self.recent_blocks)
+        }
+
+loop_watchdog = EventLoopWatchdog(
+    interval=float(os.getenv("LOOP_LAG_INTERVAL_MS", "100")) / 1000,
+    threshold=float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000
+)
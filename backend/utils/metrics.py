@@ -0,0 +1,433 @@
+"""
+KO Gym - Registo de métricas em processo
+Counters, gauges e histogramas de buckets fixos, expostos no formato de texto do Prometheus
+"""
+import asyncio
+import atexit
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Latências em segundos (requests HTTP, queries, funções)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+    
+    def __init__(self, lock: threading.Lock):
+        self.value = 0.0
+        self._lock = lock
+    
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+    
+    def snapshot(self):
+        return self.value
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+    
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+    
+    def set(self, value: float):
+        self.value = float(value)
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum", "_lock")
+    
+    def __init__(self, lock: threading.Lock, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        # Contagem por bucket (não cumulativa); o último é +Inf
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self._lock = lock
+    
+    def observe(self, value: float):
+        index = bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+    
+    def observe_ns(self, elapsed_ns: int):
+        """Duração de perf_counter_ns() em segundos"""
+        self.observe(elapsed_ns / 1e9)
+    
+    def snapshot(self):
+        with self._lock:
+            return [list(self.counts), self.sum]
+
+class Metric:
+    """Métrica com labels; sem labels, a própria métrica atua como o filho ()"""
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+    
+    def _new_child(self):
+        raise NotImplementedError
+    
+    def labels(self, *values) -> Any:
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+    
+    def describe(self) -> Dict[str, Any]:
+        return {"type": self.kind, "help": self.documentation, "labelnames": list(self.labelnames)}
+    
+    def samples(self) -> List[List[Any]]:
+        return [[list(key), child.snapshot()] for key, child in list(self._children.items())]
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def _new_child(self):
+        return _CounterChild(threading.Lock())
+    
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    """multiprocess_mode: como juntar os workers - "sum", "max", "min" ou "all" (label pid)"""
+    
+    kind = "gauge"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 multiprocess_mode: str = "sum"):
+        super().__init__(name, documentation, labelnames)
+        self.multiprocess_mode = multiprocess_mode
+    
+    def _new_child(self):
+        return _GaugeChild(threading.Lock())
+    
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+    
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+    
+    def set(self, value: float):
+        self.labels().set(value)
+    
+    def describe(self) -> Dict[str, Any]:
+        return {**super().describe(), "mode": self.multiprocess_mode}
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets if b != float("inf")))
+    
+    def _new_child(self):
+        return _HistogramChild(threading.Lock(), self.buckets)
+    
+    def observe(self, value: float):
+        self.labels().observe(value)
+    
+    def describe(self) -> Dict[str, Any]:
+        return {**super().describe(), "buckets": list(self.buckets)}
+    
+    def quantile(self, child: _HistogramChild, q: float) -> float:
+        """Estimativa por interpolação linear dentro do bucket (como histogram_quantile)"""
+        counts, _ = child.snapshot()
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if index >= len(self.buckets):
+                    # Bucket +Inf: o melhor limite conhecido é o último bucket finito
+                    return self.buckets[-1] if self.buckets else 0.0
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1] if self.buckets else 0.0
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class MetricsRegistry:
+    """Registo do processo, com agregação opcional entre workers
+    
+    Com multiproc_dir, cada worker grava periodicamente um snapshot JSON
+    (metrics_<pid>.json, escrita atómica) e o worker que atende /metrics junta
+    todos os ficheiros: counters e histogramas somam-se, gauges seguem o
+    multiprocess_mode. O diretório deve ser limpo em cada deploy.
+    """
+    
+    def __init__(self, multiproc_dir: Optional[str] = None, flush_interval: float = 5.0,
+                 stale_gauge_seconds: float = 60.0):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+        self.multiproc_dir = multiproc_dir
+        self.flush_interval = flush_interval
+        self.stale_gauge_seconds = stale_gauge_seconds
+        self._flusher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        if multiproc_dir:
+            os.makedirs(multiproc_dir, exist_ok=True)
+    
+    def _get_or_create(self, cls, name: str, *args, **kwargs) -> Metric:
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = cls(name, *args, **kwargs)
+                    self._metrics[name] = metric
+        if not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} already registered as {metric.kind}")
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+    
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              multiprocess_mode: str = "sum") -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames, multiprocess_mode=multiprocess_mode)
+    
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            name: {**metric.describe(), "samples": metric.samples()}
+            for name, metric in list(self._metrics.items())
+        }
+    
+    # --- Multi-worker -------------------------------------------------------
+    
+    def _snapshot_path(self, pid: Optional[int] = None) -> str:
+        return os.path.join(self.multiproc_dir, f"metrics_{pid or os.getpid()}.json")
+    
+    def write_snapshot(self):
+        """Grava o snapshot deste worker (tmp + rename, os leitores nunca veem meio ficheiro)"""
+        if not self.multiproc_dir:
+            return
+        path = self._snapshot_path()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"pid": os.getpid(), "written_at": time.time(), "metrics": self.snapshot()}, f)
+        os.replace(tmp_path, path)
+    
+    def start_flusher(self):
+        """Thread que grava o snapshot a cada flush_interval (idempotente, só com multiproc_dir)"""
+        if not self.multiproc_dir or (self._flusher and self._flusher.is_alive()):
+            return
+        
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                try:
+                    self.write_snapshot()
+                except OSError:
+                    pass
+        
+        self._stop.clear()
+        self._flusher = threading.Thread(target=run, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+    
+    def stop_flusher(self):
+        self._stop.set()
+        if self.multiproc_dir:
+            try:
+                self.write_snapshot()
+            except OSError:
+                pass
+    
+    def _collect(self) -> Dict[str, Any]:
+        if not self.multiproc_dir:
+            return {name: {**data, "samples": [(tuple(l), v) for l, v in data["samples"]]}
+                    for name, data in self.snapshot().items()}
+        
+        self.write_snapshot()
+        now = time.time()
+        merged: Dict[str, Any] = {}
+        for path in glob.glob(os.path.join(self.multiproc_dir, "metrics_*.json")):
+            try:
+                with open(path) as f:
+                    worker = json.load(f)
+            except (OSError, ValueError):
+                continue
+            stale = now - worker.get("written_at", 0) > self.stale_gauge_seconds
+            
+            for name, data in worker["metrics"].items():
+                target = merged.setdefault(name, {**data, "samples": {}})
+                samples = target["samples"]
+                kind = data["type"]
+                mode = data.get("mode", "sum")
+                
+                for labels, value in data["samples"]:
+                    key = tuple(labels)
+                    if kind == "histogram":
+                        current = samples.get(key)
+                        if current is None or len(current[0]) != len(value[0]):
+                            samples[key] = [list(value[0]), value[1]]
+                        else:
+                            current[0] = [a + b for a, b in zip(current[0], value[0])]
+                            current[1] += value[1]
+                    elif kind == "gauge":
+                        if stale:
+                            continue
+                        if mode == "all":
+                            samples[key + (str(worker["pid"]),)] = value
+                        elif key not in samples:
+                            samples[key] = value
+                        elif mode == "max":
+                            samples[key] = max(samples[key], value)
+                        elif mode == "min":
+                            samples[key] = min(samples[key], value)
+                        else:
+                            samples[key] += value
+                    else:
+                        samples[key] = samples.get(key, 0.0) + value
+        
+        for data in merged.values():
+            if data["type"] == "gauge" and data.get("mode") == "all":
+                data["labelnames"] = data["labelnames"] + ["pid"]
+            data["samples"] = sorted(data["samples"].items())
+        return merged
+    
+    def render(self) -> str:
+        """Formato de texto do Prometheus (0.0.4)"""
+        lines = []
+        for name, data in sorted(self._collect().items()):
+            labelnames = data["labelnames"]
+            lines.append(f"# HELP {name} {data['help']}")
+            lines.append(f"# TYPE {name} {data['type']}")
+            
+            for labels, value in data["samples"]:
+                if data["type"] == "histogram":
+                    counts, total = value
+                    cumulative = 0
+                    for bound, count in zip(list(data["buckets"]) + [float("inf")], counts):
+                        cumulative += count
+                        le = _format_labels(labelnames, labels, ("le", _format_value(bound)))
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    label_str = _format_labels(labelnames, labels)
+                    lines.append(f"{name}_sum{label_str} {_format_value(total)}")
+                    lines.append(f"{name}_count{label_str} {cumulative}")
+                else:
+                    lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics_registry = MetricsRegistry(
+    multiproc_dir=os.getenv("METRICS_MULTIPROC_DIR") or None,
+    flush_interval=float(os.getenv("METRICS_FLUSH_SECONDS", "5")),
+    stale_gauge_seconds=float(os.getenv("METRICS_STALE_GAUGE_SECONDS", "60"))
+)
+
+atexit.register(metrics_registry.stop_flusher)
+
+# Métricas HTTP (alimentadas pelo LoggingMiddleware)
+http_requests_total = metrics_registry.counter(
+    "http_requests_total", "Total de requests HTTP", ("method", "route", "status")
+)
+http_request_duration_seconds = metrics_registry.histogram(
+    "http_request_duration_seconds", "Latência dos requests HTTP (até ao fim da resposta)", ("method", "route")
+)
+http_requests_in_progress = metrics_registry.gauge(
+    "http_requests_in_progress", "Requests HTTP em curso", ("method",)
+)
+
+# Funções instrumentadas com @timed
+# Buckets mais finos que os HTTP: os percentis são interpolados dentro de cada bucket
+FUNCTION_BUCKETS = (
+    0.0005, 0.001, 0.002, 0.003, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075,
+    0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0, 10.0
+)
+
+function_duration_seconds = metrics_registry.histogram(
+    "function_duration_seconds", "Duração das funções instrumentadas com @timed", ("function",),
+    buckets=FUNCTION_BUCKETS
+)
+
+TIMING_ENABLED = os.getenv("TIMING_ENABLED", "true").lower() not in ("0", "false", "no")
+
+def timed(name=None):
+    """Decorador que agrega a duração da função no histograma function_duration_seconds
+    
+    Funciona em funções sync e async (nas coroutines mede até ao fim do await).
+    Com TIMING_ENABLED=false devolve a função original: custo zero.
+    Uso: @timed, @timed() ou @timed("nome.personalizado")
+    """
+    if callable(name):
+        return timed()(name)
+    
+    def decorator(func):
+        if not TIMING_ENABLED:
+            return func
+        child = function_duration_seconds.labels(name or func.__qualname__)
+        perf_counter_ns = time.perf_counter_ns
+        
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = perf_counter_ns()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    child.observe_ns(perf_counter_ns() - start)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe_ns(perf_counter_ns() - start)
+        return wrapper
+    return decorator
+
+def timing_summary() -> Dict[str, Dict[str, float]]:
+    """count, soma e p50/p95/p99 (ms) por função, neste worker"""
+    summary = {}
+    for (function,), child in sorted(function_duration_seconds._children.items()):
+        count, total = sum(child.counts), child.sum
+        if not count:
+            continue
+        summary[function] = {
+            "count": count,
+            "sum_ms": round(total * 1000, 2),
+            "avg_ms": round(total * 1000 / count, 3),
+            **{
+                f"p{int(q * 100)}_ms": round(function_duration_seconds.quantile(child, q) * 1000, 3)
+                for q in (0.50, 0.95, 0.99)
+            }
+        }
+    return summary
@@ -0,0 +1,125 @@
+"""
+KO Gym - Hashing de passwords fora do event loop
+Pool limitado de threads para bcrypt, com métricas de fila e rehash no login
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+import bcrypt
+from fastapi import HTTPException
+
+class PasswordHasher:
+    """bcrypt num ThreadPoolExecutor (o bcrypt liberta o GIL enquanto calcula)
+    
+    Usa o módulo bcrypt diretamente: o passlib 1.7.4 falha no auto-teste com bcrypt 5.x.
+    
+    - max_workers limita o CPU gasto em hashing em simultâneo
+    - max_pending limita a fila: acima disso responde 503 em vez de acumular logins
+    - hashes SHA256 antigos (64 hex) e hashes bcrypt com outro custo são
+      devolvidos como novo hash após um login válido, para o chamador gravar
+    """
+    
+    def __init__(self, rounds: int = 12, max_workers: int = 4, max_pending: int = 64):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._queue_ms = deque(maxlen=1000)
+        self.stats = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected_busy": 0, "max_queue_ms": 0.0}
+    
+    @staticmethod
+    def _encode(password: str) -> bytes:
+        # Bcrypt has a 72 byte limit, truncate if necessary
+        return password.encode('utf-8')[:72]
+    
+    def hash_sync(self, password: str) -> str:
+        return bcrypt.hashpw(self._encode(password), bcrypt.gensalt(rounds=self.rounds)).decode()
+    
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """Hash bcrypt com custo diferente de BCRYPT_ROUNDS ($2b$<custo>$...)"""
+        parts = hashed_password.split("$")
+        return len(parts) < 3 or not parts[2].isdigit() or int(parts[2]) != self.rounds
+    
+    def verify_sync(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """(válida, novo_hash); novo_hash só quando o hash guardado deve ser atualizado"""
+        if len(hashed_password) == 64:  # SHA256 hash length (legado)
+            digest = hashlib.sha256(password.encode()).hexdigest()
+            if hmac.compare_digest(digest, hashed_password):
+                return True, self.hash_sync(password)
+            return False, None
+        
+        try:
+            if not bcrypt.checkpw(self._encode(password), hashed_password.encode()):
+                return False, None
+        except (ValueError, TypeError):
+            return False, None
+        return True, self.hash_sync(password) if self.needs_rehash(hashed_password) else None
+    
+    async def _run(self, func: Callable, *args) -> Any:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.stats["rejected_busy"] += 1
+                raise HTTPException(status_code=503, detail="Servidor ocupado, tente novamente")
+            self._pending += 1
+        
+        submitted = time.perf_counter()
+        
+        def job():
+            queue_ms = (time.perf_counter() - submitted) * 1000
+            self._queue_ms.append(queue_ms)
+            if queue_ms > self.stats["max_queue_ms"]:
+                self.stats["max_queue_ms"] = round(queue_ms, 2)
+            return func(*args)
+        
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+        finally:
+            with self._lock:
+                self._pending -= 1
+    
+    async def hash(self, password: str) -> str:
+        result = await self._run(self.hash_sync, password)
+        self.stats["hashed"] += 1
+        return result
+    
+    async def verify(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        valid, new_hash = await self._run(self.verify_sync, password, hashed_password)
+        self.stats["verified"] += 1
+        if new_hash:
+            self.stats["rehashed"] += 1
+        return valid, new_hash
+    
+    def get_stats(self) -> Dict[str, Any]:
+        samples = sorted(self._queue_ms)
+        
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0.0
+            return round(samples[min(int(len(samples) * p), len(samples) - 1)], 2)
+        
+        return {
+            "bcrypt_rounds": self.rounds,
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "queue_ms_p50": percentile(0.50),
+            "queue_ms_p95": percentile(0.95),
+            **self.stats
+        }
+    
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+password_hasher = PasswordHasher(
+    rounds=int(os.getenv("BCRYPT_ROUNDS", "12")),
+    max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    max_pending=int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+)
@@ -0,0 +1,138 @@
+"""
+KO Gym - Profiler por amostragem em processo
+Stacks de todas as threads (sys._current_frames) e das tasks asyncio, em formato collapsed
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+class ProfilerBusy(Exception):
+    """Já existe uma sessão de profiling a decorrer"""
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _thread_stack(frame, max_depth: int) -> List[str]:
+    stack = []
+    while frame is not None and len(stack) < max_depth:
+        stack.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _task_stack(task: asyncio.Task, max_depth: int) -> List[str]:
+    """Cadeia de awaits da task, da coroutine raiz até onde está suspensa"""
+    stack = []
+    coro = task.get_coro()
+    while coro is not None and len(stack) < max_depth:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(_frame_label(frame.f_code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return stack
+
+class SamplingProfiler:
+    """Profiler de amostragem numa thread de fundo, uma sessão de cada vez
+    
+    - cada amostra lê sys._current_frames() (stacks on-CPU de todas as threads)
+    - a cada task_every amostras lê também as tasks do event loop (onde estão à espera)
+    - overhead limitado: se uma amostra custar mais do que max_overhead do intervalo,
+      o intervalo seguinte é alargado
+    - o resultado está em formato collapsed ("raiz;...;folha contagem"), pronto para
+      flamegraph.pl / speedscope
+    """
+    
+    def __init__(self, interval: float = 0.01, max_seconds: float = 60.0, max_depth: int = 64,
+                 task_every: int = 5, max_overhead: float = 0.05):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self.task_every = task_every
+        self.max_overhead = max_overhead
+        self._session_lock = threading.Lock()
+        self.last_session: Optional[Dict[str, Any]] = None
+    
+    @property
+    def running(self) -> bool:
+        return self._session_lock.locked()
+    
+    def profile(self, seconds: float, loop: Optional[asyncio.AbstractEventLoop] = None) -> Dict[str, Any]:
+        """Bloqueia durante a sessão (correr fora do event loop); ProfilerBusy se já houver uma"""
+        if not self._session_lock.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            return self._run(min(max(seconds, 0.1), self.max_seconds), loop)
+        finally:
+            self._session_lock.release()
+    
+    def _run(self, seconds: float, loop: Optional[asyncio.AbstractEventLoop]) -> Dict[str, Any]:
+        stacks: Counter = Counter()
+        own_thread = threading.get_ident()
+        samples = task_samples = 0
+        sampling_time = 0.0
+        started = time.perf_counter()
+        deadline = started + seconds
+        
+        while True:
+            sample_start = time.perf_counter()
+            if sample_start >= deadline:
+                break
+            
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = _thread_stack(frame, self.max_depth)
+                if stack:
+                    stacks[";".join([f"thread:{names.get(thread_id, thread_id)}"] + stack)] += 1
+            
+            if loop is not None and samples % self.task_every == 0:
+                try:
+                    # Leitura entre threads: o conjunto de tasks pode mudar a meio da iteração
+                    tasks = list(asyncio.all_tasks(loop))
+                except RuntimeError:
+                    tasks = []
+                for task in tasks:
+                    stack = _task_stack(task, self.max_depth)
+                    if stack:
+                        stacks[";".join(["asyncio-tasks"] + stack)] += 1
+                task_samples += 1
+            
+            samples += 1
+            cost = time.perf_counter() - sample_start
+            sampling_time += cost
+            time.sleep(max(self.interval - cost, cost / self.max_overhead - cost, 0.0))
+        
+        elapsed = time.perf_counter() - started
+        self.last_session = {
+            "seconds": round(elapsed, 2),
+            "samples": samples,
+            "task_samples": task_samples,
+            "interval_ms": self.interval * 1000,
+            "overhead_pct": round(sampling_time / elapsed * 100, 2) if elapsed else 0.0,
+            "finished_at": time.time()
+        }
+        return {**self.last_session, "stacks": stacks}
+    
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "max_seconds": self.max_seconds,
+            "last_session": self.last_session
+        }
+
+sampling_profiler = SamplingProfiler(
+    interval=float(os.getenv("PROFILER_INTERVAL_MS", "10")) / 1000,
+    max_seconds=float(os.getenv("PROFILER_MAX_SECONDS", "60")),
+    max_overhead=float(os.getenv("PROFILER_MAX_OVERHEAD", "0.05"))
+)
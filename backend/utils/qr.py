@@ -0,0 +1,152 @@
+"""
+KO Gym - Payload dos QR codes de check-in
+Formato compacto assinado (KO1) verificável sem ir à base de dados,
+e leitura dos formatos antigos durante a migração
+"""
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+PREFIX = "KO1:"
+TAG_BYTES = 10  # 80 bits de HMAC-SHA256, 16 caracteres em base32
+
+class InvalidQRCode(ValueError):
+    """QR code ilegível ou com assinatura inválida"""
+
+@dataclass(frozen=True)
+class QRPayload:
+    member_id: Optional[str]
+    member_number: Optional[str]
+    signed: bool
+
+def _b32encode(data: bytes) -> str:
+    return base64.b32encode(data).decode().rstrip("=")
+
+def _b32decode(text: str) -> bytes:
+    return base64.b32decode(text + "=" * (-len(text) % 8))
+
+def _is_uuid(value: str) -> bool:
+    try:
+        return str(uuid.UUID(value)) == value
+    except ValueError:
+        return False
+
+class QRCodec:
+    """KO1:<número>.<id base32>.<tag base32>
+    
+    - só maiúsculas, dígitos, ":" e "." -> modo alfanumérico do QR (módulos mais pequenos)
+    - o id UUID vai nos seus 16 bytes (26 caracteres); outros ids vão em UTF-8
+    - a tag é o HMAC do resto do payload: verificar é local e em tempo constante
+    - parse() aceita também os formatos antigos ("001-<uuid>", "MEMBER:...", só o id),
+      devolvidos com signed=False
+    """
+    
+    def __init__(self, secret: str):
+        self._key = secret.encode()
+        self.stats = {"signed": 0, "legacy": 0, "invalid": 0}
+    
+    def _tag(self, body: str) -> str:
+        return _b32encode(hmac.new(self._key, body.encode(), hashlib.sha256).digest()[:TAG_BYTES])
+    
+    def encode(self, member_number: str, member_id: str) -> str:
+        id_bytes = uuid.UUID(member_id).bytes if _is_uuid(member_id) else member_id.encode()
+        body = f"{PREFIX}{member_number}.{_b32encode(id_bytes)}"
+        return f"{body}.{self._tag(body)}"
+    
+    def _decode_signed(self, data: str) -> QRPayload:
+        body, _, tag = data.rpartition(".")
+        number, _, encoded_id = body[len(PREFIX):].partition(".")
+        # Bytes: compare_digest recusa str com caracteres não ASCII (TypeError -> 500)
+        expected = self._tag(body).encode()
+        if not number or not encoded_id or not hmac.compare_digest(tag.encode(errors="replace"), expected):
+            raise InvalidQRCode("Invalid QR code signature")
+        try:
+            id_bytes = _b32decode(encoded_id)
+            member_id = str(uuid.UUID(bytes=id_bytes)) if len(id_bytes) == 16 else id_bytes.decode()
+        except ValueError:
+            raise InvalidQRCode("Invalid QR code format")
+        return QRPayload(member_id=member_id, member_number=number, signed=True)
+    
+    @staticmethod
+    def _decode_legacy(data: str) -> QRPayload:
+        if data.startswith("MEMBER:"):
+            data = data[len("MEMBER:"):]
+        if _is_uuid(data):
+            return QRPayload(member_id=data, member_number=None, signed=False)
+        # "<número>-<uuid>": o UUID também tem hífens, só o primeiro separa
+        number, _, member_id = data.partition("-")
+        if not number.isdigit():
+            raise InvalidQRCode("Invalid QR code format")
+        return QRPayload(member_id=member_id or None, member_number=number, signed=False)
+    
+    def parse(self, data: str) -> QRPayload:
+        data = (data or "").strip()
+        try:
+            if data.upper().startswith(PREFIX):
+                payload = self._decode_signed(data.upper())
+            else:
+                payload = self._decode_legacy(data)
+        except InvalidQRCode:
+            self.stats["invalid"] += 1
+            raise
+        self.stats["signed" if payload.signed else "legacy"] += 1
+        return payload
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self.stats)
+
+class MemberNumberCache:
+    """LRU número de sócio -> id
+    
+    Os números não mudam depois de atribuídos, por isso não há TTL; só os
+    resultados positivos ficam em cache (um número novo resolve-se à primeira).
+    """
+    
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.collection = None
+        self._ids: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+    
+    def attach(self, db):
+        self.collection = db.members
+    
+    def put(self, member_number: str, member_id: str):
+        with self._lock:
+            self._ids[member_number] = member_id
+            self._ids.move_to_end(member_number)
+            if len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+    
+    def invalidate(self, member_number: str):
+        with self._lock:
+            self._ids.pop(member_number, None)
+    
+    async def resolve(self, member_number: str) -> Optional[str]:
+        with self._lock:
+            member_id = self._ids.get(member_number)
+            if member_id is not None:
+                self._ids.move_to_end(member_number)
+                self.stats["hits"] += 1
+                return member_id
+            self.stats["misses"] += 1
+        
+        member = await self.collection.find_one({"member_number": member_number}, {"_id": 0, "id": 1})
+        if member is None:
+            return None
+        self.put(member_number, member["id"])
+        return member["id"]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {"size": len(self._ids), "max_size": self.max_size, **self.stats}
+
+member_number_cache = MemberNumberCache(
+    max_size=int(os.getenv("MEMBER_NUMBER_CACHE_SIZE", "10000"))
+)
@@ -6,88 +6,282 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from fastapi import Request, HTTPException
-from typing import Dict, Any
+from fastapi.responses import JSONResponse
+from typing import Awaitable, Dict, Any, Callable, Iterable, List, NamedTuple, Optional, Tuple
+from functools import lru_cache, wraps
+import contextvars
+import inspect
+import ipaddress
+import json
+import os
+import re
+import socket
 import time
+from collections import OrderedDict
 from datetime import datetime, timezone
 from .logger import gym_logger
+from .abuse_store import create_abuse_store, KEY_PREFIX
+from .cache import LocalCacheTier, _MISSING
+from .token_bucket import create_token_buckets, parse_rate
+
+def parse_trusted_proxies(value: str) -> List["ipaddress._BaseNetwork"]:
+    """Lista de CIDRs separados por vírgula (ex.: "10.0.0.0/8,127.0.0.1/32")"""
+    networks = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            gym_logger.warning(f"Invalid TRUSTED_PROXIES entry ignored: {item}")
+    return networks
+
+# Só proxies nestas redes podem definir X-Forwarded-For / X-Real-IP
+TRUSTED_PROXIES = parse_trusted_proxies(os.getenv("TRUSTED_PROXIES", "127.0.0.1/32,::1/128"))
+
+# (família, rede, máscara) como inteiros: evita ipaddress.ip_address por request
+_TRUSTED_RANGES: Dict[int, List[Tuple[int, int]]] = {socket.AF_INET: [], socket.AF_INET6: []}
+for _network in TRUSTED_PROXIES:
+    _family = socket.AF_INET if _network.version == 4 else socket.AF_INET6
+    _TRUSTED_RANGES[_family].append((int(_network.network_address), int(_network.netmask)))
+
+@lru_cache(maxsize=4096)
+def is_trusted_proxy(ip: str) -> bool:
+    family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+    ranges = _TRUSTED_RANGES[family]
+    if not ranges:
+        return False
+    try:
+        value = int.from_bytes(socket.inet_pton(family, ip.split("%", 1)[0]), "big")
+    except (OSError, ValueError):
+        return False
+    return any(value & mask == network for network, mask in ranges)
+
+def resolve_client_ip(peer: Optional[str], forwarded_for: Optional[str], real_ip: Optional[str]) -> str:
+    """IP real do cliente sem confiar em headers enviados por quem não é proxy
+    
+    O X-Forwarded-For é lido da direita para a esquerda: cada proxy confiável
+    acrescenta o IP que viu, por isso o primeiro IP não confiável é o cliente.
+    """
+    if not peer:
+        return "unknown"
+    if not is_trusted_proxy(peer):
+        return peer
+    
+    if forwarded_for:
+        hops = forwarded_for.split(",")
+        for hop in reversed(hops):
+            hop = hop.strip()
+            if hop and not is_trusted_proxy(hop):
+                return hop
+        # Cadeia só com proxies confiáveis: o mais à esquerda é a origem
+        first = hops[0].strip()
+        if first:
+            return first
+    
+    if real_ip:
+        return real_ip.strip()
+    return peer
+
+def client_ip_from_scope(scope) -> str:
+    """Resolve o IP do cliente diretamente do scope ASGI (sem construir Request)"""
+    state = scope.get("state")
+    if state and "client_ip" in state:
+        return state["client_ip"]
+    
+    client = scope.get("client")
+    peer = client[0] if client else None
+    forwarded_for = None
+    real_ip = None
+    if peer and is_trusted_proxy(peer):
+        for name, value in scope.get("headers", ()):
+            if name == b"x-forwarded-for":
+                # Vários headers equivalem a uma lista separada por vírgulas
+                decoded = value.decode("latin-1")
+                forwarded_for = f"{forwarded_for},{decoded}" if forwarded_for else decoded
+            elif name == b"x-real-ip":
+                real_ip = value.decode("latin-1")
+    return resolve_client_ip(peer, forwarded_for, real_ip)
+
+def resolve_storage_uri(value: str) -> str:
+    """RATE_LIMIT_STORAGE_URI: "memory", "redis" (usa REDIS_URL) ou um URI do limits"""
+    value = value.strip()
+    if value in ("", "memory"):
+        return "memory://"
+    if value == "redis":
+        return os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    return value
+
+# Estratégia por categoria: moving-window é exato mas guarda um timestamp por hit;
+# fixed-window custa um INCR mas permite 2x o limite na fronteira da janela
+RATE_LIMIT_STRATEGIES = {
+    "auth": os.getenv("RATE_LIMIT_STRATEGY_AUTH", "moving-window"),
+    "api": os.getenv("RATE_LIMIT_STRATEGY_API", "fixed-window"),
+    "dashboard": os.getenv("RATE_LIMIT_STRATEGY_DASHBOARD", "fixed-window"),
+    "write": os.getenv("RATE_LIMIT_STRATEGY_WRITE", "fixed-window"),
+    "upload": os.getenv("RATE_LIMIT_STRATEGY_UPLOAD", "fixed-window"),
+    "mobile": os.getenv("RATE_LIMIT_STRATEGY_MOBILE", "sliding-window-counter"),
+    "member_login": os.getenv("RATE_LIMIT_STRATEGY_MEMBER_LOGIN", "sliding-window-counter")
+}
+
+def _ip_rate_limit_key(request: Request) -> str:
+    """key_func do slowapi (IP resolvido com proxies confiáveis)"""
+    return client_ip_from_scope(request.scope)
+
+# O slowapi chama inspect.signature(key_func) em cada request; com __signature__
+# pré-calculado essa chamada deixa de reconstruir a assinatura
+_ip_rate_limit_key.__signature__ = inspect.signature(_ip_rate_limit_key)
 
 class GymRateLimiter:
     """Sistema de Rate Limiting inteligente para o KO Gym"""
     
     def __init__(self):
-        # Limiter principal usando IP
-        self.limiter = Limiter(key_func=get_remote_address)
+        # Limiters por IP (mesma resolução de proxies do middleware), um por estratégia
+        self.storage_uri = resolve_storage_uri(os.getenv("RATE_LIMIT_STORAGE_URI", "memory"))
+        self._limiters: Dict[str, Limiter] = {}
+        self.limiter = self.limiter_for_strategy(os.getenv("RATE_LIMIT_STRATEGY", "fixed-window"))
+        
+        # Tentativas falhadas e bloqueios partilhados entre workers (Redis ou local)
+        self.abuse_store = create_abuse_store()
         
-        # Cache para tracking de usuários suspeitos
-        self.suspicious_ips = {}
-        self.blocked_ips = {}
+        # Token buckets por utilizador/membro autenticado
+        self.token_buckets = create_token_buckets()
+        self._token_decoder: Optional[Callable[[str], Dict[str, Any]]] = None
+        self._active_check: Optional[Callable[["Principal"], Awaitable[bool]]] = None
+        self._principal_cache = LocalCacheTier(max_items=10000, ttl_seconds=60)
         
         # Configurações
         self.max_failed_attempts = 5
         self.block_duration = 900  # 15 minutos
+        self.failure_window = 86400  # tentativas contam durante 24h
         
     def get_client_ip(self, request: Request) -> str:
-        """Extrai IP do cliente considerando proxies"""
-        # Headers comuns de proxy
-        forwarded_for = request.headers.get("X-Forwarded-For")
-        if forwarded_for:
-            return forwarded_for.split(",")[0].strip()
+        """Extrai IP do cliente considerando apenas proxies confiáveis"""
+        return client_ip_from_scope(request.scope)
+    
+    def limiter_for_strategy(self, strategy: str) -> Limiter:
+        """Limiter do slowapi para a estratégia (fixed-window, moving-window, sliding-window-counter)"""
+        limiter = self._limiters.get(strategy)
+        if limiter is None:
+            limiter = Limiter(
+                key_func=_ip_rate_limit_key,
+                storage_uri=self.storage_uri,
+                strategy=strategy,
+                key_prefix=f"{KEY_PREFIX}:slowapi",
+                # Redis em baixo: continua a limitar em memória em vez de falhar
+                in_memory_fallback_enabled=not self.storage_uri.startswith("memory://")
+            )
+            self._limiters[strategy] = limiter
+        return limiter
+    
+    def limiter_for(self, category: str) -> Limiter:
+        return self.limiter_for_strategy(RATE_LIMIT_STRATEGIES.get(category, self.limiter._strategy))
+    
+    def configure_token_decoder(self, decoder: Callable[[str], Dict[str, Any]],
+                                active_check: Optional[Callable[["Principal"], Awaitable[bool]]] = None):
+        """Define como validar o JWT (a chave secreta vive no server.py)
+        
+        active_check: confirma que o dono do token continua ativo; só é usado antes
+        de um JWT contornar o bloqueio de IP (ver principal_is_active)
+        """
+        self._token_decoder = decoder
+        self._active_check = active_check
+        self._principal_cache.clear()
+    
+    async def principal_is_active(self, principal: "Principal") -> bool:
+        """Utilizador/membro do token ainda ativo (sem active_check, a assinatura basta)
+        
+        Um token assinado continua válido até expirar mesmo depois de o utilizador ser
+        desativado; para contornar um bloqueio de IP isso não chega. Falha fechado.
+        """
+        if self._active_check is None:
+            return True
+        try:
+            return bool(await self._active_check(principal))
+        except Exception as e:
+            gym_logger.error("Principal active check failed", error=e, user_id=principal.id)
+            return False
+    
+    def resolve_principal(self, request: Request) -> "Principal":
+        """Quem faz o request: JWT validado, member_id do app móvel ou IP"""
+        state = request.scope.setdefault("state", {})
+        principal = state.get("principal")
+        if principal is not None:
+            return principal
+        
+        principal = None
+        authorization = request.headers.get("authorization")
+        if authorization and self._token_decoder and authorization[:7].lower() == "bearer ":
+            principal = self._principal_from_token(authorization[7:].strip())
+        
+        if principal is None and "/mobile/" in request.url.path:
+            member_id = request.path_params.get("member_id") or request.query_params.get("member_id")
+            if member_id:
+                # Não autenticado: bucket próprio, mas continua sujeito ao limite por IP
+                principal = Principal("member", member_id, "member", False)
         
-        real_ip = request.headers.get("X-Real-IP")
-        if real_ip:
-            return real_ip
+        if principal is None:
+            principal = Principal("ip", self.get_client_ip(request), "anonymous", False)
         
-        # Fallback para IP direto
-        return request.client.host if request.client else "unknown"
+        state["principal"] = principal
+        return principal
+    
+    def _principal_from_token(self, token: str) -> Optional["Principal"]:
+        cached = self._principal_cache.get(token)
+        if cached is not _MISSING:
+            return cached
+        try:
+            payload = self._token_decoder(token)
+        except Exception:
+            payload = None
+        
+        principal = None
+        ttl = None
+        if payload and payload.get("sub"):
+            # Tokens antigos não têm role: só admin/staff recebiam token
+            role = payload.get("role") or "staff"
+            kind = "member" if role == "member" else "user"
+            principal = Principal(kind, str(payload["sub"]), role, True)
+            # Nunca em cache para lá do exp: um token expirado não mantém o principal
+            if isinstance(payload.get("exp"), (int, float)):
+                ttl = payload["exp"] - time.time()
+        self._principal_cache.set(token, principal, ttl)
+        return principal
+    
+    def take_token(self, principal: "Principal", category: str) -> Tuple[bool, float]:
+        """Consome um token do bucket do principal para a categoria"""
+        role_limits = ROLE_RATE_LIMITS.get(principal.role, ROLE_RATE_LIMITS["anonymous"])
+        capacity, rate_per_second = _parsed_rate(role_limits.get(category, role_limits["api"]))
+        return self.token_buckets.take(
+            f"{category}:{principal.kind}:{principal.id}", capacity, rate_per_second
+        )
     
     def is_ip_blocked(self, ip: str) -> bool:
         """Verifica se IP está bloqueado"""
-        if ip in self.blocked_ips:
-            block_time = self.blocked_ips[ip]
-            if time.time() - block_time < self.block_duration:
-                return True
-            else:
-                # Remover bloqueio expirado
-                del self.blocked_ips[ip]
-                if ip in self.suspicious_ips:
-                    del self.suspicious_ips[ip]
-        return False
+        return self.abuse_store.blocked_for(ip) > 0
     
     def record_failed_attempt(self, ip: str, endpoint: str = ""):
         """Registra tentativa de acesso falhada"""
-        current_time = time.time()
-        
-        if ip not in self.suspicious_ips:
-            self.suspicious_ips[ip] = []
-        
-        # Adicionar tentativa falhada
-        self.suspicious_ips[ip].append({
-            "timestamp": current_time,
-            "endpoint": endpoint
-        })
-        
-        # Remover tentativas antigas (últimas 24h)
-        day_ago = current_time - 86400
-        self.suspicious_ips[ip] = [
-            attempt for attempt in self.suspicious_ips[ip] 
-            if attempt["timestamp"] > day_ago
-        ]
+        result = self.abuse_store.record_failure(
+            ip, endpoint,
+            window_seconds=self.failure_window,
+            max_attempts=self.max_failed_attempts,
+            block_seconds=self.block_duration
+        )
         
         # Verificar se deve bloquear
-        if len(self.suspicious_ips[ip]) >= self.max_failed_attempts:
-            self.blocked_ips[ip] = current_time
-            
+        if result.blocked:
             gym_logger.security_event(
                 event_type="ip_blocked",
                 ip_address=ip,
-                failed_attempts=len(self.suspicious_ips[ip]),
-                endpoints_attempted=[a["endpoint"] for a in self.suspicious_ips[ip]]
+                failed_attempts=result.attempts,
+                endpoints_attempted=result.endpoints
             )
     
     def record_successful_attempt(self, ip: str):
         """Registra tentativa bem-sucedida (limpa suspeitas)"""
-        if ip in self.suspicious_ips:
-            del self.suspicious_ips[ip]
+        self.abuse_store.clear_failures(ip)
     
     async def check_request_limits(self, request: Request) -> bool:
         """Verifica limites de request"""
@@ -110,31 +304,82 @@ class GymRateLimiter:
 # Instância global do rate limiter
 gym_rate_limiter = GymRateLimiter()
 
-# Configurações de limite por endpoint
-RATE_LIMITS = {
-    # Autenticação - mais restritivo
-    "auth": "10/minute",
-    
-    # APIs gerais
-    "api": "100/minute", 
-    
-    # Dashboard (queries pesadas)
-    "dashboard": "30/minute",
-    
-    # Operações de escrita
-    "write": "50/minute",
-    
-    # Uploads
-    "upload": "20/minute"
+class Principal(NamedTuple):
+    """Chave de rate limiting: utilizador, membro ou IP anónimo"""
+    kind: str
+    id: str
+    role: str
+    verified: bool
+
+# Limites por role e categoria (token bucket: capacidade = burst, refill contínuo)
+# "anonymous" aplica-se por IP; os restantes por utilizador/membro autenticado
+ROLE_RATE_LIMITS = {
+    "admin": {
+        "auth": "10/minute",
+        "api": "300/minute",
+        "dashboard": "60/minute",
+        "write": "150/minute",
+        "upload": "40/minute",
+        "mobile": "120/minute"
+    },
+    "staff": {
+        "auth": "10/minute",
+        "api": "300/minute",
+        "dashboard": "60/minute",
+        "write": "150/minute",
+        "upload": "40/minute",
+        "mobile": "120/minute"
+    },
+    "member": {
+        "auth": "10/minute",
+        "api": "60/minute",
+        "dashboard": "10/minute",
+        "write": "30/minute",
+        "upload": "10/minute",
+        "mobile": "60/minute",
+        # Login do app por número de sócio (tentativas com o mesmo número)
+        "member_login": "10/minute"
+    },
+    "anonymous": {
+        # Autenticação - mais restritivo
+        "auth": "10/minute",
+        # APIs gerais
+        "api": "100/minute",
+        # Dashboard (queries pesadas)
+        "dashboard": "30/minute",
+        # Operações de escrita
+        "write": "50/minute",
+        # Uploads
+        "upload": "20/minute",
+        # App móvel: todos os membros no Wi-Fi do ginásio partilham o IP
+        "mobile": "600/minute",
+        # Teto por IP do login do app (o limite apertado é por número de sócio)
+        "member_login": "300/minute"
+    }
 }
 
+@lru_cache(maxsize=64)
+def _parsed_rate(rate: str) -> Tuple[int, float]:
+    return parse_rate(rate)
+
+# Principal do request em curso, lido pelo exempt_when do slowapi
+_current_principal: contextvars.ContextVar[Optional[Principal]] = contextvars.ContextVar(
+    "rate_limit_principal", default=None
+)
+
+def _exempt_from_ip_limit() -> bool:
+    """Principals autenticados usam o seu bucket em vez do limite por IP"""
+    principal = _current_principal.get()
+    return principal is not None and principal.verified
+
 def create_rate_limit_handler():
     """Cria handler personalizado para rate limit exceeded"""
     async def rate_limit_handler(request: Request, exc: RateLimitExceeded):
         ip = gym_rate_limiter.get_client_ip(request)
         endpoint = str(request.url.path)
         
-        # Log do evento
+        # Log do evento; não conta como tentativa falhada (só logins errados e o
+        # SecurityAnalyzer levam a bloqueio do IP, throttling normal não)
         gym_logger.security_event(
             event_type="rate_limit_exceeded",
             ip_address=ip,
@@ -142,82 +387,299 @@ def create_rate_limit_handler():
             limit=str(exc.detail)
         )
         
-        # Registrar como tentativa suspeita se muitas rate limits
-        gym_rate_limiter.record_failed_attempt(ip, endpoint)
-        
-        return HTTPException(
+        return JSONResponse(
             status_code=429,
-            detail={
-                "error": "Rate limit exceeded",
-                "message": "Muitas requests. Tente novamente em alguns minutos.",
-                "retry_after": 60
-            }
+            content={
+                "detail": {
+                    "error": "Rate limit exceeded",
+                    "message": "Muitas requests. Tente novamente em alguns minutos.",
+                    "retry_after": 60
+                }
+            },
+            headers={"Retry-After": "60"}
         )
     
     return rate_limit_handler
 
+# Resposta de bloqueio pré-codificada (o middleware corre em todos os requests)
+_BLOCKED_BODY = json.dumps(
+    {"detail": "IP temporariamente bloqueado devido a atividade suspeita"}
+).encode()
+_BLOCKED_HEADERS = [
+    (b"content-type", b"application/json"),
+    (b"content-length", str(len(_BLOCKED_BODY)).encode()),
+]
+
 # Middleware para checking automático
 class RateLimitMiddleware:
-    """Middleware para rate limiting automático"""
+    """Middleware ASGI puro: lê o IP dos headers crus e recusa IPs bloqueados"""
     
     def __init__(self, app):
         self.app = app
     
     async def __call__(self, scope, receive, send):
         if scope["type"] == "http":
-            # Criar request fake para verificar IP
-            from fastapi import Request
-            request = Request(scope, receive)
+            ip = client_ip_from_scope(scope)
+            # Partilhado com os handlers via request.state.client_ip
+            scope.setdefault("state", {})["client_ip"] = ip
             
-            try:
-                await gym_rate_limiter.check_request_limits(request)
-            except HTTPException as e:
-                # Enviar resposta de erro
-                response = {
+            blocked_for = gym_rate_limiter.abuse_store.blocked_for(ip)
+            # Um JWT válido de um utilizador ativo nunca é bloqueado pelo IP
+            # (staff atrás do mesmo NAT de um abusador)
+            if blocked_for > 0 and not await self._bypasses_ip_block(scope):
+                gym_logger.security_event(
+                    event_type="blocked_ip_attempt",
+                    ip_address=ip,
+                    endpoint=scope.get("path", "")
+                )
+                await send({
                     "type": "http.response.start",
-                    "status": e.status_code,
-                    "headers": [[b"content-type", b"application/json"]]
-                }
-                await send(response)
-                
-                body = {
-                    "type": "http.response.body",
-                    "body": f'{{"detail": "{e.detail}"}}'.encode()
-                }
-                await send(body)
+                    "status": 429,
+                    "headers": _BLOCKED_HEADERS + [(b"retry-after", str(int(blocked_for) + 1).encode())]
+                })
+                await send({"type": "http.response.body", "body": _BLOCKED_BODY})
                 return
+            
+            status_holder = [500]
+            
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    status_holder[0] = message["status"]
+                await send(message)
+            
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                self._observe(scope, ip, status_holder[0])
+            return
         
         await self.app(scope, receive, send)
+    
+    @staticmethod
+    async def _bypasses_ip_block(scope) -> bool:
+        """Só corre para IPs bloqueados: JWT válido e dono ativo; guarda o principal para o resto do request"""
+        for name, value in scope.get("headers", ()):
+            if name == b"authorization":
+                token = value.decode("latin-1")
+                if token[:7].lower() != "bearer ":
+                    return False
+                principal = gym_rate_limiter._principal_from_token(token[7:].strip())
+                if principal is None or not await gym_rate_limiter.principal_is_active(principal):
+                    return False
+                scope["state"]["principal"] = principal
+                return True
+        return False
+    
+    @staticmethod
+    def _observe(scope, ip: str, status_code: int):
+        """Alimenta o SecurityAnalyzer só com recursos individuais da API
+        
+        Por ordem de custo: prefixo do path, principal já resolvido no request,
+        needs_analysis (um 2xx de um IP sem 404s recentes sai aqui), regex do
+        recurso e só então a verificação do JWT (utilizadores autenticados ficam de fora).
+        """
+        path = scope.get("path", "")
+        if not path.startswith(security_analyzer.RESOURCE_PREFIXES):
+            return
+        principal = scope["state"].get("principal")
+        if principal is not None and principal.verified:
+            return
+        
+        user_agent = ""
+        authorization = None
+        for name, value in scope.get("headers", ()):
+            if name == b"user-agent":
+                user_agent = value.decode("latin-1")
+            elif name == b"authorization":
+                authorization = value
+        if not security_analyzer.needs_analysis(ip, status_code, user_agent):
+            return
+        resource = security_analyzer.resource_id(path, scope.get("query_string", b""))
+        if resource is None:
+            return
+        if principal is None and authorization is not None:
+            token = authorization.decode("latin-1")
+            if token[:7].lower() == "bearer " and gym_rate_limiter._principal_from_token(token[7:].strip()) is not None:
+                return
+        try:
+            security_analyzer.observe_resource(ip, resource, path, status_code, user_agent)
+        except Exception as e:
+            gym_logger.error("Security analysis failed", error=e, ip_address=ip)
+
+def layered_rate_limit(category: str, member_key: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None):
+    """Limite em camadas: token bucket por principal + limite por IP (slowapi) para anónimos
+    
+    member_key: extrai dos argumentos do endpoint o membro a limitar quando o
+    request não traz JWT (ex.: número de sócio no body do login do app)
+    """
+    def decorator(func):
+        ip_limited = gym_rate_limiter.limiter_for(category).limit(
+            ROLE_RATE_LIMITS["anonymous"][category],
+            exempt_when=_exempt_from_ip_limit
+        )(func)
+        
+        def check(kwargs) -> Optional[contextvars.Token]:
+            request = kwargs.get("request")
+            if not isinstance(request, Request):
+                return None
+            principal = gym_rate_limiter.resolve_principal(request)
+            if principal.kind == "ip" and member_key is not None:
+                member = member_key(kwargs)
+                if member:
+                    principal = Principal("member", str(member), "member", False)
+            if principal.kind != "ip":
+                allowed, retry_after = gym_rate_limiter.take_token(principal, category)
+                if not allowed:
+                    gym_logger.security_event(
+                        event_type="rate_limit_exceeded",
+                        user_id=principal.id,
+                        ip_address=gym_rate_limiter.get_client_ip(request),
+                        endpoint=request.url.path,
+                        role=principal.role,
+                        category=category
+                    )
+                    raise HTTPException(
+                        status_code=429,
+                        detail={
+                            "error": "Rate limit exceeded",
+                            "message": "Muitas requests. Tente novamente em alguns segundos.",
+                            "retry_after": int(retry_after) + 1
+                        },
+                        headers={"Retry-After": str(int(retry_after) + 1)}
+                    )
+            return _current_principal.set(principal)
+        
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                token = check(kwargs)
+                try:
+                    return await ip_limited(*args, **kwargs)
+                finally:
+                    if token is not None:
+                        _current_principal.reset(token)
+            return async_wrapper
+        
+        @wraps(func)
+        def sync_wrapper(*args, **kwargs):
+            token = check(kwargs)
+            try:
+                return ip_limited(*args, **kwargs)
+            finally:
+                if token is not None:
+                    _current_principal.reset(token)
+        return sync_wrapper
+    return decorator
 
 # Decoradores para diferentes tipos de limite
 def auth_rate_limit():
     """Rate limit para endpoints de autenticação"""
-    def decorator(func):
-        return gym_rate_limiter.limiter.limit(RATE_LIMITS["auth"])(func)
-    return decorator
+    return layered_rate_limit("auth")
 
 def api_rate_limit():
     """Rate limit para APIs gerais"""
-    def decorator(func):
-        return gym_rate_limiter.limiter.limit(RATE_LIMITS["api"])(func)
-    return decorator
+    return layered_rate_limit("api")
 
 def dashboard_rate_limit():
     """Rate limit para dashboard (queries pesadas)"""
-    def decorator(func):
-        return gym_rate_limiter.limiter.limit(RATE_LIMITS["dashboard"])(func)
-    return decorator
+    return layered_rate_limit("dashboard")
 
 def write_rate_limit():
     """Rate limit para operações de escrita"""
-    def decorator(func):
-        return gym_rate_limiter.limiter.limit(RATE_LIMITS["write"])(func)
-    return decorator
+    return layered_rate_limit("write")
+
+def mobile_rate_limit():
+    """Rate limit para o app móvel (por member_id)"""
+    return layered_rate_limit("mobile")
+
+def _login_member_number(kwargs: Dict[str, Any]) -> Optional[str]:
+    credentials = kwargs.get("credentials")
+    return getattr(credentials, "member_number", None)
+
+def member_login_rate_limit():
+    """Rate limit do login do app: por número de sócio, com teto generoso por IP
+    
+    Os telemóveis no Wi-Fi do ginásio partilham um IP; o limite "auth" por IP
+    bloqueava todos ao mesmo tempo.
+    """
+    return layered_rate_limit("member_login", member_key=_login_member_number)
 
 # Função para análise de segurança
+class _BehaviourWindow:
+    """Contadores de um IP em duas janelas fixas (atual + anterior), O(1) por request
+    
+    A estimativa "deslizante" pesa a janela anterior pela fração que ainda se
+    sobrepõe, como o sliding-window-counter do rate limiting.
+    """
+    __slots__ = ("started", "requests", "not_found", "ids", "prev_requests",
+                 "prev_not_found", "prev_ids", "last_reported")
+    
+    def __init__(self, now: float):
+        self.started = now
+        self.requests = 0
+        self.not_found = 0
+        self.ids = set()
+        self.prev_requests = 0
+        self.prev_not_found = 0
+        self.prev_ids = 0
+        self.last_reported = 0.0
+    
+    def roll(self, now: float, window: float):
+        elapsed = now - self.started
+        if elapsed < window:
+            return
+        if elapsed < 2 * window:
+            self.prev_requests, self.prev_not_found, self.prev_ids = self.requests, self.not_found, len(self.ids)
+        else:
+            self.prev_requests = self.prev_not_found = self.prev_ids = 0
+        self.started = now - (elapsed % window)
+        self.requests = 0
+        self.not_found = 0
+        self.ids = set()
+    
+    def estimate(self, now: float, window: float) -> Tuple[float, float, float]:
+        weight = max(0.0, 1.0 - (now - self.started) / window)
+        return (
+            self.requests + self.prev_requests * weight,
+            self.not_found + self.prev_not_found * weight,
+            len(self.ids) + self.prev_ids * weight
+        )
+
+@lru_cache(maxsize=1024)
+def _is_suspicious_agent(user_agent: str) -> bool:
+    """Poucos user agents distintos: a regex corre uma vez por valor"""
+    return SecurityAnalyzer.SUSPICIOUS_AGENTS.search(user_agent) is not None
+
 class SecurityAnalyzer:
     """Analisador de segurança para detectar padrões suspeitos"""
     
+    SUSPICIOUS_AGENTS = re.compile(r"bot|crawler|spider|scraper|hack|attack", re.IGNORECASE)
+    SENSITIVE_ENDPOINTS = re.compile(r"/api/users|/api/members|/api/payments|/admin")
+    INTERNAL_PREFIXES = ("10.", "192.168.", "172.")
+    # Recursos individuais cujo id pode ser enumerado (/api/members/{id}, /api/mobile/profile?member_id=)
+    # Alternativas mais longas primeiro: "members/qr" antes de "members"
+    RESOURCE_PATH = re.compile(
+        r"^/api/(?P<family>members/qr|members|payments|users|attendance|mobile/attendance|mobile/messages|"
+        r"mobile/profile|mobile/fcm-token)/(?P<id>[^/]+)"
+    )
+    # Filtro barato antes da regex: prefixos das famílias acima e das rotas móveis com ?member_id=
+    RESOURCE_PREFIXES = ("/api/members/", "/api/payments/", "/api/users/", "/api/attendance/", "/api/mobile/")
+    MEMBER_ID_QUERY = re.compile(rb"(?:^|&)member_id=([^&]+)")
+    
+    def __init__(self, window_seconds: float = 60.0, max_tracked_ips: int = 50000,
+                 enumeration_threshold: int = 20, not_found_ratio: float = 0.5,
+                 min_requests: int = 10, report_interval: float = 5.0,
+                 enumeration_not_found_ratio: float = 0.2):
+        self.window_seconds = window_seconds
+        self.max_tracked_ips = max_tracked_ips
+        self.enumeration_threshold = enumeration_threshold
+        self.not_found_ratio = not_found_ratio
+        self.enumeration_not_found_ratio = enumeration_not_found_ratio
+        self.min_requests = min_requests
+        self.report_interval = report_interval
+        self._windows: "OrderedDict[str, _BehaviourWindow]" = OrderedDict()
+        self.stats = {"observed": 0, "flagged": 0, "reported": 0}
+    
     @staticmethod
     def analyze_request_pattern(ip: str, endpoint: str, user_agent: str = "") -> Dict[str, Any]:
         """Analisa padrões de request para detectar bots/ataques"""
@@ -228,29 +690,124 @@ class SecurityAnalyzer:
         }
         
         # Verificar user agent suspeito
-        suspicious_agents = ["bot", "crawler", "spider", "scraper", "hack", "attack"]
-        if any(agent in user_agent.lower() for agent in suspicious_agents):
+        if user_agent and SecurityAnalyzer.SUSPICIOUS_AGENTS.search(user_agent):
             analysis["flags"].append("suspicious_user_agent")
             analysis["score"] += 30
         
         # Verificar endpoints sensíveis
-        sensitive_endpoints = ["/api/users", "/api/members", "/api/payments", "/admin"]
-        if any(sens in endpoint for sens in sensitive_endpoints):
+        if SecurityAnalyzer.SENSITIVE_ENDPOINTS.search(endpoint):
             analysis["flags"].append("sensitive_endpoint_access")
             analysis["score"] += 20
         
         # Verificar padrões de IP
-        if ip.startswith(("10.", "192.168.", "172.")):
+        if ip.startswith(SecurityAnalyzer.INTERNAL_PREFIXES):
             analysis["flags"].append("internal_ip")
             analysis["score"] -= 10  # IPs internos são menos suspeitos
         
         # Calcular nível de risco
+        SecurityAnalyzer._set_risk_level(analysis)
+        return analysis
+    
+    @staticmethod
+    def _set_risk_level(analysis: Dict[str, Any]):
         if analysis["score"] >= 50:
             analysis["risk_level"] = "high"
         elif analysis["score"] >= 25:
             analysis["risk_level"] = "medium"
+        else:
+            analysis["risk_level"] = "low"
+    
+    def resource_id(self, path: str, query_string: bytes = b"") -> Optional[str]:
+        """Identificador "familia:id" do recurso pedido, se for um recurso individual"""
+        match = self.RESOURCE_PATH.match(path)
+        if match:
+            return f"{match.group('family')}:{match.group('id')}"
+        if query_string and path.startswith("/api/mobile/"):
+            match = self.MEMBER_ID_QUERY.search(query_string)
+            if match:
+                return f"{path}:{match.group(1).decode('latin-1')}"
+        return None
+    
+    def needs_analysis(self, ip: str, status_code: int, user_agent: str = "") -> bool:
+        """Filtro O(1) antes de resource_id/observe_resource
+        
+        Enumeração e high_404 só disparam com 404s, por isso um IP só ganha janela
+        no primeiro 404 (ou com user agent suspeito); os 2xx anteriores não contam.
+        """
+        if status_code == 404 or ip in self._windows:
+            return True
+        return bool(user_agent) and _is_suspicious_agent(user_agent)
+    
+    def observe(self, ip: str, path: str, status_code: int, query_string: bytes = b"",
+                user_agent: str = "") -> Optional[Dict[str, Any]]:
+        """Regista um request terminado; só recursos individuais contam (ver observe_resource)"""
+        if not path.startswith(self.RESOURCE_PREFIXES) or not self.needs_analysis(ip, status_code, user_agent):
+            return None
+        resource = self.resource_id(path, query_string)
+        if resource is None:
+            return None
+        return self.observe_resource(ip, resource, path, status_code, user_agent)
+    
+    def observe_resource(self, ip: str, resource: str, path: str, status_code: int,
+                         user_agent: str = "") -> Optional[Dict[str, Any]]:
+        """Atualiza a janela do IP e devolve a análise, ou None se não há nada a assinalar
         
+        Sem sinal comportamental nem user agent suspeito o score não chega a "high",
+        por isso a análise completa só é construída nesse caso.
+        """
+        now = time.monotonic()
+        window = self._windows.get(ip)
+        if window is None:
+            window = _BehaviourWindow(now)
+            self._windows[ip] = window
+            if len(self._windows) > self.max_tracked_ips:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(ip)
+            window.roll(now, self.window_seconds)
+        
+        window.requests += 1
+        if status_code == 404:
+            window.not_found += 1
+        # Acima do limite já não interessa contar mais ids: o set fica limitado
+        if len(window.ids) <= self.enumeration_threshold:
+            window.ids.add(resource)
+        self.stats["observed"] += 1
+        
+        requests, not_found, distinct_ids = window.estimate(now, self.window_seconds)
+        # Muitos ids distintos só é enumeração com 404s: atrás do NAT do ginásio dezenas
+        # de membros consultam legitimamente o próprio member_id a partir do mesmo IP
+        enumeration = distinct_ids > self.enumeration_threshold and not_found >= requests * self.enumeration_not_found_ratio
+        high_404 = requests >= self.min_requests and not_found / requests >= self.not_found_ratio
+        if not (enumeration or high_404 or (user_agent and self.SUSPICIOUS_AGENTS.search(user_agent))):
+            return None
+        
+        analysis = self.analyze_request_pattern(ip, path, user_agent)
+        if enumeration:
+            analysis["flags"].append("resource_enumeration")
+            analysis["score"] += 50
+        if high_404:
+            analysis["flags"].append("high_404_ratio")
+            analysis["score"] += 30
+        self._set_risk_level(analysis)
+        
+        if analysis["risk_level"] == "high":
+            self.stats["flagged"] += 1
+            # Cada relatório conta como tentativa falhada: comportamento sustentado leva a bloqueio
+            if now - window.last_reported >= self.report_interval:
+                window.last_reported = now
+                self.stats["reported"] += 1
+                gym_rate_limiter.record_failed_attempt(ip, f"security:{','.join(analysis['flags'])}")
         return analysis
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {"tracked_ips": len(self._windows), **self.stats}
 
 # Instância global do analisador
-security_analyzer = SecurityAnalyzer()
\ No newline at end of file
+security_analyzer = SecurityAnalyzer(
+    window_seconds=float(os.getenv("SECURITY_WINDOW_SECONDS", "60")),
+    max_tracked_ips=int(os.getenv("SECURITY_MAX_TRACKED_IPS", "50000")),
+    enumeration_threshold=int(os.getenv("SECURITY_ENUMERATION_THRESHOLD", "20")),
+    not_found_ratio=float(os.getenv("SECURITY_NOT_FOUND_RATIO", "0.5")),
+    enumeration_not_found_ratio=float(os.getenv("SECURITY_ENUMERATION_NOT_FOUND_RATIO", "0.2"))
+)
@@ -0,0 +1,33 @@
+"""
+KO Gym - Contexto do request em curso
+Estado por request partilhado entre o middleware e a instrumentação (Mongo, timers)
+"""
+import contextvars
+import threading
+from typing import Optional
+
+class RequestContext:
+    """Contadores mutáveis do request; o Motor corre os comandos em threads com uma
+    cópia do contexto, por isso o objeto é partilhado e atualizado sob lock"""
+    
+    __slots__ = ("scope", "db_commands", "db_time_ns", "_lock")
+    
+    def __init__(self, scope=None):
+        self.scope = scope
+        self.db_commands = 0
+        self.db_time_ns = 0
+        self._lock = threading.Lock()
+    
+    def add_db_command(self, duration_ns: int):
+        with self._lock:
+            self.db_commands += 1
+            self.db_time_ns += duration_ns
+    
+    @property
+    def db_time_ms(self) -> float:
+        return self.db_time_ns / 1e6
+
+# Definido pelo LoggingMiddleware durante cada request HTTP
+current_request: contextvars.ContextVar[Optional[RequestContext]] = contextvars.ContextVar(
+    "current_request", default=None
+)
@@ -0,0 +1,119 @@
+"""
+KO Gym - Amostragem de logs de requests
+Decisão no fim do request (tail-based): erros e pedidos lentos são sempre mantidos
+"""
+import os
+import random
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+_DEFAULT_EXCLUDED = "/health,/healthz,/metrics,/favicon.ico,/static,/docs,/redoc,/openapi.json"
+
+# endpoint -> template da rota ("/api/members/{member_id}"), por app
+_route_templates: Dict[int, Dict[Any, str]] = {}
+_route_lock = threading.Lock()
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+def route_template(scope) -> str:
+    """Template da rota que tratou o request (baixa cardinalidade, para logs e métricas)
+    
+    O Starlette guarda o endpoint no scope após o routing; o mapa endpoint -> path
+    é construído uma vez por app a partir de app.routes.
+    """
+    endpoint = scope.get("endpoint")
+    app = scope.get("app")
+    if endpoint is None or app is None:
+        return UNMATCHED_ROUTE
+    
+    templates = _route_templates.get(id(app))
+    if templates is None or endpoint not in templates:
+        with _route_lock:
+            templates = {}
+            for route in getattr(app, "routes", ()):
+                route_endpoint = getattr(route, "endpoint", None)
+                if route_endpoint is not None:
+                    templates.setdefault(route_endpoint, route.path)
+            # Endpoints fora de app.routes (sub-apps montadas) não voltam a disparar a reconstrução
+            templates.setdefault(endpoint, UNMATCHED_ROUTE)
+            _route_templates[id(app)] = templates
+    return templates.get(endpoint, UNMATCHED_ROUTE)
+
+def _parse_route_rates(spec: str) -> Dict[str, float]:
+    """"GET /api/dashboard=0.05,/api/members=0.2" -> {chave: taxa}"""
+    rates = {}
+    for item in spec.split(","):
+        key, sep, rate = item.rpartition("=")
+        if sep and key.strip():
+            rates[key.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+class RequestSampler:
+    """Amostragem dos eventos api_request
+    
+    - taxa base por rota ("METHOD /template" ou "/template"), senão a taxa global
+    - 4xx/5xx, pedidos acima de slow_ms e pedidos com max_db_commands ou mais
+      comandos Mongo (N+1) são sempre mantidos (sample_rate=1.0)
+    - health checks e estáticos são excluídos por prefixo de path
+    - o registo leva sample_rate para re-ponderar contagens (1 / sample_rate)
+    """
+    
+    def __init__(self, base_rate: float = 1.0, route_rates: Optional[Dict[str, float]] = None,
+                 slow_ms: float = 1000.0, excluded_prefixes: Tuple[str, ...] = (),
+                 max_db_commands: int = 50):
+        self.base_rate = base_rate
+        self.route_rates = route_rates or {}
+        self.slow_ms = slow_ms
+        self.max_db_commands = max_db_commands
+        self.excluded_prefixes = tuple(prefix for prefix in excluded_prefixes if prefix)
+        self.stats = {"seen": 0, "kept": 0, "kept_always": 0, "sampled_out": 0, "excluded": 0}
+    
+    def is_excluded(self, path: str) -> bool:
+        return path.startswith(self.excluded_prefixes) if self.excluded_prefixes else False
+    
+    def rate_for(self, method: str, route: str) -> float:
+        rates = self.route_rates
+        if not rates:
+            return self.base_rate
+        rate = rates.get(f"{method} {route}")
+        if rate is None:
+            rate = rates.get(route, self.base_rate)
+        return rate
+    
+    def decide(self, method: str, route: str, status_code: int, duration_ms: float,
+               db_commands: int = 0) -> Optional[float]:
+        """sample_rate a registar se o request deve ser logado, senão None"""
+        self.stats["seen"] += 1
+        if status_code >= 400 or duration_ms >= self.slow_ms or db_commands >= self.max_db_commands:
+            self.stats["kept"] += 1
+            self.stats["kept_always"] += 1
+            return 1.0
+        
+        rate = self.rate_for(method, route)
+        if rate >= 1.0 or (rate > 0.0 and random.random() < rate):
+            self.stats["kept"] += 1
+            return rate
+        self.stats["sampled_out"] += 1
+        return None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "base_rate": self.base_rate,
+            "route_rates": self.route_rates,
+            "slow_ms": self.slow_ms,
+            "max_db_commands": self.max_db_commands,
+            **self.stats
+        }
+
+def create_request_sampler() -> RequestSampler:
+    """Configuração por variáveis de ambiente (produção amostra 10% por omissão)"""
+    default_rate = "0.1" if os.getenv("ENVIRONMENT") == "production" else "1.0"
+    return RequestSampler(
+        base_rate=min(max(float(os.getenv("LOG_SAMPLE_RATE", default_rate)), 0.0), 1.0),
+        route_rates=_parse_route_rates(os.getenv("LOG_SAMPLE_ROUTES", "")),
+        slow_ms=float(os.getenv("LOG_SLOW_REQUEST_MS", "1000")),
+        max_db_commands=int(os.getenv("LOG_MAX_DB_COMMANDS", "50")),
+        excluded_prefixes=tuple(p.strip() for p in os.getenv("LOG_SAMPLE_EXCLUDE", _DEFAULT_EXCLUDED).split(","))
+    )
+
+request_sampler = create_request_sampler()
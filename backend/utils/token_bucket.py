@@ -0,0 +1,141 @@
+"""
+KO Gym - Token buckets partilhados
+Limites por utilizador/membro com burst, atómicos no Redis e com stand-in local
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import redis
+from .logger import gym_logger
+from .cache import REDIS_ERRORS, REDIS_SCRIPT_ERRORS
+from .circuit_breaker import CircuitBreaker
+from .abuse_store import KEY_PREFIX
+
+# Refill + consumo num único round trip; TIME do Redis evita relógios diferentes entre workers
+_TAKE_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate_per_ms = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil or ts == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate_per_ms)
+local allowed = 0
+local retry_ms = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_ms = math.ceil((cost - tokens) / rate_per_ms)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate_per_ms) + 1000)
+return {allowed, retry_ms}
+"""
+
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+def parse_rate(rate: str) -> Tuple[int, float]:
+    """"100/minute" -> (capacidade, tokens por segundo)"""
+    amount, _, period = rate.partition("/")
+    period = period.strip().lower().rstrip("s")
+    if period not in _PERIODS:
+        raise ValueError(f"Invalid rate: {rate}")
+    capacity = int(amount)
+    return capacity, capacity / _PERIODS[period]
+
+class LocalTokenBuckets:
+    """Stand-in em processo: buckets por chave num LRU limitado"""
+    
+    def __init__(self, max_keys: int = 50000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def take(self, key: str, capacity: int, rate_per_second: float, cost: int = 1) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [float(capacity), now]
+                self._buckets[key] = bucket
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            
+            tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate_per_second)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return True, 0.0
+            bucket[0] = tokens
+            return False, (cost - tokens) / rate_per_second
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "buckets": len(self._buckets), "max_keys": self.max_keys}
+
+class RedisTokenBuckets:
+    """Buckets em hashes do Redis (tokens, ts), partilhados entre workers"""
+    
+    def __init__(self, client: "redis.Redis", fallback: Optional[LocalTokenBuckets] = None):
+        self.client = client
+        self.fallback = fallback or LocalTokenBuckets()
+        self.breaker = CircuitBreaker(
+            "redis_token_buckets",
+            failure_threshold=int(os.getenv("CACHE_BREAKER_FAILURE_THRESHOLD", "3")),
+            reset_timeout=float(os.getenv("CACHE_BREAKER_RESET_SECONDS", "10"))
+        )
+        self._take_script = client.register_script(_TAKE_LUA)
+    
+    def take(self, key: str, capacity: int, rate_per_second: float, cost: int = 1) -> Tuple[bool, float]:
+        if self.breaker.allow_request():
+            try:
+                allowed, retry_ms = self._take_script(
+                    keys=[f"{KEY_PREFIX}:bucket:{key}"],
+                    args=[capacity, rate_per_second / 1000.0, cost]
+                )
+                self.breaker.record_success()
+                return bool(allowed), int(retry_ms) / 1000.0
+            except REDIS_SCRIPT_ERRORS as e:
+                self.breaker.record_failure(e)
+                gym_logger.warning("Redis token buckets unavailable, using local buckets", error=e)
+        
+        return self.fallback.take(key, capacity, rate_per_second, cost)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "redis",
+            "circuit_breaker": self.breaker.snapshot(),
+            "local_fallback": self.fallback.stats()
+        }
+
+def create_token_buckets():
+    """Redis partilhado quando configurado, senão buckets locais"""
+    local_buckets = LocalTokenBuckets(max_keys=int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "50000")))
+    redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    try:
+        client = redis.from_url(
+            redis_url,
+            socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5")),
+            socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+        )
+        buckets = RedisTokenBuckets(client, fallback=local_buckets)
+    except Exception as e:
+        gym_logger.warning("Redis token buckets not configured, using local buckets", error=e)
+        return local_buckets
+    
+    try:
+        client.ping()
+    except REDIS_ERRORS as e:
+        buckets.breaker.force_open(e)
+        gym_logger.warning("Redis not available for rate limiting, using local buckets", error=e)
+    return buckets
@@ -0,0 +1,43 @@
+"""
+KO Gym - Testes unitários do backend
+Os módulos são importados como no servidor (backend/ no sys.path, `utils.x`)
+"""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+# server.py lê estas variáveis no import; os testes não abrem ligações ao Mongo
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "ko_gym_test")
+
+class FakeClock:
+    """Relógio controlado pelo teste: avançar com `clock.now += segundos`"""
+    
+    def __init__(self, now: float = 1_700_000_000.0):
+        self.now = now
+    
+    def monotonic(self) -> float:
+        return self.now
+    
+    def time(self) -> float:
+        return self.now
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """Fábrica: fake_clock(módulo) troca o `time` desse módulo por um FakeClock
+    
+    Só monotonic() e time() ficam controlados; o resto do módulo time mantém-se.
+    """
+    def install(module) -> FakeClock:
+        clock = FakeClock()
+        monkeypatch.setattr(module, "time", SimpleNamespace(
+            **{**vars(time), "monotonic": clock.monotonic, "time": clock.time}
+        ))
+        return clock
+    return install
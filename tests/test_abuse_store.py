@@ -0,0 +1,64 @@
+import pytest
+
+from utils import abuse_store
+from utils.abuse_store import LocalAbuseStore
+
+WINDOW = 300
+MAX_ATTEMPTS = 3
+BLOCK = 900
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(abuse_store)
+
+@pytest.fixture
+def store():
+    return LocalAbuseStore(max_tracked_ips=100, compact_interval=0)
+
+def _fail(store, ip="10.0.0.1", endpoint="/api/auth/login"):
+    return store.record_failure(ip, endpoint, window_seconds=WINDOW, max_attempts=MAX_ATTEMPTS, block_seconds=BLOCK)
+
+def test_blocks_after_max_attempts_in_window(clock, store):
+    assert [_fail(store, endpoint=f"/e{i}").blocked for i in range(MAX_ATTEMPTS)] == [False, False, True]
+    assert store.blocked_for("10.0.0.1") == pytest.approx(BLOCK)
+    assert store.blocked_for("10.0.0.2") == 0
+
+def test_blocked_result_lists_endpoints_in_order(clock, store):
+    for i in range(MAX_ATTEMPTS - 1):
+        _fail(store, endpoint=f"/e{i}")
+    result = _fail(store, endpoint="/last")
+    assert (result.attempts, result.endpoints) == (MAX_ATTEMPTS, ["/e0", "/e1", "/last"])
+
+def test_attempts_outside_window_do_not_count(clock, store):
+    _fail(store)
+    _fail(store)
+    clock.now += WINDOW + 1
+    result = _fail(store)
+    assert (result.attempts, result.blocked) == (1, False)
+
+def test_block_expires(clock, store):
+    for _ in range(MAX_ATTEMPTS):
+        _fail(store)
+    clock.now += BLOCK
+    assert store.blocked_for("10.0.0.1") == 0
+    assert store.stats()["blocked_ips"] == 0
+
+def test_success_clears_failures(clock, store):
+    _fail(store)
+    _fail(store)
+    store.clear_failures("10.0.0.1")
+    assert _fail(store).attempts == 1
+
+def test_tracked_ips_are_lru_bounded(clock):
+    store = LocalAbuseStore(max_tracked_ips=2, compact_interval=0)
+    for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+        _fail(store, ip=ip)
+    assert store.stats()["tracked_ips"] == 2
+    assert store.stats()["evicted"] == 1
+
+def test_compact_drops_stale_ips(clock, store):
+    _fail(store, ip="10.0.0.1")
+    clock.now += WINDOW
+    _fail(store, ip="10.0.0.2")
+    assert store.compact() == 1
+    assert store.stats()["tracked_ips"] == 1
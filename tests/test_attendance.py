@@ -0,0 +1,239 @@
+import asyncio
+import inspect
+import time
+from datetime import date, datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import server
+from server import Attendance, attendance_dedupe_key
+from utils.activity_registry import activity_registry
+
+NOW = datetime(2026, 10, 19, 18, 30, 5, tzinfo=timezone.utc)
+
+def test_repeated_scan_in_window_collides():
+    later = NOW + timedelta(seconds=30)
+    assert attendance_dedupe_key("m1", "a1", NOW.date(), NOW) == attendance_dedupe_key("m1", "a1", NOW.date(), later)
+
+def test_scans_in_different_windows_do_not_collide():
+    later = NOW + timedelta(seconds=server.CHECKIN_DEDUPE_WINDOW_SECONDS)
+    assert attendance_dedupe_key("m1", "a1", NOW.date(), NOW) != attendance_dedupe_key("m1", "a1", NOW.date(), later)
+
+def test_back_dated_entries_for_different_days_do_not_collide():
+    # Lançadas em seguida pela receção: mesmo check_in_time, dias diferentes
+    first = attendance_dedupe_key("m1", "a1", date(2026, 10, 14), NOW)
+    second = attendance_dedupe_key("m1", "a1", date(2026, 10, 15), NOW + timedelta(seconds=20))
+    assert first != second
+
+def test_back_dated_entry_repeated_for_same_day_collides():
+    first = attendance_dedupe_key("m1", "a1", date(2026, 10, 14), NOW)
+    assert first == attendance_dedupe_key("m1", "a1", date(2026, 10, 14), NOW + timedelta(seconds=20))
+
+def test_member_and_activity_are_part_of_the_key():
+    key = attendance_dedupe_key("m1", "a1", NOW.date(), NOW)
+    assert key != attendance_dedupe_key("m2", "a1", NOW.date(), NOW)
+    assert key != attendance_dedupe_key("m1", "a2", NOW.date(), NOW)
+    assert key != attendance_dedupe_key("m1", None, NOW.date(), NOW)
+
+def _matches(doc, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(_matches(doc, option) for option in condition):
+                return False
+        elif isinstance(condition, dict) and "$in" in condition:
+            if doc.get(field) not in condition["$in"]:
+                return False
+        elif doc.get(field) != condition:
+            return False
+    return True
+
+class _Cursor:
+    def __init__(self, docs):
+        self.docs = docs
+    
+    async def to_list(self, length):
+        return self.docs
+
+class _FakeCollection:
+    """O subconjunto do Motor usado pelos check-ins, com índices únicos parciais"""
+    
+    def __init__(self, docs=(), unique=()):
+        self.docs = [dict(doc) for doc in docs]
+        self.unique = unique
+        self.bulk_writes = []
+    
+    def _duplicate_field(self, document):
+        for field in self.unique:
+            if field in document and any(doc.get(field) == document[field] for doc in self.docs):
+                return field
+        return None
+    
+    async def insert_one(self, document):
+        field = self._duplicate_field(document)
+        if field:
+            raise DuplicateKeyError(f"E11000 duplicate key error: {field}")
+        self.docs.append(dict(document))
+    
+    async def insert_many(self, documents, ordered=True):
+        errors = []
+        for index, document in enumerate(documents):
+            field = self._duplicate_field(document)
+            if field:
+                errors.append({"index": index, "code": 11000, "errmsg": f"E11000 duplicate key error: {field}"})
+            else:
+                self.docs.append(dict(document))
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(documents) - len(errors)})
+    
+    async def find_one(self, query, projection=None):
+        return next((dict(doc) for doc in self.docs if _matches(doc, query)), None)
+    
+    def find(self, query, projection=None):
+        return _Cursor([dict(doc) for doc in self.docs if _matches(doc, query)])
+    
+    async def bulk_write(self, operations, ordered=True):
+        self.bulk_writes.append(operations)
+
+@pytest.fixture
+def attendance_collection(monkeypatch):
+    collection = _FakeCollection(unique=("dedupe_key", "idempotency_key"))
+    monkeypatch.setattr(server, "db", SimpleNamespace(attendance=collection))
+    return collection
+
+def _attendance(member_id="m1", check_in_time=NOW, **fields):
+    return Attendance(member_id=member_id, activity_id="a1", check_in_date=check_in_time.date(),
+                      check_in_time=check_in_time, **fields)
+
+def test_insert_attendance_returns_original_for_repeated_scan(attendance_collection):
+    first, created = asyncio.run(server.insert_attendance(_attendance()))
+    again, created_again = asyncio.run(server.insert_attendance(_attendance(check_in_time=NOW + timedelta(seconds=10))))
+    assert (created, created_again) == (True, False)
+    assert again["id"] == first["id"]
+    assert len(attendance_collection.docs) == 1
+
+def test_insert_attendance_replays_idempotency_key(attendance_collection):
+    first, _ = asyncio.run(server.insert_attendance(_attendance(), idempotency_key="k1"))
+    retry, created = asyncio.run(server.insert_attendance(
+        _attendance(check_in_time=NOW + timedelta(hours=1)), idempotency_key="k1"
+    ))
+    assert not created
+    assert retry["id"] == first["id"]
+
+def test_insert_attendance_rejects_idempotency_key_of_another_member(attendance_collection):
+    asyncio.run(server.insert_attendance(_attendance(), idempotency_key="k1"))
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(server.insert_attendance(_attendance(member_id="m2"), idempotency_key="k1"))
+    assert exc_info.value.status_code == 409
+
+def test_local_check_in_date_uses_server_local_day(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Lisbon")
+    time.tzset()
+    try:
+        # 23:30 UTC em julho já é o dia seguinte em Lisboa (UTC+1), como date.today()
+        assert server.local_check_in_date(datetime(2026, 7, 1, 23, 30, tzinfo=timezone.utc)) == date(2026, 7, 2)
+        assert server.local_check_in_date(datetime(2026, 1, 1, 23, 30, tzinfo=timezone.utc)) == date(2026, 1, 1)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+STAFF = SimpleNamespace(id="staff")
+bulk_create_attendance = inspect.unwrap(server.bulk_create_attendance)
+
+@pytest.fixture
+def bulk_db(monkeypatch):
+    db = SimpleNamespace(
+        attendance=_FakeCollection(unique=("dedupe_key", "idempotency_key")),
+        members=_FakeCollection([
+            {"id": "m1", "status": "active"},
+            {"id": "m2", "status": "active"},
+            {"id": "m3", "status": "inactive"},
+        ]),
+        activities=_FakeCollection([
+            {"id": "a1", "is_active": True},
+            {"id": "a2", "is_active": False},
+        ]),
+    )
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(activity_registry, "collection", db.activities)
+    monkeypatch.setattr(activity_registry, "_activities", {})
+    monkeypatch.setattr(activity_registry, "_loaded_at", 0.0)
+    return db
+
+def _bulk(*items):
+    now = datetime.now(timezone.utc)
+    payload = server.BulkCheckInRequest(check_ins=[
+        {"member_id": "m1", "activity_id": "a1", "check_in_time": now, **item}
+        for item in items
+    ])
+    return asyncio.run(bulk_create_attendance(payload, current_user=STAFF))
+
+def _counter_updates(db):
+    return {op._filter["id"]: op._doc["$inc"]["workout_count"] for batch in db.members.bulk_writes for op in batch}
+
+def test_bulk_creates_and_counts_each_member_once(bulk_db):
+    response = _bulk({}, {"member_id": "m2"})
+    
+    assert response["summary"] == {"created": 2}
+    assert [r["attendance_id"] for r in response["results"]] == [doc["id"] for doc in bulk_db.attendance.docs]
+    [batch] = bulk_db.members.bulk_writes
+    assert _counter_updates(bulk_db) == {"m1": 1, "m2": 1}
+    assert set(batch[0]._doc) == {"$inc", "$max"}
+
+def test_bulk_duplicate_within_batch(bulk_db):
+    response = _bulk({}, {})
+    first, second = response["results"]
+    assert (first["status"], second["status"]) == ("created", "duplicate")
+    assert second["attendance_id"] == first["attendance_id"]
+    assert _counter_updates(bulk_db) == {"m1": 1}
+
+def test_bulk_duplicate_of_existing_check_in(bulk_db):
+    # O mesmo scan já entrou pelo caminho individual: mesma dedupe_key, dia incluído
+    now = datetime.now(timezone.utc)
+    existing, _ = asyncio.run(server.insert_attendance(Attendance(
+        member_id="m1", activity_id="a1", check_in_date=server.local_check_in_date(), check_in_time=now
+    )))
+    
+    response = _bulk({"check_in_time": now})
+    assert response["results"][0] == {"index": 0, "status": "duplicate", "attendance_id": existing["id"]}
+    assert bulk_db.members.bulk_writes == []
+
+def test_bulk_idempotency_key_of_another_member_is_a_conflict(bulk_db):
+    _bulk({"member_id": "m2", "idempotency_key": "k1"})
+    response = _bulk({"idempotency_key": "k1"}, {"member_id": "m2", "idempotency_key": "k1"})
+    
+    assert response["summary"] == {"conflict": 1, "duplicate": 1}
+    assert response["results"][0]["attendance_id"] is None
+    assert _counter_updates(bulk_db) == {"m2": 1}
+
+def test_bulk_rejects_unknown_and_inactive_members_and_activities(bulk_db):
+    response = _bulk(
+        {"member_id": "unknown"},
+        {"member_id": "m3"},
+        {"activity_id": "unknown"},
+        {"activity_id": "a2"},
+        {"check_in_time": datetime.now(timezone.utc) - timedelta(days=30)},
+    )
+    assert [r["status"] for r in response["results"]] == [
+        "invalid_member", "invalid_member", "invalid_activity", "invalid_activity", "invalid_timestamp"
+    ]
+    assert bulk_db.attendance.docs == []
+    assert bulk_db.members.bulk_writes == []
+
+def test_bulk_resolves_activities_once_per_batch(bulk_db, monkeypatch):
+    lookups = []
+    get_active_many = activity_registry.get_active_many
+    
+    async def recording_get_active_many(activity_ids):
+        activity_ids = list(activity_ids)
+        lookups.append(activity_ids)
+        return await get_active_many(activity_ids)
+    
+    monkeypatch.setattr(activity_registry, "get_active_many", recording_get_active_many)
+    monkeypatch.setattr(activity_registry, "get_active", None)
+    response = _bulk({}, {"activity_id": "a2"}, {}, {"activity_id": "unknown"})
+    
+    assert len(lookups) == 1
+    assert [r["status"] for r in response["results"]] == ["created", "invalid_activity", "duplicate", "invalid_activity"]
@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime, timezone
+
+from utils.business_metrics import BusinessMetricsAggregator
+
+AT = datetime(2026, 10, 19, 18, 30, 42, tzinfo=timezone.utc)
+
+class _Collection:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+    
+    async def bulk_write(self, operations, ordered=True):
+        if self.fail:
+            raise ConnectionError("mongo down")
+        self.batches.append(operations)
+
+def _aggregator(collection=None, **kwargs):
+    aggregator = BusinessMetricsAggregator(label_keys=("method",), **kwargs)
+    aggregator.collection = collection
+    return aggregator
+
+def test_records_sum_per_name_labels_and_minute():
+    aggregator = _aggregator()
+    aggregator.record("attendance_checked_in", 1, at=AT, method="qr_code")
+    aggregator.record("attendance_checked_in", 1, at=AT.replace(second=5), method="qr_code")
+    aggregator.record("attendance_checked_in", 1, at=AT, method="manual")
+    aggregator.record("attendance_checked_in", 1, at=AT.replace(minute=31), method="qr_code")
+    
+    assert len(aggregator._buffer) == 3
+    entry = aggregator._buffer[("attendance_checked_in", (("method", "qr_code"),), AT.replace(second=0))]
+    assert (entry["count"], entry["value"]) == (2, 2)
+
+def test_only_label_keys_become_labels_and_numbers_are_summed():
+    aggregator = _aggregator()
+    aggregator.record("payment_received", 1, at=AT, method="card", amount=30.0, member_id="m1")
+    aggregator.record("payment_received", 1, at=AT, method="card", amount=12.5, member_id="m2")
+    
+    [(key, entry)] = aggregator._buffer.items()
+    assert key[1] == (("method", "card"),)
+    assert entry["sums"] == {"amount": 42.5}
+
+def test_flush_writes_one_upsert_per_key():
+    collection = _Collection()
+    aggregator = _aggregator(collection)
+    for _ in range(10):
+        aggregator.record("attendance_checked_in", 1, at=AT, method="qr_code")
+    
+    assert asyncio.run(aggregator.flush()) == 1
+    [[operation]] = collection.batches
+    assert operation._doc["$inc"] == {"count": 10, "value": 10}
+    assert operation._filter == {"key": "attendance_checked_in|method=qr_code", "minute": AT.replace(second=0)}
+    assert aggregator.get_stats()["pending"] == 0
+
+def test_failed_flush_restores_increments():
+    collection = _Collection(fail=True)
+    aggregator = _aggregator(collection)
+    aggregator.record("attendance_checked_in", 1, at=AT, method="qr_code")
+    assert asyncio.run(aggregator.flush()) == 0
+    
+    aggregator.record("attendance_checked_in", 1, at=AT, method="qr_code")
+    collection.fail = False
+    asyncio.run(aggregator.flush())
+    [[operation]] = collection.batches
+    assert operation._doc["$inc"]["count"] == 2
+    assert aggregator.get_stats()["flush_errors"] == 1
+
+def test_new_keys_are_dropped_when_buffer_is_full():
+    aggregator = _aggregator(max_pending=1)
+    aggregator.record("a", 1, at=AT)
+    aggregator.record("a", 1, at=AT)
+    aggregator.record("b", 1, at=AT)
+    assert aggregator.get_stats()["dropped"] == 1
+    assert aggregator.get_stats()["recorded"] == 2
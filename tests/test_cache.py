@@ -0,0 +1,145 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from utils import cache
+from utils.cache import LocalCacheTier, _MISSING, _async_inflight, cache_result, gym_cache
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_concurrent_misses_share_one_execution():
+    calls = []
+    
+    @cache_result(ttl_seconds=60)
+    async def load(member_id):
+        calls.append(member_id)
+        await asyncio.sleep(0.01)
+        return {"id": member_id, "tags": []}
+    
+    async def main():
+        return await asyncio.gather(*(load("m1") for _ in range(5)))
+    
+    results = asyncio.run(main())
+    assert calls == ["m1"]
+    assert all(result == {"id": "m1", "tags": []} for result in results)
+    assert not _async_inflight
+
+def test_callers_do_not_share_mutable_results():
+    @cache_result(ttl_seconds=60)
+    async def load(member_id):
+        await asyncio.sleep(0.01)
+        return {"id": member_id, "tags": []}
+    
+    async def main():
+        first, second = await asyncio.gather(load("m1"), load("m1"))
+        first["tags"].append("leaked")
+        return second, await load("m1")
+    
+    second, cached = asyncio.run(main())
+    assert second["tags"] == []
+    assert cached["tags"] == []
+
+def test_cancelled_leader_does_not_fail_followers():
+    calls = []
+    gate = asyncio.Event()
+    
+    @cache_result(ttl_seconds=60)
+    async def load(member_id):
+        calls.append(member_id)
+        await gate.wait()
+        return {"id": member_id, "call": len(calls)}
+    
+    async def main():
+        leader = asyncio.create_task(load("m1"))
+        await _settle()
+        followers = [asyncio.create_task(load("m1")) for _ in range(3)]
+        await _settle()
+        
+        leader.cancel()
+        await _settle()
+        gate.set()
+        
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+    
+    results = asyncio.run(main())
+    # Um seguidor passa a líder: segunda execução, partilhada pelos restantes
+    assert len(calls) == 2
+    assert results == [{"id": "m1", "call": 2}] * 3
+    assert not _async_inflight
+
+def test_leader_exception_reaches_followers_and_is_not_cached():
+    calls = []
+    
+    @cache_result(ttl_seconds=60)
+    async def load(member_id):
+        calls.append(member_id)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("mongo down")
+    
+    async def main():
+        return await asyncio.gather(load("m1"), load("m1"), return_exceptions=True)
+    
+    results = asyncio.run(main())
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+    with pytest.raises(RuntimeError):
+        asyncio.run(load("m1"))
+    assert len(calls) == 2
+    assert not _async_inflight
+
+def test_negative_caching():
+    calls = []
+    
+    @cache_result(ttl_seconds=60, cache_none=True)
+    async def find(member_number):
+        calls.append(member_number)
+        return None
+    
+    assert asyncio.run(find("404")) is None
+    assert asyncio.run(find("404")) is None
+    assert calls == ["404"]
+
+def test_injected_arguments_do_not_change_the_key():
+    calls = []
+    
+    @cache_result(ttl_seconds=60)
+    def stats(period, current_user=None):
+        calls.append(period)
+        return {"period": period}
+    
+    stats("week", current_user=SimpleNamespace(id="u1"))
+    stats("week", current_user=SimpleNamespace(id="u2"))
+    stats("month")
+    assert calls == ["week", "month"]
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(cache)
+
+def test_l1_ttl_is_capped_by_tier_ttl(clock):
+    tier = LocalCacheTier(max_items=10, ttl_seconds=5)
+    tier.set("k", b"v", ttl_seconds=3600)
+    clock.now += 4.9
+    assert tier.get("k") == b"v"
+    clock.now += 0.1
+    assert tier.get("k") is _MISSING
+
+def test_l1_evicts_least_recently_used(clock):
+    tier = LocalCacheTier(max_items=2, ttl_seconds=5)
+    tier.set("a", 1)
+    tier.set("b", 2)
+    tier.get("a")
+    tier.set("c", 3)
+    assert tier.get("b") is _MISSING
+    assert tier.invalidate_pattern("a") == 1
+    assert len(tier) == 1
+
+def test_l1_hits_return_fresh_copies():
+    gym_cache.set("test:l1_copy", {"tags": []}, ttl_seconds=60)
+    gym_cache.get("test:l1_copy")["tags"].append("leaked")
+    assert gym_cache.get("test:l1_copy") == {"tags": []}
+    gym_cache.delete("test:l1_copy")
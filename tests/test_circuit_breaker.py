@@ -0,0 +1,81 @@
+import pytest
+
+from utils import circuit_breaker
+from utils.circuit_breaker import CircuitBreaker
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(circuit_breaker)
+
+def _open_breaker(clock, **kwargs):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10, **kwargs)
+    for _ in range(3):
+        assert breaker.allow_request()
+        breaker.record_failure(ConnectionError("refused"))
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    
+    _open_breaker(clock)
+
+def test_open_short_circuits_until_reset_timeout(clock):
+    breaker = _open_breaker(clock)
+    clock.now += 9.9
+    assert not breaker.allow_request()
+    assert breaker.snapshot()["short_circuited"] == 1
+    assert breaker.snapshot()["retry_in_seconds"] == pytest.approx(0.1)
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = _open_breaker(clock)
+    clock.now += 10
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow_request()
+
+def test_successful_probe_closes_and_notifies(clock):
+    recovered = []
+    breaker = _open_breaker(clock, on_close=lambda: recovered.append(True))
+    clock.now += 10
+    assert breaker.allow_request()
+    breaker.record_success()
+    
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert recovered == [True]
+    assert breaker.consecutive_failures == 0
+    assert all(breaker.allow_request() for _ in range(3))
+
+def test_failed_probe_reopens_for_another_timeout(clock):
+    breaker = _open_breaker(clock)
+    clock.now += 10
+    assert breaker.allow_request()
+    breaker.record_failure(ConnectionError("still down"))
+    
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    clock.now += 10
+    assert breaker.allow_request()
+
+def test_probe_without_outcome_expires(clock):
+    # Sonda que terminou com uma exceção que o chamador não registou
+    breaker = _open_breaker(clock)
+    clock.now += 10
+    assert breaker.allow_request()
+    clock.now += 9
+    assert not breaker.allow_request()
+    clock.now += 1
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_force_open(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+    breaker.force_open(ConnectionError("refused"))
+    assert not breaker.allow_request()
+    assert breaker.snapshot()["last_error"] == "ConnectionError: refused"
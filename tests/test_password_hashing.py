@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import threading
+from types import SimpleNamespace
+
+import bcrypt
+import pytest
+from fastapi import HTTPException
+
+import server
+from utils.password_hashing import PasswordHasher
+
+# Custo mínimo do bcrypt: os testes verificam comportamento, não tempo
+ROUNDS = 4
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(rounds=ROUNDS, max_workers=2, max_pending=8)
+    yield hasher
+    hasher.shutdown()
+
+def test_hash_and_verify(hasher):
+    hashed = asyncio.run(hasher.hash("s3cret"))
+    assert hashed.startswith(f"$2b$0{ROUNDS}$")
+    assert asyncio.run(hasher.verify("s3cret", hashed)) == (True, None)
+    assert asyncio.run(hasher.verify("wrong", hashed)) == (False, None)
+
+def test_legacy_sha256_hash_is_upgraded_on_login(hasher):
+    legacy = hashlib.sha256(b"s3cret").hexdigest()
+    valid, new_hash = asyncio.run(hasher.verify("s3cret", legacy))
+    assert valid
+    assert bcrypt.checkpw(b"s3cret", new_hash.encode())
+    assert hasher.get_stats()["rehashed"] == 1
+    assert asyncio.run(hasher.verify("wrong", legacy)) == (False, None)
+
+def test_hash_with_other_cost_is_rehashed(hasher):
+    old = bcrypt.hashpw(b"s3cret", bcrypt.gensalt(rounds=ROUNDS + 1)).decode()
+    assert hasher.needs_rehash(old)
+    valid, new_hash = asyncio.run(hasher.verify("s3cret", old))
+    assert valid
+    assert new_hash.startswith(f"$2b$0{ROUNDS}$")
+    assert not hasher.needs_rehash(new_hash)
+    # Password errada nunca devolve hash novo
+    assert asyncio.run(hasher.verify("wrong", old)) == (False, None)
+
+def test_passwords_are_truncated_to_72_bytes_like_existing_hashes(hasher):
+    password = "é" * 40  # 80 bytes em UTF-8
+    # Hash criado antes (passlib/bcrypt também só usavam os primeiros 72 bytes)
+    existing = bcrypt.hashpw(password.encode()[:72], bcrypt.gensalt(rounds=ROUNDS)).decode()
+    assert asyncio.run(hasher.verify(password, existing)) == (True, None)
+    # Só os primeiros 72 bytes contam: o que vem depois é ignorado, o que vem antes não
+    assert asyncio.run(hasher.verify("é" * 36 + "xyz", existing)) == (True, None)
+    assert asyncio.run(hasher.verify("é" * 35 + "xx", existing))[0] is False
+    assert asyncio.run(hasher.verify(password, asyncio.run(hasher.hash(password))))[0]
+
+def test_malformed_hash_is_rejected(hasher):
+    assert asyncio.run(hasher.verify("s3cret", "not-a-hash")) == (False, None)
+
+def test_full_queue_answers_503():
+    hasher = PasswordHasher(rounds=ROUNDS, max_workers=1, max_pending=2)
+    release = threading.Event()
+    
+    async def main():
+        busy = [asyncio.ensure_future(hasher._run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as exc_info:
+            await hasher.hash("s3cret")
+        release.set()
+        await asyncio.gather(*busy)
+        return exc_info.value
+    
+    try:
+        error = asyncio.run(main())
+    finally:
+        hasher.shutdown()
+    assert error.status_code == 503
+    assert hasher.get_stats()["rejected_busy"] == 1
+    assert hasher.get_stats()["pending"] == 0
+
+class _Users:
+    def __init__(self):
+        self.updates = []
+    
+    async def update_one(self, query, update):
+        self.updates.append((query, update))
+
+def test_login_stores_upgraded_hash(monkeypatch, hasher):
+    users = _Users()
+    monkeypatch.setattr(server, "db", SimpleNamespace(users=users))
+    monkeypatch.setattr(server, "password_hasher", hasher)
+    legacy = hashlib.sha256(b"s3cret").hexdigest()
+    
+    assert asyncio.run(server.verify_password("s3cret", legacy, "u1"))
+    [(query, update)] = users.updates
+    assert query == {"id": "u1"}
+    assert bcrypt.checkpw(b"s3cret", update["$set"]["password_hash"].encode())
+    
+    assert not asyncio.run(server.verify_password("wrong", legacy, "u1"))
+    assert len(users.updates) == 1
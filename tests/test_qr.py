@@ -0,0 +1,93 @@
+import asyncio
+import uuid
+
+import pytest
+
+from utils.qr import PREFIX, InvalidQRCode, MemberNumberCache, QRCodec
+
+MEMBER_ID = "3f2b8c1e-9a4d-4e6f-8b7a-1c2d3e4f5a6b"
+
+@pytest.fixture
+def codec():
+    return QRCodec("test-secret")
+
+def test_encode_parse_round_trip(codec):
+    data = codec.encode("042", MEMBER_ID)
+    assert data.startswith(PREFIX)
+    payload = codec.parse(data)
+    assert (payload.member_id, payload.member_number, payload.signed) == (MEMBER_ID, "042", True)
+
+def test_payload_is_qr_alphanumeric(codec):
+    data = codec.encode("042", MEMBER_ID)
+    assert set(data) <= set("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ:.")
+
+def test_parse_accepts_lowercased_payload(codec):
+    payload = codec.parse(codec.encode("042", MEMBER_ID).lower())
+    assert payload.member_id == MEMBER_ID
+
+def test_non_uuid_member_id_round_trip(codec):
+    payload = codec.parse(codec.encode("7", "legacy-id"))
+    assert payload.member_id == "legacy-id"
+
+@pytest.mark.parametrize("tamper", [
+    lambda data: data.replace(f"{PREFIX}042.", f"{PREFIX}043.", 1),
+    lambda data: data[:-1] + ("A" if data[-1] != "A" else "B"),
+    lambda data: data.rpartition(".")[0],
+])
+def test_tampered_payload_is_rejected(codec, tamper):
+    with pytest.raises(InvalidQRCode):
+        codec.parse(tamper(codec.encode("042", MEMBER_ID)))
+    assert codec.get_stats()["invalid"] == 1
+
+def test_other_secret_is_rejected(codec):
+    data = QRCodec("other-secret").encode("042", MEMBER_ID)
+    with pytest.raises(InvalidQRCode, match="signature"):
+        codec.parse(data)
+
+@pytest.mark.parametrize("data, member_id, member_number", [
+    (MEMBER_ID, MEMBER_ID, None),
+    (f"MEMBER:{MEMBER_ID}", MEMBER_ID, None),
+    (f"001-{MEMBER_ID}", MEMBER_ID, "001"),
+    ("001", None, "001"),
+])
+def test_legacy_formats(codec, data, member_id, member_number):
+    payload = codec.parse(data)
+    assert (payload.member_id, payload.member_number, payload.signed) == (member_id, member_number, False)
+    assert codec.get_stats()["legacy"] == 1
+
+@pytest.mark.parametrize("data", ["KO1:1.AAAA.é", "KO1:1.ÉÉÉÉ.AAAA", "KO1:ü.AAAA.AAAA"])
+def test_non_ascii_signed_payload_is_rejected(codec, data):
+    with pytest.raises(InvalidQRCode):
+        codec.parse(data)
+
+@pytest.mark.parametrize("data", ["", "   ", "hello", "abc-def", f"{PREFIX}garbage"])
+def test_unreadable_payload_is_rejected(codec, data):
+    with pytest.raises(InvalidQRCode):
+        codec.parse(data)
+
+class _FakeMembers:
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = 0
+    
+    async def find_one(self, query, projection=None):
+        self.queries += 1
+        return self.docs.get(query["member_number"])
+
+def test_member_number_cache_hits_after_first_lookup():
+    cache = MemberNumberCache(max_size=2)
+    cache.collection = _FakeMembers({"001": {"id": MEMBER_ID}})
+    
+    assert asyncio.run(cache.resolve("001")) == MEMBER_ID
+    assert asyncio.run(cache.resolve("001")) == MEMBER_ID
+    assert asyncio.run(cache.resolve("999")) is None
+    assert cache.collection.queries == 2
+    assert cache.get_stats()["hits"] == 1
+
+def test_member_number_cache_evicts_least_recently_used():
+    cache = MemberNumberCache(max_size=2)
+    for number in ("001", "002", "003"):
+        cache.put(number, str(uuid.uuid4()))
+    assert "001" not in cache._ids
+    cache.invalidate("002")
+    assert list(cache._ids) == ["003"]
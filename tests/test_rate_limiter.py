@@ -0,0 +1,169 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from utils import cache, rate_limiter
+from utils.cache import LocalCacheTier
+from utils.rate_limiter import (
+    Principal, RateLimitMiddleware, client_ip_from_scope, gym_rate_limiter, is_trusted_proxy,
+    parse_trusted_proxies, resolve_client_ip
+)
+
+STAFF = Principal("user", "alice", "staff", True)
+
+@pytest.fixture
+def payloads(monkeypatch):
+    """Decoder de teste para o gym_rate_limiter: token -> payload deste dict"""
+    payloads = {}
+    monkeypatch.setattr(gym_rate_limiter, "_principal_cache", LocalCacheTier(max_items=100, ttl_seconds=60))
+    monkeypatch.setattr(gym_rate_limiter, "_active_check", None)
+    monkeypatch.setattr(gym_rate_limiter, "_token_decoder", lambda token: payloads[token])
+    return payloads
+
+def test_principal_cache_never_outlives_token_expiry(fake_clock, payloads):
+    clock = fake_clock(cache)
+    payloads["t"] = {"sub": "alice", "role": "staff", "exp": time.time() + 5}
+    assert gym_rate_limiter._principal_from_token("t") == STAFF
+    
+    del payloads["t"]  # o decoder passaria a falhar (token expirado)
+    clock.now += 4
+    assert gym_rate_limiter._principal_from_token("t") == STAFF
+    clock.now += 1
+    assert gym_rate_limiter._principal_from_token("t") is None
+
+def test_principal_without_exp_uses_cache_ttl(fake_clock, payloads):
+    clock = fake_clock(cache)
+    payloads["t"] = {"sub": "m1", "role": "member"}
+    assert gym_rate_limiter._principal_from_token("t") == Principal("member", "m1", "member", True)
+    del payloads["t"]
+    clock.now += 59
+    assert gym_rate_limiter._principal_from_token("t") is not None
+
+def test_principal_is_active(payloads):
+    assert asyncio.run(gym_rate_limiter.principal_is_active(STAFF))
+    
+    async def inactive(principal):
+        return False
+    gym_rate_limiter._active_check = inactive
+    assert not asyncio.run(gym_rate_limiter.principal_is_active(STAFF))
+    
+    async def broken(principal):
+        raise ConnectionError("mongo down")
+    gym_rate_limiter._active_check = broken
+    assert not asyncio.run(gym_rate_limiter.principal_is_active(STAFF))
+
+async def _call(middleware, headers):
+    sent = []
+    scope = {"type": "http", "method": "GET", "path": "/api/members", "client": ("203.0.113.9", 5000),
+             "headers": headers, "query_string": b""}
+    
+    async def receive():
+        return {"type": "http.request", "body": b""}
+    
+    async def send(message):
+        sent.append(message)
+    
+    await middleware(scope, receive, send)
+    return sent[0]["status"], scope["state"]
+
+@pytest.fixture
+def blocked_ip(monkeypatch):
+    monkeypatch.setattr(gym_rate_limiter.abuse_store, "blocked_for", lambda ip: 600.0)
+
+async def _ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+@pytest.mark.parametrize("headers", [[], [(b"authorization", b"Bearer unknown")], [(b"authorization", b"Basic alice")]])
+def test_blocked_ip_without_valid_token_gets_429(payloads, blocked_ip, headers):
+    status, _ = asyncio.run(_call(RateLimitMiddleware(_ok_app), headers))
+    assert status == 429
+
+def test_valid_token_of_active_user_bypasses_ip_block(payloads, blocked_ip):
+    payloads["alice"] = {"sub": "alice", "role": "staff"}
+    
+    async def active(principal):
+        return True
+    gym_rate_limiter._active_check = active
+    status, state = asyncio.run(_call(RateLimitMiddleware(_ok_app), [(b"authorization", b"Bearer alice")]))
+    assert status == 200
+    assert state["principal"] == STAFF
+
+def test_valid_token_of_deactivated_user_is_blocked(payloads, blocked_ip):
+    payloads["alice"] = {"sub": "alice", "role": "staff"}
+    
+    async def inactive(principal):
+        return False
+    gym_rate_limiter._active_check = inactive
+    status, state = asyncio.run(_call(RateLimitMiddleware(_ok_app), [(b"authorization", b"Bearer alice")]))
+    assert status == 429
+    assert "principal" not in state
+
+@pytest.fixture
+def trusted_proxies(monkeypatch):
+    """trusted_proxies("10.0.0.0/8", ...) substitui TRUSTED_PROXIES durante o teste"""
+    def configure(*cidrs):
+        ranges = {socket.AF_INET: [], socket.AF_INET6: []}
+        for network in parse_trusted_proxies(",".join(cidrs)):
+            family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+            ranges[family].append((int(network.network_address), int(network.netmask)))
+        monkeypatch.setattr(rate_limiter, "_TRUSTED_RANGES", ranges)
+        is_trusted_proxy.cache_clear()
+    yield configure
+    is_trusted_proxy.cache_clear()
+
+def _scope(peer, *headers):
+    return {"type": "http", "client": (peer, 50000) if peer else None, "headers": list(headers)}
+
+def test_forwarded_for_is_read_right_to_left_up_to_first_untrusted_hop(trusted_proxies):
+    trusted_proxies("10.0.0.0/8")
+    # O cliente pôs 1.2.3.4 no header; o proxy acrescentou o IP que viu de facto
+    assert resolve_client_ip("10.0.0.2", "1.2.3.4, 203.0.113.9, 10.0.0.5", None) == "203.0.113.9"
+
+def test_chain_of_trusted_proxies_resolves_to_leftmost(trusted_proxies):
+    trusted_proxies("10.0.0.0/8")
+    assert resolve_client_ip("10.0.0.2", "10.1.1.1, 10.0.0.5", None) == "10.1.1.1"
+
+def test_untrusted_peer_cannot_spoof_forwarded_headers(trusted_proxies):
+    trusted_proxies("10.0.0.0/8")
+    scope = _scope("203.0.113.9", (b"x-forwarded-for", b"10.0.0.7"), (b"x-real-ip", b"10.0.0.8"))
+    assert client_ip_from_scope(scope) == "203.0.113.9"
+    assert resolve_client_ip("203.0.113.9", "1.2.3.4", "5.6.7.8") == "203.0.113.9"
+
+def test_multiple_forwarded_for_headers_are_one_list(trusted_proxies):
+    trusted_proxies("10.0.0.0/8")
+    scope = _scope("10.0.0.2", (b"x-forwarded-for", b"1.2.3.4, 198.51.100.1"), (b"x-forwarded-for", b"10.0.0.5"))
+    assert client_ip_from_scope(scope) == "198.51.100.1"
+
+@pytest.mark.parametrize("forwarded_for, real_ip, expected", [
+    ("garbage, , 198.51.100.1", None, "198.51.100.1"),
+    (" , ,", None, "10.0.0.2"),
+    ("", "198.51.100.2", "198.51.100.2"),
+    (" , ", " 198.51.100.2 ", "198.51.100.2"),
+])
+def test_malformed_forwarded_for(trusted_proxies, forwarded_for, real_ip, expected):
+    trusted_proxies("10.0.0.0/8")
+    assert resolve_client_ip("10.0.0.2", forwarded_for, real_ip) == expected
+
+@pytest.mark.parametrize("peer, trusted", [
+    ("2001:db8::1", True),
+    ("2001:db8:ffff::1", True),
+    ("2001:db9::1", False),
+    ("fe80::1%eth0", True),
+    ("::1", True),
+    ("10.0.0.2", False),
+    ("not-an-ip", False),
+])
+def test_ipv6_peers(trusted_proxies, peer, trusted):
+    trusted_proxies("2001:db8::/32", "fe80::/10", "::1/128")
+    assert is_trusted_proxy(peer) is trusted
+    expected = "2001:db8:1::9" if trusted else peer
+    assert client_ip_from_scope(_scope(peer, (b"x-forwarded-for", b"2001:db8:1::9"))) == expected
+
+def test_missing_peer_and_cached_resolution():
+    assert client_ip_from_scope(_scope(None)) == "unknown"
+    scope = _scope("203.0.113.9")
+    scope["state"] = {"client_ip": "198.51.100.7"}
+    assert client_ip_from_scope(scope) == "198.51.100.7"
@@ -0,0 +1,44 @@
+import pytest
+
+from utils import request_sampling
+from utils.request_sampling import RequestSampler, _parse_route_rates
+
+def test_parse_route_rates_clamps_and_skips_garbage():
+    rates = _parse_route_rates("GET /api/dashboard=0.05, /api/members=2,=0.5,nonsense")
+    assert rates == {"GET /api/dashboard": 0.05, "/api/members": 1.0}
+
+@pytest.mark.parametrize("status_code, duration_ms, db_commands", [
+    (404, 5, 0),
+    (500, 5, 0),
+    (200, 1000, 0),
+    (200, 5, 50),
+])
+def test_errors_slow_and_chatty_requests_are_always_kept(status_code, duration_ms, db_commands):
+    sampler = RequestSampler(base_rate=0.0, slow_ms=1000, max_db_commands=50)
+    assert sampler.decide("GET", "/api/members", status_code, duration_ms, db_commands) == 1.0
+    assert sampler.get_stats()["kept_always"] == 1
+
+def test_zero_rate_samples_everything_out():
+    sampler = RequestSampler(base_rate=0.0)
+    assert sampler.decide("GET", "/api/members", 200, 5) is None
+    assert sampler.get_stats()["sampled_out"] == 1
+
+def test_method_specific_rate_wins_over_route_rate():
+    sampler = RequestSampler(base_rate=0.5, route_rates={"GET /api/members": 0.0, "/api/members": 1.0})
+    assert sampler.rate_for("GET", "/api/members") == 0.0
+    assert sampler.rate_for("POST", "/api/members") == 1.0
+    assert sampler.rate_for("GET", "/api/payments") == 0.5
+
+def test_kept_requests_carry_their_sample_rate(monkeypatch):
+    sampler = RequestSampler(base_rate=0.25)
+    monkeypatch.setattr(request_sampling.random, "random", lambda: 0.1)
+    assert sampler.decide("GET", "/api/members", 200, 5) == 0.25
+    monkeypatch.setattr(request_sampling.random, "random", lambda: 0.9)
+    assert sampler.decide("GET", "/api/members", 200, 5) is None
+
+def test_excluded_prefixes():
+    sampler = RequestSampler(excluded_prefixes=("/health", "/static", ""))
+    assert sampler.is_excluded("/healthz")
+    assert sampler.is_excluded("/static/app.js")
+    assert not sampler.is_excluded("/api/members")
+    assert not RequestSampler().is_excluded("/health")
@@ -0,0 +1,103 @@
+import pytest
+
+from utils import rate_limiter
+from utils.rate_limiter import SecurityAnalyzer
+
+IP = "198.51.100.7"
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(rate_limiter)
+
+@pytest.fixture
+def reports(monkeypatch):
+    reports = []
+    monkeypatch.setattr(rate_limiter.gym_rate_limiter, "record_failed_attempt",
+                        lambda ip, endpoint="": reports.append((ip, endpoint)))
+    return reports
+
+@pytest.fixture
+def analyzer():
+    return SecurityAnalyzer(window_seconds=60, enumeration_threshold=20, not_found_ratio=0.5,
+                            min_requests=10, report_interval=5, enumeration_not_found_ratio=0.2)
+
+def _scan(analyzer, count, not_found_every=0, start=0, ip=IP):
+    """`count` pedidos a ids distintos; cada `not_found_every`-ésimo devolve 404"""
+    results = []
+    for i in range(start, start + count):
+        status = 404 if not_found_every and i % not_found_every == 0 else 200
+        results.append(analyzer.observe_resource(ip, f"members:m-{i}", f"/api/members/m-{i}", status))
+    return results
+
+def test_shared_nat_ip_reading_many_members_is_not_flagged(clock, reports, analyzer):
+    # Dezenas de membros no Wi-Fi do ginásio, cada um com o seu member_id
+    assert _scan(analyzer, 40) == [None] * 40
+    assert reports == []
+
+def test_id_enumeration_with_404s_is_flagged(clock, reports, analyzer):
+    results = _scan(analyzer, 25, not_found_every=3)
+    assert results[:20] == [None] * 20
+    flagged = results[20]
+    assert "resource_enumeration" in flagged["flags"]
+    assert flagged["risk_level"] == "high"
+    assert reports == [(IP, "security:sensitive_endpoint_access,resource_enumeration")]
+
+def test_high_404_ratio_on_a_single_resource(clock, reports, analyzer):
+    results = [analyzer.observe_resource(IP, "members:m-1", "/api/members/m-1", 404) for _ in range(10)]
+    assert results[:9] == [None] * 9
+    assert results[9]["flags"] == ["sensitive_endpoint_access", "high_404_ratio"]
+
+def test_reports_are_rate_limited_by_report_interval(clock, reports, analyzer):
+    _scan(analyzer, 30, not_found_every=3)
+    assert len(reports) == 1
+    assert analyzer.get_stats()["flagged"] == 10
+    
+    clock.now += 5
+    _scan(analyzer, 1, not_found_every=3, start=30)
+    assert len(reports) == 2
+
+def test_counts_fade_after_the_window(clock, reports, analyzer):
+    _scan(analyzer, 20, not_found_every=3)
+    clock.now += 90
+    # A meio da janela seguinte a anterior pesa metade: 10 + 10 ids, no limite mas não acima
+    assert _scan(analyzer, 10, not_found_every=3, start=20) == [None] * 10
+    assert _scan(analyzer, 1, start=30)[0] is not None
+    
+    # Duas janelas sem pedidos: tudo esquecido
+    clock.now += 120
+    assert _scan(analyzer, 20, not_found_every=3, start=40) == [None] * 20
+    assert len(reports) == 1
+
+def test_tracked_ips_are_lru_bounded(clock, reports):
+    analyzer = SecurityAnalyzer(max_tracked_ips=2)
+    for ip in ("10.1.0.1", "10.1.0.2", "10.1.0.3"):
+        analyzer.observe_resource(ip, "members:m-1", "/api/members/m-1", 404)
+    assert analyzer.get_stats()["tracked_ips"] == 2
+    assert "10.1.0.1" not in analyzer._windows
+
+@pytest.mark.parametrize("path, query_string, resource", [
+    ("/api/members/qr/m-1", b"", "members/qr:m-1"),
+    ("/api/members/m-1", b"", "members:m-1"),
+    ("/api/members/m-1/qr", b"", "members:m-1"),
+    ("/api/mobile/attendance/m-1", b"", "mobile/attendance:m-1"),
+    ("/api/mobile/profile", b"lang=pt&member_id=m-1", "/api/mobile/profile:m-1"),
+    ("/api/members", b"", None),
+    ("/api/activities/a-1", b"", None),
+])
+def test_resource_id(analyzer, path, query_string, resource):
+    assert analyzer.resource_id(path, query_string) == resource
+
+def test_ip_is_only_tracked_from_its_first_404(clock, reports, analyzer):
+    assert not analyzer.needs_analysis(IP, 200)
+    assert analyzer.observe(IP, "/api/members/m-1", 200) is None
+    assert analyzer.get_stats()["tracked_ips"] == 0
+    
+    analyzer.observe(IP, "/api/members/m-2", 404)
+    assert analyzer.needs_analysis(IP, 200)
+    analyzer.observe(IP, "/api/members/m-3", 200)
+    assert analyzer.get_stats()["observed"] == 2
+
+def test_suspicious_user_agent_is_analyzed_without_404s(clock, reports, analyzer):
+    assert analyzer.needs_analysis(IP, 200, "python-scraper/1.0")
+    analysis = analyzer.observe(IP, "/api/members/m-1", 200, user_agent="python-scraper/1.0")
+    assert "suspicious_user_agent" in analysis["flags"]
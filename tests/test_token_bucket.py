@@ -0,0 +1,78 @@
+import pytest
+import redis
+
+from utils import token_bucket
+from utils.circuit_breaker import CircuitBreaker
+from utils.rate_limiter import Principal, ROLE_RATE_LIMITS, gym_rate_limiter
+from utils.token_bucket import LocalTokenBuckets, RedisTokenBuckets, parse_rate
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(token_bucket)
+
+@pytest.mark.parametrize("rate, expected", [
+    ("60/minute", (60, 1.0)),
+    ("10/second", (10, 10.0)),
+    ("7200 / hours", (7200, 2.0)),
+])
+def test_parse_rate(rate, expected):
+    assert parse_rate(rate) == expected
+
+def test_parse_rate_rejects_unknown_period():
+    with pytest.raises(ValueError):
+        parse_rate("10/fortnight")
+
+def test_burst_up_to_capacity_then_denied(clock):
+    buckets = LocalTokenBuckets()
+    assert all(buckets.take("k", 3, 1.0)[0] for _ in range(3))
+    allowed, retry_after = buckets.take("k", 3, 1.0)
+    assert not allowed
+    assert retry_after == pytest.approx(1.0)
+
+def test_refill_is_continuous_and_capped(clock):
+    buckets = LocalTokenBuckets()
+    for _ in range(3):
+        buckets.take("k", 3, 2.0)
+    
+    clock.now += 0.25  # meio token
+    allowed, retry_after = buckets.take("k", 3, 2.0)
+    assert not allowed
+    assert retry_after == pytest.approx(0.25)
+    
+    clock.now += 0.25
+    assert buckets.take("k", 3, 2.0)[0]
+    
+    clock.now += 3600  # nunca acima da capacidade
+    assert sum(buckets.take("k", 3, 2.0)[0] for _ in range(5)) == 3
+
+def test_cost_larger_than_available(clock):
+    buckets = LocalTokenBuckets()
+    assert buckets.take("k", 5, 1.0, cost=4)[0]
+    allowed, retry_after = buckets.take("k", 5, 1.0, cost=4)
+    assert not allowed
+    assert retry_after == pytest.approx(3.0)
+
+def test_keys_are_independent_and_lru_bounded(clock):
+    buckets = LocalTokenBuckets(max_keys=2)
+    buckets.take("a", 1, 1.0)
+    buckets.take("b", 1, 1.0)
+    assert not buckets.take("a", 1, 1.0)[0]
+    buckets.take("c", 1, 1.0)  # "b" é o menos recente
+    assert buckets.stats()["buckets"] == 2
+    assert buckets.take("b", 1, 1.0)[0]
+
+def test_redis_unavailable_falls_back_to_local_limits(clock):
+    client = redis.from_url("redis://127.0.0.1:1/0", socket_connect_timeout=0.1, socket_timeout=0.1)
+    buckets = RedisTokenBuckets(client)
+    results = [buckets.take("k", 3, 1.0)[0] for _ in range(5)]
+    assert results == [True, True, True, False, False]
+    assert buckets.breaker.state == CircuitBreaker.OPEN
+    assert buckets.stats()["local_fallback"]["buckets"] == 1
+
+def test_member_login_bucket_is_per_member_number():
+    capacity, _ = parse_rate(ROLE_RATE_LIMITS["member"]["member_login"])
+    principal = Principal("member", "test-login-0001", "member", False)
+    results = [gym_rate_limiter.take_token(principal, "member_login")[0] for _ in range(capacity + 1)]
+    assert results == [True] * capacity + [False]
+    other = Principal("member", "test-login-0002", "member", False)
+    assert gym_rate_limiter.take_token(other, "member_login")[0]